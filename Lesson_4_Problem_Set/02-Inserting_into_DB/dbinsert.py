@@ -1,16 +1,22 @@
 import json
+import os
+import sys
 
+# mongowriter lives in the project root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+import mongowriter
 
-def insert_data(data, db):
+
+def insert_data(data, db, batch_size=mongowriter.BATCH_SIZE):
     # Your code here. Insert the data into a collection 'arachnid'
-    for d in data:
-        db.arachnid.insert_one(d)
+    with mongowriter.BulkWriter(db.arachnid, batch_size) as writer:
+        for d in data:
+            writer.insert(d)
 
 
 if __name__ == "__main__":
 
-    from pymongo import MongoClient
-    client = MongoClient("mongodb://localhost:27017")
+    client = mongowriter.get_client("mongodb://localhost:27017")
     db = client.examples
 
     with open('arachnid.json') as f:
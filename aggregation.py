@@ -0,0 +1,536 @@
+'''
+In-process executor of mongodb aggregation pipelines, for running the analyses
+of region.py, city.py, population.py, average_population_region.py and the
+notebook on a machine without a database.
+
+    import aggregation
+    for doc in aggregation.run("munich.json", pipeline):
+        ...
+
+Documents are streamed from files written by osmData.routine (one document per
+line, or pretty printed), a json array, mongo shell output (ObjectId(..)) or
+pprint output such as examples.json. Compressed files are read as in
+osmstream.open_osm.
+
+Supported stages and operators, with mongodb semantics where they matter for
+these pipelines (a missing field equals None, a condition on an array field
+matches if any element matches, sort order None < numbers < strings < documents
+< arrays < booleans):
+
+    $match      $eq $ne $gt $gte $lt $lte $in $nin $exists, $and $or $nor
+    $unwind     "$field" or {"path": "$field"}
+    $group      _id: "$field", constant or document of those, $year of an iso timestamp
+                $sum $avg $min $max $first $last $push $addToSet
+    $sort $limit $skip
+
+$group is a hash aggregation, one entry per group, and a $sort followed by a
+$limit keeps a heap of the first n documents instead of sorting all of them.
+'''
+import ast
+import heapq
+import json
+import re
+import sys
+from contextlib import closing
+from itertools import islice
+
+import osmstream
+
+EXAMPLES = "examples.json"
+
+NUMBERS = (int, long, float)
+STRINGS = (str, unicode)
+
+# mongo shell prints ids as ObjectId("..")
+object_id_re = re.compile(r'ObjectId\(("[0-9a-fA-F]*")\)')
+
+_missing = object()
+
+
+def iter_documents(path):
+    ''' Yield the documents of a file, see the module doc for the formats. '''
+    with closing(osmstream.open_osm(path)) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '[':
+            for doc in json.loads('[' + f.read()):
+                yield doc
+            return
+
+        # a document starts with a '{' in the first column, the lines of a pretty printed one are indented
+        lines = [first] if first else []
+        for line in f:
+            if line.startswith('{') and lines:
+                yield _parse(''.join(lines))
+                lines = []
+            lines.append(line)
+        if ''.join(lines).strip():
+            yield _parse(''.join(lines))
+
+
+def _parse(text):
+    try:
+        return json.loads(object_id_re.sub(r'\1', text))
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def _path(field):
+    ''' 'created.user' -> ('created', 'user') '''
+    return tuple(field.split('.'))
+
+
+def _lookup(doc, path):
+    ''' Value at path, _missing if doc has none. '''
+    for key in path:
+        if not isinstance(doc, dict):
+            return _missing
+        doc = doc.get(key, _missing)
+        if doc is _missing:
+            return _missing
+    return doc
+
+
+def _with_value(doc, path, value):
+    ''' Shallow copy of doc with value at path. '''
+    doc = dict(doc)
+    if len(path) == 1:
+        doc[path[0]] = value
+    else:
+        doc[path[0]] = _with_value(doc.get(path[0]) or {}, path[1:], value)
+    return doc
+
+
+def _order(value):
+    ''' Sort key of a value in mongodb order, also across types. '''
+    if value is None or value is _missing:
+        return (0,)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, NUMBERS):
+        return (1, value)
+    if isinstance(value, STRINGS):
+        return (2, value)
+    if isinstance(value, dict):
+        return (3, tuple((k, _order(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return (4, tuple(_order(v) for v in value))
+    return (6, value)
+
+
+def _hashable(value):
+    ''' Group key of an _id value. '''
+    if isinstance(value, dict):
+        return ('{}',) + tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    if isinstance(value, list):
+        return ('[]',) + tuple(_hashable(v) for v in value)
+    return value
+
+
+# $match
+
+def _equals(value, expected):
+    if expected is None:
+        return value is None or value is _missing or (isinstance(value, list) and None in value)
+    if value is _missing:
+        return False
+    return value == expected or (isinstance(value, list) and not isinstance(expected, list) and expected in value)
+
+
+def _comparison(op):
+    def compare(value, bound):
+        candidates = value if isinstance(value, list) else [value]
+        for candidate in candidates:
+            # only values of the same kind are compared, as in mongodb
+            if isinstance(bound, NUMBERS) and not isinstance(bound, bool):
+                if not isinstance(candidate, NUMBERS) or isinstance(candidate, bool):
+                    continue
+            elif isinstance(bound, STRINGS):
+                if not isinstance(candidate, STRINGS):
+                    continue
+            elif type(candidate) is not type(bound):
+                continue
+            if op(candidate, bound):
+                return True
+        return False
+    return compare
+
+
+QUERY_OPERATORS = {
+    '$eq': _equals,
+    '$ne': lambda value, expected: not _equals(value, expected),
+    '$gt': _comparison(lambda a, b: a > b),
+    '$gte': _comparison(lambda a, b: a >= b),
+    '$lt': _comparison(lambda a, b: a < b),
+    '$lte': _comparison(lambda a, b: a <= b),
+    '$in': lambda value, options: any(_equals(value, o) for o in options),
+    '$nin': lambda value, options: not any(_equals(value, o) for o in options),
+    '$exists': lambda value, exists: (value is not _missing) == bool(exists),
+}
+
+
+def _field_test(field, condition):
+    path = _path(field)
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        tests = []
+        for op, argument in condition.iteritems():
+            if op not in QUERY_OPERATORS:
+                raise ValueError("unsupported query operator {0}".format(op))
+            tests.append((QUERY_OPERATORS[op], argument))
+        return lambda doc: all(test(_lookup(doc, path), argument) for test, argument in tests)
+    return lambda doc: _equals(_lookup(doc, path), condition)
+
+
+def compile_match(query):
+    ''' Predicate doc -> bool of a $match query. '''
+    tests = []
+    for key, condition in query.iteritems():
+        if key in ('$and', '$or', '$nor'):
+            subqueries = [compile_match(q) for q in condition]
+            if key == '$and':
+                tests.append(lambda doc, subqueries=subqueries: all(q(doc) for q in subqueries))
+            elif key == '$or':
+                tests.append(lambda doc, subqueries=subqueries: any(q(doc) for q in subqueries))
+            else:
+                tests.append(lambda doc, subqueries=subqueries: not any(q(doc) for q in subqueries))
+        elif key.startswith('$'):
+            raise ValueError("unsupported query operator {0}".format(key))
+        else:
+            tests.append(_field_test(key, condition))
+    if len(tests) == 1:
+        return tests[0]
+    return lambda doc: all(test(doc) for test in tests)
+
+
+# expressions of $group
+
+def _year(value):
+    # iso timestamps as written by osmData, e.g. "2013-08-03T16:43:42Z"
+    if isinstance(value, STRINGS) and len(value) >= 4 and value[:4].isdigit():
+        return int(value[:4])
+    return getattr(value, 'year', None)
+
+
+EXPRESSION_OPERATORS = {
+    '$year': _year,
+}
+
+
+def compile_expression(expression):
+    ''' Function doc -> value of "$field", {"$year": ..}, a document of expressions or a constant. '''
+    if isinstance(expression, STRINGS) and expression.startswith('$'):
+        path = _path(expression[1:])
+        def field(doc):
+            value = _lookup(doc, path)
+            return None if value is _missing else value
+        return field
+    if isinstance(expression, dict):
+        if len(expression) == 1 and expression.keys()[0].startswith('$'):
+            op, argument = expression.items()[0]
+            if op not in EXPRESSION_OPERATORS:
+                raise ValueError("unsupported expression operator {0}".format(op))
+            function, value = EXPRESSION_OPERATORS[op], compile_expression(argument)
+            return lambda doc: function(value(doc))
+        fields = [(key, compile_expression(value)) for key, value in expression.iteritems()]
+        return lambda doc: dict((key, value(doc)) for key, value in fields)
+    if isinstance(expression, list):
+        items = [compile_expression(value) for value in expression]
+        return lambda doc: [value(doc) for value in items]
+    return lambda doc: expression
+
+
+def _is_number(value):
+    return isinstance(value, NUMBERS) and not isinstance(value, bool)
+
+
+def _avg_step(state, value):
+    if _is_number(value):
+        state[0] += value
+        state[1] += 1
+    return state
+
+
+def _min_step(state, value):
+    if value is None:
+        return state
+    return value if state is None or _order(value) < _order(state) else state
+
+
+def _max_step(state, value):
+    if value is None:
+        return state
+    return value if state is None or _order(value) > _order(state) else state
+
+
+def _add_to_set(state, value):
+    key = _hashable(value)
+    if key not in state[0]:
+        state[0].add(key)
+        state[1].append(value)
+    return state
+
+
+# name: (initial state, step(state, value) -> state, result(state))
+ACCUMULATORS = {
+    '$sum': (lambda: 0, lambda state, value: state + value if _is_number(value) else state, lambda state: state),
+    '$avg': (lambda: [0, 0], _avg_step, lambda state: float(state[0]) / state[1] if state[1] else None),
+    '$min': (lambda: None, _min_step, lambda state: state),
+    '$max': (lambda: None, _max_step, lambda state: state),
+    '$first': (lambda: _missing, lambda state, value: value if state is _missing else state, lambda state: state),
+    '$last': (lambda: None, lambda state, value: value, lambda state: state),
+    '$push': (list, lambda state, value: state.append(value) or state, lambda state: state),
+    '$addToSet': (lambda: (set(), []), _add_to_set, lambda state: state[1]),
+}
+
+
+def _group(docs, spec):
+    if '_id' not in spec:
+        raise ValueError("$group needs an _id")
+    group_id = compile_expression(spec['_id'])
+    accumulators = []
+    for name, accumulator in spec.iteritems():
+        if name == '_id':
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise ValueError("$group field {0} must be a single accumulator".format(name))
+        op, argument = accumulator.items()[0]
+        if op not in ACCUMULATORS:
+            raise ValueError("unsupported accumulator {0}".format(op))
+        accumulators.append((name, ACCUMULATORS[op], compile_expression(argument)))
+
+    # key -> [_id, state per accumulator], in order of the first document of each group
+    groups = {}
+    order = []
+    for doc in docs:
+        value = group_id(doc)
+        key = _hashable(value)
+        entry = groups.get(key)
+        if entry is None:
+            entry = groups[key] = [value] + [init() for _, (init, _, _), _ in accumulators]
+            order.append(key)
+        for i, (_, (_, step, _), argument) in enumerate(accumulators, 1):
+            entry[i] = step(entry[i], argument(doc))
+
+    for key in order:
+        entry = groups[key]
+        result = {'_id': entry[0]}
+        for i, (name, (_, _, final), _) in enumerate(accumulators, 1):
+            result[name] = final(entry[i])
+        yield result
+
+
+# $sort, $limit
+
+class _Descending(object):
+    ''' Inverts the order of a sort key. '''
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+
+def sort_key(spec):
+    ''' Function doc -> sort key of a $sort spec such as {"count": -1}. '''
+    fields = [(_path(field), direction < 0) for field, direction in spec.iteritems()]
+    def key(doc):
+        return tuple(_Descending(_order(_lookup(doc, path))) if descending else _order(_lookup(doc, path))
+                     for path, descending in fields)
+    return key
+
+
+def _sort(docs, spec, limit=None):
+    ''' The documents in $sort order, only the first limit ones if given. Stable, like mongodb on equal keys. '''
+    key = sort_key(spec)
+    if limit is None:
+        return iter(sorted(docs, key=key))
+    return iter(heapq.nsmallest(limit, docs, key=key))
+
+
+def _unwind(docs, spec):
+    field = spec['path'] if isinstance(spec, dict) else spec
+    path = _path(field.lstrip('$'))
+    for doc in docs:
+        value = _lookup(doc, path)
+        if isinstance(value, list):
+            for item in value:
+                yield _with_value(doc, path, item)
+        elif value is not _missing and value is not None:
+            yield doc
+
+
+def aggregate(docs, pipeline):
+    ''' Run a pipeline.
+    Args:
+        docs iterable - input documents, e.g. iter_documents(path)
+        pipeline list - stage dicts, as passed to pymongo's Collection.aggregate
+    Return:
+        iterator of the result documents
+    '''
+    docs = iter(docs)
+    stages = list(pipeline)
+    i = 0
+    while i < len(stages):
+        if len(stages[i]) != 1:
+            raise ValueError("a stage must have exactly one key: {0}".format(stages[i]))
+        name, spec = stages[i].items()[0]
+        i += 1
+        if name == '$match':
+            docs = _filter(docs, compile_match(spec))
+        elif name == '$unwind':
+            docs = _unwind(docs, spec)
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$sort':
+            limit = None
+            if i < len(stages) and stages[i].keys() == ['$limit']:
+                limit = stages[i]['$limit']
+                i += 1
+            docs = _sort(docs, spec, limit)
+        elif name == '$limit':
+            docs = islice(docs, spec)
+        elif name == '$skip':
+            docs = islice(docs, spec, None)
+        else:
+            raise ValueError("unsupported stage {0}".format(name))
+    return docs
+
+
+def _filter(docs, predicate):
+    for doc in docs:
+        if predicate(doc):
+            yield doc
+
+
+def run(paths, pipeline):
+    ''' Run a pipeline over the documents of one file or a list of files (e.g. the shards of a routine run). '''
+    if isinstance(paths, STRINGS):
+        paths = [paths]
+    return aggregate((doc for path in paths for doc in iter_documents(path)), pipeline)
+
+
+def main(make_pipeline, aggregate_db, argv=None):
+    ''' Results of the pipeline of an analysis script: with --local [file] run in process over file (EXAMPLES by
+    default), without a database, else by the script's database query.
+    Args:
+        make_pipeline function - returns the pipeline
+        aggregate_db function - runs a pipeline on the database, returns its results
+        argv list - command line, sys.argv by default
+    '''
+    argv = sys.argv if argv is None else argv
+    pipeline = make_pipeline()
+    if '--local' not in argv:
+        return aggregate_db(pipeline)
+    args = [arg for arg in argv[1:] if arg != '--local']
+    return run(args[0] if args else EXAMPLES, pipeline)
+
+
+def benchmark(n=500000, distinct=200000):
+    ''' Documents/s of the notebook pipelines over n synthetic documents, and of a top 10 by heap against a full sort
+    over distinct groups.
+    '''
+    import random
+    import time
+
+    rnd = random.Random(1)
+    amenities = ['bench', 'parking', 'restaurant', 'vending_machine', 'shelter', 'waste_basket']
+    docs = []
+    for i in xrange(n):
+        doc = {'id': str(i), 'type': 'node', 'created': {'user': 'user%d' % int(rnd.paretovariate(0.8)),
+                                                        'timestamp': '201%d-08-03T16:43:42Z' % rnd.randint(0, 6)}}
+        if rnd.random() < 0.1:
+            doc['amenity'] = rnd.choice(amenities)
+            doc['address'] = {'postcode': str(80000 + rnd.randint(0, 2000))}
+        docs.append(doc)
+
+    pipelines = [
+        ('top users', [{'$group': {'_id': '$created.user', 'count': {'$sum': 1}}},
+                       {'$sort': {'count': -1}}, {'$limit': 3}]),
+        ('top amenities', [{'$match': {'amenity': {'$exists': 1}}},
+                           {'$group': {'_id': '$amenity', 'count': {'$sum': 1}}},
+                           {'$sort': {'count': -1}}, {'$limit': 5}]),
+        ('postcodes by year', [{'$match': {'address.postcode': {'$exists': 1}}},
+                               {'$group': {'_id': {'year': {'$year': '$created.timestamp'}, 'plz': '$address.postcode'},
+                                           'count': {'$sum': 1}}},
+                               {'$sort': {'count': -1}}, {'$limit': 5}]),
+    ]
+    for name, pipeline in pipelines:
+        started = time.time()
+        result = list(aggregate(docs, pipeline))
+        elapsed = time.time() - started
+        print "{0}: {1:.0f} docs/s, {2}".format(name, n / elapsed, result[0])
+
+    groups = [{'_id': i, 'count': rnd.randint(0, 1000000)} for i in xrange(distinct)]
+    for label, limit in (('heap', 10), ('full sort', None)):
+        started = time.time()
+        top = list(islice(_sort(groups, {'count': -1}, limit), 10))
+        print "top 10 of {0} groups, {1}: {2:.3f}s".format(distinct, label, time.time() - started)
+
+
+def test():
+    import os
+    import tempfile
+
+    docs = list(iter_documents(EXAMPLES))
+    assert len(docs) == 226 and docs[0]['name'] == 'Kud'
+
+    cities = [
+        {'name': 'a', 'country': 'India', 'lon': 76, 'isPartOf': ['X', 'Y'], 'population': 100},
+        {'name': 'b', 'country': 'India', 'lon': 77, 'isPartOf': ['X'], 'population': 300},
+        {'name': 'a', 'country': 'India', 'lon': 85, 'isPartOf': 'Y', 'population': 50},
+        {'country': 'Kuwait', 'lon': 'n/a', 'isPartOf': [], 'population': 10},
+    ]
+    region = [{'$match': {'country': {'$eq': 'India'}}},
+              {'$match': {'$and': [{'lon': {'$gt': 75}}, {'lon': {'$lt': 80}}]}},
+              {'$unwind': '$isPartOf'},
+              {'$group': {'_id': '$isPartOf', 'count': {'$sum': 1}}},
+              {'$sort': {'count': -1}},
+              {'$limit': 1}]
+    assert list(aggregate(cities, region)) == [{'_id': 'X', 'count': 2}]
+
+    city = [{'$match': {'name': {'$ne': None}}},
+            {'$group': {'_id': '$name', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1, '_id': 1}}]
+    assert list(aggregate(cities, city)) == [{'_id': 'a', 'count': 2}, {'_id': 'b', 'count': 1}]
+
+    average = [{'$unwind': '$isPartOf'},
+               {'$group': {'_id': {'region': '$isPartOf', 'country': '$country'}, 'avg': {'$avg': '$population'}}},
+               {'$group': {'_id': '$_id.country', 'avg': {'$avg': '$avg'}}}]
+    assert list(aggregate(cities, average)) == [{'_id': 'India', 'avg': 137.5}]
+
+    assert list(aggregate(cities, [{'$match': {'isPartOf': 'Y', 'name': {'$in': ['a', 'c']}}}, {'$skip': 1}])) == [cities[2]]
+    assert [d.get('name') for d in aggregate(cities, [{'$sort': {'name': 1}}])] == [None, 'a', 'a', 'b']
+    assert list(aggregate(cities, [{'$group': {'_id': None, 'names': {'$addToSet': '$name'}, 'max': {'$max': '$lon'}}}])) == \
+        [{'_id': None, 'names': ['a', 'b', None], 'max': 'n/a'}]
+
+    # routine output, one document per line and pretty printed
+    directory = tempfile.mkdtemp()
+    for indent in (None, 2):
+        path = os.path.join(directory, 'cities.json')
+        with open(path, 'w') as f:
+            for doc in cities:
+                f.write(json.dumps(doc, indent=indent) + '\n')
+        assert list(iter_documents(path)) == cities
+        os.remove(path)
+    os.rmdir(directory)
+
+    def unused(pipeline):
+        raise AssertionError("queried the database")
+    assert list(main(lambda: city, unused, ['city.py', '--local'])) == list(aggregate(docs, city))
+    assert list(main(lambda: city, lambda pipeline: ['db'], ['city.py'])) == ['db']
+
+
+if __name__ == '__main__':
+    test()
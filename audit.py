@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import sys
-import codecs
 """
 Your task in this exercise has two steps:
 
@@ -12,13 +11,17 @@ not a generalized solution, since that may and will depend on the particular are
 The function takes a string with street name as an argument and should return the fixed name
 We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+import normalizer
+import osmstream
 
 OSMFILE = "./munich_germany_k10.osm"
 
+# street names collected by StreetAuditor before they are audited as one batch
+BATCH_SIZE = 10000
+
 street_type_re = re.compile(
     ur'(\s|-)?(straße|weg|ring|platz|allee|bogen|gasse|brücke|hof|berg|eck)$',
     re.IGNORECASE | re.UNICODE)
@@ -41,21 +44,50 @@ expected = [
     "markt",
     "feld"]
 
-# UPDATE THIS VARIABLE
-mapping = {
-    "St": "Street",
-    "Str.": "Straße",
-    "Ave": "Avenue",
-    "Rd.": "Road",
-    "St.": "Street"}
+# UPDATE THIS VARIABLE, it is the "mapping" of normalizer.CLEANING_RULES
+mapping = normalizer.default_normalizer().mapping
+
+
+# drop the cached results of a matcher once it holds this many names
+MATCHER_CACHE_SIZE = 1000000
+
+
+def street_matcher(type_re, expected_words):
+    ''' Compile the street type regex and the expected words into a single alternation.
+    Args:
+        type_re - compiled street type regex, e.g. street_type_re
+        expected_words list - words which let a street name pass the audit, e.g. expected
+    Return:
+        unexpected(street_name) -> bool, the same as `type_re.search(name) is None and isNotExpected(name)`.
+        Street names repeat across many nodes and ways, so each distinct name is matched once and the result cached.
+    '''
+    combined = re.compile(u'(?:{0})|{1}'.format(type_re.pattern, u'|'.join(re.escape(e) for e in expected_words)),
+                          re.IGNORECASE | re.UNICODE)
+    cache = {}
+
+    def unexpected(street_name):
+        result = cache.get(street_name)
+        if result is None:
+            if len(cache) >= MATCHER_CACHE_SIZE:
+                cache.clear()
+            result = cache[street_name] = combined.search(street_name) is None
+        return result
+
+    unexpected.cache = cache
+    return unexpected
 
 
 def audit_street_type(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m is None and isNotExpected(street_name):
+    if is_unexpected(street_name):
         street_types[street_name.rsplit(' ', 1)[-1]].add(street_name)
 
 
+def audit_street_names(street_types, street_names):
+    ''' Audit a batch of street names, every distinct name once. '''
+    for street_name in set(street_names):
+        audit_street_type(street_types, street_name)
+
+
 def isNotExpected(streetName):
     for e in expected:
         if e.lower() in streetName.lower():
@@ -67,26 +99,71 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 
+is_unexpected = street_matcher(street_type_re, expected)
+
+
+class StreetAuditor(osmstream.Visitor):
+    ''' Unexpected street names of nodes and ways by street type, see audit_street_type. '''
+    tags = ("node", "way")
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+        self._names = []
+
+    def visit(self, elem):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                self._names.append(tag.attrib['v'])
+        if len(self._names) >= BATCH_SIZE:
+            audit_street_names(self.street_types, self._names)
+            self._names = []
+
+    def result(self):
+        audit_street_names(self.street_types, self._names)
+        self._names = []
+        return self.street_types
+
+
 def audit(osmfile):
-    osm_file = codecs.open(osmfile, "r", "utf-8")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-
-    osm_file.close()
-    return street_types
-
-
-def update_name(name, mapping):
-    # YOUR CODE HERE
-    str_type = name.rsplit(' ', 1)
-    if len(str_type) != 2:
-        return name
-    else:
-        return str_type[0] + ' ' + mapping[str_type[1]]
+    return osmstream.run_visitors(osmfile, [StreetAuditor()])[0]
+
+
+def update_name(name, mapping=None):
+    # mapping None: the memoized mapping and rules of normalizer.CLEANING_RULES
+    # unknown suffixes are kept as they are
+    if mapping is None:
+        return normalizer.default_normalizer().normalize(name)
+    return normalizer.apply_mapping(name, mapping)
+
+
+def benchmark(osmfile=OSMFILE):
+    ''' Audit all street names of osmfile one occurrence at a time with the original regex and word loop, and
+    batched with the compiled matcher. Print the time of both and unique names per second.
+    '''
+    import time
+
+    names = []
+    for elem in osmstream.iter_elements(osmfile, tags=("node", "way")):
+        names.extend(tag.attrib['v'] for tag in elem.iter("tag") if is_street_name(tag))
+
+    started = time.time()
+    per_name = defaultdict(set)
+    for street_name in names:
+        if street_type_re.search(street_name) is None and isNotExpected(street_name):
+            per_name[street_name.rsplit(' ', 1)[-1]].add(street_name)
+    per_name_time = time.time() - started
+
+    is_unexpected.cache.clear()
+    started = time.time()
+    batched = defaultdict(set)
+    audit_street_names(batched, names)
+    batched_time = time.time() - started
+
+    unique = len(set(names))
+    print "{0} street names, {1} unique".format(len(names), unique)
+    print "per name: {0:.3f}s, {1:.0f} unique names/s".format(per_name_time, unique / per_name_time)
+    print "batched:  {0:.3f}s, {1:.0f} unique names/s, {2:.1f}x".format(batched_time, unique / batched_time, per_name_time / batched_time)
+    print "same result: {0}".format(per_name == batched)
 
 
 def test():
@@ -23,6 +23,7 @@ Please note that the dataset you are using here is a smaller version of the twit
 examples in this lesson. If you attempt some of the same queries that we looked at in the lesson 
 examples, your results will be different.
 """
+import aggregation
 
 def get_db(db_name):
     from pymongo import MongoClient
@@ -56,9 +57,8 @@ def aggregate(db, pipeline):
     return result
 
 if __name__ == '__main__':
-    db = get_db('examples')
-    pipeline = make_pipeline()
-    result = aggregate(db, pipeline)
+    # --local [file]: run the pipeline in process over a file of city documents
+    result = aggregation.main(make_pipeline, lambda pipeline: aggregate(get_db('examples'), pipeline))
     import pprint
     for r in result:
        pprint.pprint(r)
@@ -0,0 +1,203 @@
+'''
+Disk-backed index of way and relation bounding boxes, for resolving relation members.
+
+osm files list nodes, then ways, then relations. A relation is resolved from the
+node locations (nodestore / nodeindex) and the bounding boxes of the ways and
+relations listed before it, which are kept in a local SQLite file instead of
+memory, so the ways of a country do not have to fit in RAM.
+
+- the serial routine fills the index while it reads the ways, also those a change
+  index skips as unchanged, and relations look them up later in the same pass
+- parallel runs first build it in a pass over the ways and relations (see
+  build), then every worker opens it read only
+
+A relation member that is itself a relation listed later in the file is not
+resolved.
+'''
+import os
+import sqlite3
+
+import nodestore
+
+BATCH_SIZE = 10000
+
+# the index of a nodeindex file is kept next to it, with this suffix
+SUFFIX = '.bbox'
+
+
+class BBoxIndex(object):
+    ''' Args:
+        path str - sqlite file, created on first use
+        read_only bool - lookups only, the index is complete (see is_fresh)
+    '''
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._conn = sqlite3.connect(path)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS bboxes (
+                type TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                min_lat REAL, min_lon REAL, max_lat REAL, max_lon REAL,
+                PRIMARY KEY (type, id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (complete INTEGER NOT NULL);
+        ''')
+        if not read_only:
+            # rebuilt from the osm file if the run dies
+            self._conn.execute('PRAGMA journal_mode = OFF')
+            self._conn.execute('PRAGMA synchronous = OFF')
+            self._conn.execute('DELETE FROM meta')
+        self._pending = {}
+
+    def add(self, el_type, el_id, bbox):
+        ''' Record the [min_lat, min_lon, max_lat, max_lon] of a way or relation. '''
+        self._pending[(el_type, int(el_id))] = bbox
+        if len(self._pending) >= BATCH_SIZE:
+            self._flush()
+
+    def get(self, el_type, el_id):
+        ''' The bbox of a way or relation, None if it is not in the index. '''
+        key = (el_type, int(el_id))
+        if key in self._pending:
+            return self._pending[key]
+        row = self._conn.execute('SELECT min_lat, min_lon, max_lat, max_lon FROM bboxes WHERE type = ? AND id = ?', key).fetchone()
+        return list(row) if row else None
+
+    def close(self):
+        ''' Write the pending entries and mark a writable index complete. '''
+        if not self.read_only:
+            self._flush()
+            self._conn.execute('INSERT INTO meta (complete) VALUES (1)')
+            self._conn.commit()
+        self._conn.close()
+
+    def _flush(self):
+        if self._pending:
+            self._conn.executemany('INSERT OR REPLACE INTO bboxes VALUES (?, ?, ?, ?, ?, ?)',
+                                   [key + tuple(bbox) for key, bbox in self._pending.iteritems()])
+            self._pending = {}
+
+
+def merge(bboxes):
+    ''' Smallest bbox around all given ones, None values are skipped. None if there is nothing to merge. '''
+    bboxes = [b for b in bboxes if b]
+    if not bboxes:
+        return None
+    return [min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+
+
+def relation_bbox(members, nodes, bboxes):
+    ''' bbox of a relation.
+    Args:
+        members list - [{"type": .., "ref": .., ...}] as shaped by osmData.shape
+        nodes - node locations, see nodestore.resolve
+        bboxes BBoxIndex - bboxes of the ways and relations seen so far
+    '''
+    parts = []
+    for member in members:
+        if member['type'] == 'node':
+            location = nodes.get(member['ref'])
+            if location:
+                parts.append([location[0], location[1], location[0], location[1]])
+        else:
+            parts.append(bboxes.get(member['type'], member['ref']))
+    return merge(parts)
+
+
+def is_fresh(path, osmfile):
+    ''' True if path is a complete index written after osmfile was last modified. '''
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(osmfile):
+        return False
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT complete FROM meta').fetchone() == (1,)
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+def build(osmfile, path, nodes):
+    ''' Index the bboxes of the ways and relations of osmfile into path, unless a fresh index exists already. '''
+    import osmstream
+
+    if is_fresh(path, osmfile):
+        return
+    if os.path.exists(path):
+        os.remove(path)
+
+    index = BBoxIndex(path)
+    for elem in osmstream.iter_elements(osmfile, tags=('way', 'relation')):
+        add_element(index, elem, nodes)
+    index.close()
+
+
+def add_element(index, elem, nodes):
+    ''' Add the bbox of a way or relation element to index, if it has one. '''
+    if elem.tag == 'way':
+        bbox = nodestore.resolve(nodes, [nd.attrib['ref'] for nd in elem.iter('nd')])[1]
+    else:
+        members = [{'type': m.attrib['type'], 'ref': m.attrib['ref']} for m in elem.iter('member')]
+        bbox = relation_bbox(members, nodes, index)
+    if bbox:
+        index.add(elem.tag, elem.attrib['id'], bbox)
+
+
+_open_indexes = {}
+
+
+def shared(path):
+    ''' Read only index of path, opened once per process (e.g. by each pool worker). '''
+    # a rebuilt file is opened again
+    key = (path, os.path.getmtime(path))
+    if key not in _open_indexes:
+        _open_indexes[key] = BBoxIndex(path, read_only=True)
+    return _open_indexes[key]
+
+
+def test():
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.bbox')
+    nodes = nodestore.NodeStore()
+    nodes.add(1, 48.0, 11.0)
+    nodes.add(2, 48.5, 11.2)
+
+    index = BBoxIndex(path)
+    index.add('way', 10, [48.1, 11.1, 48.2, 11.3])
+    assert index.get('way', '10') == [48.1, 11.1, 48.2, 11.3]
+    members = [{'type': 'node', 'ref': '1'}, {'type': 'way', 'ref': '10'}, {'type': 'way', 'ref': '11'}]
+    assert relation_bbox(members, nodes, index) == [48.0, 11.0, 48.2, 11.3]
+    assert relation_bbox([{'type': 'relation', 'ref': '5'}], nodes, index) is None
+    index.close()
+
+    assert is_fresh(path, 'example.osm')
+    index = shared(path)
+    assert index.get('way', 10) == [48.1, 11.1, 48.2, 11.3] and index.get('way', 2) is None
+    os.remove(path)
+
+    # a changed relation of unchanged ways is resolved from the bboxes of those ways
+    import json
+    import osmData
+
+    directory = tempfile.mkdtemp()
+    osmfile = os.path.join(directory, 'changed.osm')
+    for version in (1, 2):
+        with open(osmfile, 'w') as f:
+            f.write('<osm>\n<node id="1" lat="48.0" lon="11.0" version="1"/>\n<node id="2" lat="48.5" lon="11.2" version="1"/>\n'
+                    '<way id="10" version="1"><nd ref="1"/><nd ref="2"/></way>\n'
+                    '<relation id="20" version="{0}"><member type="way" ref="10" role=""/></relation>\n</osm>\n'.format(version))
+        osmData.routine(osmfile, index=osmfile + '.index', geometry=True)
+        with open(osmfile + '.json') as f:
+            docs = [json.loads(line) for line in f]
+    assert [doc['type'] for doc in docs] == ['relation'] and docs[0]['bbox'] == [48.0, 11.0, 48.5, 11.2]
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    test()
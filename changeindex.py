@@ -0,0 +1,141 @@
+'''
+Persistent index of the element versions seen by the last import.
+
+Each refresh of an extract mostly contains elements that did not change since
+the previous import. ChangeIndex remembers (type, id) -> version/changeset of
+every element, so an import can skip unchanged elements, tell new ones from
+modified ones, and list the elements that disappeared (tombstones).
+
+The index is a local SQLite file. A whole run is one transaction: if the import
+dies, the index stays at the state of the last completed import.
+
+Usage:
+    index = ChangeIndex("munich.index")
+    for elem in osmstream.iter_elements(osmfile):
+        action = index.check(elem)      # None, CREATE or MODIFY
+        ...
+    for el_type, el_id in index.removed():
+        ...
+    index.close()
+'''
+import sqlite3
+
+CREATE = 'create'
+MODIFY = 'modify'
+DELETE = 'delete'
+
+BATCH_SIZE = 10000
+
+
+class ChangeIndex(object):
+    ''' Args:
+        path str - sqlite file of the index, created on first use
+    '''
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS elements (
+                type TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                stamp TEXT NOT NULL,
+                generation INTEGER NOT NULL,
+                PRIMARY KEY (type, id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (generation INTEGER NOT NULL);
+        ''')
+        row = self._conn.execute('SELECT generation FROM meta').fetchone()
+        self.generation = (row[0] if row else 0) + 1
+
+        self._seen = []
+        self._upserts = []
+        self.stats = {CREATE: 0, MODIFY: 0, DELETE: 0, 'unchanged': 0}
+
+    def check(self, elem):
+        ''' Record the element as seen in this run and classify it.
+        Args:
+            elem xml.etree.cElementTree.Element - top level node, way or relation
+        Return:
+            CREATE if the element is new, MODIFY if its version or changeset changed, None if unchanged.
+        '''
+        el_type = elem.tag
+        el_id = int(elem.get('id'))
+        stamp = '{0}/{1}'.format(elem.get('version'), elem.get('changeset'))
+
+        row = self._conn.execute('SELECT stamp FROM elements WHERE type = ? AND id = ?', (el_type, el_id)).fetchone()
+        if row is not None and row[0] == stamp:
+            self._seen.append((self.generation, el_type, el_id))
+            if len(self._seen) >= BATCH_SIZE:
+                self._flush()
+            self.stats['unchanged'] += 1
+            return None
+
+        self._upserts.append((el_type, el_id, stamp, self.generation))
+        if len(self._upserts) >= BATCH_SIZE:
+            self._flush()
+        action = CREATE if row is None else MODIFY
+        self.stats[action] += 1
+        return action
+
+    def removed(self):
+        ''' Yield (type, id) of the elements of the previous import which were not seen in this run, and drop them
+        from the index. Call it once, after all elements went through check.
+        '''
+        self._flush()
+        cursor = self._conn.execute('SELECT type, id FROM elements WHERE generation < ? ORDER BY type, id', (self.generation,))
+        for el_type, el_id in cursor:
+            self.stats[DELETE] += 1
+            yield el_type, str(el_id)
+        self._conn.execute('DELETE FROM elements WHERE generation < ?', (self.generation,))
+
+    def close(self):
+        ''' Commit the run. Elements not seen are only dropped by removed(), until then they stay in the index. '''
+        self._flush()
+        self._conn.execute('DELETE FROM meta')
+        self._conn.execute('INSERT INTO meta (generation) VALUES (?)', (self.generation,))
+        self._conn.commit()
+        self._conn.close()
+
+    def _flush(self):
+        if self._seen:
+            self._conn.executemany('UPDATE elements SET generation = ? WHERE type = ? AND id = ?', self._seen)
+            self._seen = []
+        if self._upserts:
+            self._conn.executemany('INSERT OR REPLACE INTO elements (type, id, stamp, generation) VALUES (?, ?, ?, ?)', self._upserts)
+            self._upserts = []
+
+
+def tombstone(el_type, el_id):
+    ''' Document standing for an element removed since the previous import. '''
+    return {'id': el_id, 'type': el_type, 'deleted': True}
+
+
+def test():
+    import os
+    import tempfile
+    import xml.etree.cElementTree as ET
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.index')
+
+    index = ChangeIndex(path)
+    elems = [ET.Element('node', id=str(i), version='1', changeset='1') for i in range(5)]
+    assert [index.check(e) for e in elems] == [CREATE] * 5
+    assert list(index.removed()) == []
+    index.close()
+
+    index = ChangeIndex(path)
+    elems[1].set('version', '2')
+    assert [index.check(e) for e in elems[:4]] == [None, MODIFY, None, None]
+    assert list(index.removed()) == [('node', '4')]
+    index.close()
+
+    index = ChangeIndex(path)
+    assert [index.check(e) for e in elems[:4]] == [None] * 4
+    assert list(index.removed()) == []
+    index.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,97 @@
+'''
+Checkpoints of long running passes over an osm file.
+
+A pass that processes the input chunk by chunk (see osmstream.chunk_offsets)
+saves after every chunk:
+- the input byte offset where the next chunk starts, always a top level element boundary
+- the id of the last element processed
+- the positions of its outputs (bytes written to a json file, documents written to a collection, ...)
+- any result accumulated so far, e.g. the unexpected street types
+
+After a crash the pass is restarted with resume=True: the input is read again
+from the saved offset and the outputs are rolled back to the saved positions,
+so nothing is processed or written twice.
+'''
+import json
+import os
+
+import osmstream
+
+
+class Checkpoint(object):
+    ''' Json checkpoint file of one pass over osm_path.
+    Args:
+        path str - checkpoint file, e.g. "munich.osm.json.checkpoint"
+        osm_path str - input file the offsets refer to
+    '''
+
+    def __init__(self, path, osm_path):
+        self.path = path
+        self.osm_path = osm_path
+
+    def load(self):
+        ''' The saved state, None if there is no checkpoint. Raise ValueError if the input changed since. '''
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'rb') as f:
+            state = json.load(f)
+
+        if state['input_size'] != os.path.getsize(self.osm_path):
+            raise ValueError("{0} changed since checkpoint {1} was written".format(self.osm_path, self.path))
+
+        # the offset was written at an element boundary, re-align in case it points anywhere else
+        with open(self.osm_path, 'rb') as f:
+            end = osmstream.document_end(f)
+            boundary = osmstream.find_boundary(f, state['offset'])
+        state['offset'] = end if boundary is None else min(boundary, end)
+        return state
+
+    def save(self, offset, last_id, outputs, result=None):
+        ''' Atomically replace the checkpoint.
+        Args:
+            offset int - input byte offset of the next element to process
+            last_id str - id of the last processed element
+            outputs dict - output name -> position
+            result - json serializable partial result
+        '''
+        state = {
+            'input': self.osm_path,
+            'input_size': os.path.getsize(self.osm_path),
+            'offset': offset,
+            'last_id': last_id,
+            'outputs': outputs,
+            'result': result,
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        ''' Remove the checkpoint once the pass completed. '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def test():
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.checkpoint')
+    ckpt = Checkpoint(path, 'example.osm')
+    assert ckpt.load() is None
+
+    chunks = osmstream.chunk_offsets('example.osm', 512)
+    ckpt.save(chunks[1][0], '261114299', {'example.osm.json': 1024}, {'St': ['Baker St']})
+    state = ckpt.load()
+    assert state['offset'] == chunks[1][0]
+    assert state['outputs'] == {'example.osm.json': 1024}
+
+    ckpt.clear()
+    assert ckpt.load() is None
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,405 @@
+'''
+Columnar store of the shaped documents, for repeated analytics without
+rescanning the json file.
+
+osmData.routine(..., columns=path) writes the fields below of every document
+into a directory, one file per field:
+
+    <field>.bin          little endian array, one value per document in output order
+    <field>.values.json  dictionary of a string field, the .bin file holds int32 codes into it
+    meta.json            number of documents and kind of every field, written last
+
+The shaped documents keep the address but not the amenity, cuisine and name
+tags, routine fills those columns from the tags of the elements. A store built
+from json files (see build) has them empty.
+
+Missing values are -1 for string codes, the smallest int64 for int fields (ids
+may be negative) and NaN for float fields.
+Writing only needs the stdlib, queries (Columns) need numpy and run vectorized
+over memory-mapped columns:
+
+    store = Columns("munich.osm.columns")
+    store.count_by('created.user', top=3)
+    store.count_by('cuisine', where={'amenity': 'restaurant'}, top=10)
+    store.count_where({'pos.lat': 0.0, 'pos.lon': 0.0})
+'''
+import calendar
+import heapq
+import json
+import math
+import os
+from array import array
+
+STR = 'str'
+INT = 'int'
+FLOAT = 'float'
+
+# (field, kind) in file order, nested fields by their dotted path
+FIELDS = [
+    ('type', STR),
+    ('id', INT),
+    ('created.user', STR),
+    ('created.timestamp', INT),
+    ('pos.lat', FLOAT),
+    ('pos.lon', FLOAT),
+    ('amenity', STR),
+    ('cuisine', STR),
+    ('name', STR),
+    ('address.street', STR),
+    ('address.postcode', STR),
+    ('address.city', STR),
+]
+
+# array type codes and numpy dtypes of the kinds; 'l' is 64 bit on the platforms this runs on, see nodestore.py
+TYPE_CODES = {STR: 'i', INT: 'l', FLOAT: 'd'}
+DTYPES = {STR: '<i4', INT: '<i8', FLOAT: '<f8'}
+MISSING = {STR: -1, INT: -(1 << 63), FLOAT: float('nan')}
+
+# rows buffered before they are appended to the column files
+BATCH_SIZE = 65536
+
+META = 'meta.json'
+
+
+def timestamp(value):
+    ''' Seconds since the epoch of an osm timestamp such as "2013-08-03T16:43:42Z". '''
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+def row(doc, tags=None):
+    ''' Values of FIELDS of a shaped document, None for missing ones.
+    Args:
+        tags dict - tags of the osm element, for the amenity, cuisine and name the shaped document does not keep
+    '''
+    tags = tags or {}
+    created = doc.get('created') or {}
+    pos = doc.get('pos') or (None, None)
+    address = doc.get('address') or {}
+    ts = created.get('timestamp')
+    return (doc.get('type'), int(doc['id']) if 'id' in doc else None, created.get('user'), timestamp(ts) if ts else None,
+            pos[0], pos[1], doc.get('amenity', tags.get('amenity')), doc.get('cuisine', tags.get('cuisine')), doc.get('name', tags.get('name')),
+            address.get('street'), address.get('postcode'), address.get('city'))
+
+
+class Rows(object):
+    ''' Rows of documents collected by a worker of the parallel routine, added to a ColumnWriter by the parent. '''
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, doc, tags=None):
+        self.rows.append(row(doc, tags))
+
+
+class ColumnWriter(object):
+    ''' Writes the columns of the documents added to it into a directory, replacing a previous store.
+    Use it as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, META)):
+            os.remove(os.path.join(path, META))
+
+        self._kinds = [kind for _, kind in FIELDS]
+        self._files = [open(os.path.join(path, name + '.bin'), 'wb') for name, _ in FIELDS]
+        self._buffers = [array(TYPE_CODES[kind]) for kind in self._kinds]
+        # value -> code of the string fields, None for the others
+        self._codes = [{} if kind == STR else None for kind in self._kinds]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, doc, tags=None):
+        self.add_row(row(doc, tags))
+
+    def add_rows(self, rows):
+        for values in rows:
+            self.add_row(values)
+
+    def add_row(self, values):
+        for value, kind, buf, codes in zip(values, self._kinds, self._buffers, self._codes):
+            if value is None:
+                buf.append(MISSING[kind])
+            elif codes is not None:
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                buf.append(code)
+            else:
+                buf.append(value)
+        self.count += 1
+        if len(self._buffers[0]) >= BATCH_SIZE:
+            self._flush()
+
+    def close(self):
+        ''' Write the remaining rows, the dictionaries and the meta file. '''
+        if self._files is None:
+            return
+        self._flush()
+        for f in self._files:
+            f.close()
+        self._files = None
+
+        for (name, _), codes in zip(FIELDS, self._codes):
+            if codes is not None:
+                values = sorted(codes, key=codes.get)
+                with open(os.path.join(self.path, name + '.values.json'), 'wb') as f:
+                    json.dump(values, f)
+        with open(os.path.join(self.path, META), 'wb') as f:
+            json.dump({'count': self.count, 'fields': FIELDS}, f)
+
+    def _flush(self):
+        for f, buf, kind in zip(self._files, self._buffers, self._kinds):
+            buf.tofile(f)
+        self._buffers = [array(TYPE_CODES[kind]) for kind in self._kinds]
+
+
+class Columns(object):
+    ''' Read only, vectorized queries over a store written by ColumnWriter.
+
+    Conditions (where) are a dict field -> value, all of which must hold: a value, None for a missing one, or a
+    list of values any of which matches. A numpy bool array of one entry per document works as well.
+    '''
+
+    def __init__(self, path):
+        import numpy
+        self._np = numpy
+        self.path = path
+        meta_path = os.path.join(path, META)
+        if not os.path.exists(meta_path):
+            raise ValueError("{0} is not a complete column store".format(path))
+        with open(meta_path, 'rb') as f:
+            meta = json.load(f)
+        self.count = meta['count']
+        self.kinds = dict((name, kind) for name, kind in meta['fields'])
+        self._columns = {}
+        self._values = {}
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        ''' numpy array of a field, codes into values(name) for string fields. '''
+        if name not in self._columns:
+            dtype = DTYPES[self.kinds[name]]
+            if self.count:
+                self._columns[name] = self._np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r')
+            else:
+                self._columns[name] = self._np.zeros(0, dtype=dtype)
+        return self._columns[name]
+
+    def values(self, name):
+        ''' Dictionary of a string field, values by code. '''
+        if name not in self._values:
+            with open(os.path.join(self.path, name + '.values.json'), 'rb') as f:
+                self._values[name] = json.load(f)
+        return self._values[name]
+
+    def missing(self, name):
+        ''' bool array, True for the documents without the field. '''
+        col = self.column(name)
+        if self.kinds[name] == FLOAT:
+            return self._np.isnan(col)
+        return col == MISSING[self.kinds[name]]
+
+    def exists(self, name):
+        return ~self.missing(name)
+
+    def mask(self, where=None):
+        ''' bool array of the documents matching the conditions, see the class doc. '''
+        np = self._np
+        if where is None:
+            return np.ones(self.count, dtype=bool)
+        if isinstance(where, np.ndarray):
+            return where
+        result = np.ones(self.count, dtype=bool)
+        for name, expected in where.iteritems():
+            if expected is None:
+                result &= self.missing(name)
+                continue
+            options = expected if isinstance(expected, (list, tuple, set)) else [expected]
+            if self.kinds[name] == STR:
+                codes = dict((value, code) for code, value in enumerate(self.values(name)))
+                options = [codes[o] for o in options if o in codes]
+            result &= np.in1d(self.column(name), options)
+        return result
+
+    def count_where(self, where=None):
+        ''' Number of documents matching the conditions. '''
+        return int(self.mask(where).sum())
+
+    def distinct(self, name, where=None):
+        ''' Number of distinct values of a field, missing values are not counted. '''
+        np = self._np
+        col = self.column(name)[self.mask(where) & self.exists(name)]
+        if self.kinds[name] == STR:
+            return int(np.count_nonzero(np.bincount(col, minlength=len(self.values(name)))))
+        return len(np.unique(col))
+
+    def count_by(self, fields, where=None, top=None):
+        ''' Number of documents per value of one field or combination of values of several fields, like a $group
+        with {"$sum": 1}. Missing values are grouped as None.
+        Args:
+            fields str or list - field name(s)
+            where - conditions, see the class doc
+            top int - only the top most frequent groups
+        Return:
+            [(value, count)] by descending count, ties by value; value is a tuple for several fields
+        '''
+        np = self._np
+        single = isinstance(fields, basestring)
+        names = [fields] if single else list(fields)
+        selected = self.mask(where) if where is not None else None
+
+        codes = []
+        decoders = []
+        for name in names:
+            col = self.column(name)
+            if selected is not None:
+                col = col[selected]
+            if self.kinds[name] == STR:
+                # missing -1 -> 0
+                codes.append(col + 1)
+                decoders.append([None] + self.values(name))
+            else:
+                uniques, inverse = np.unique(col, return_inverse=True)
+                codes.append(inverse)
+                missing = MISSING[self.kinds[name]]
+                decoders.append([None if (isinstance(v, float) and math.isnan(v)) or v == missing else v for v in uniques.tolist()])
+
+        sizes = tuple(len(d) for d in decoders)
+        if not len(codes[0]):
+            return []
+        key = np.ravel_multi_index(codes, sizes) if len(codes) > 1 else codes[0]
+        if np.prod(sizes, dtype=float) <= 4 * len(key) + 1024:
+            counts = np.bincount(key, minlength=int(np.prod(sizes)))
+            keys = np.flatnonzero(counts)
+            counts = counts[keys]
+        else:
+            keys, counts = np.unique(key, return_counts=True)
+
+        parts = np.unravel_index(keys, sizes) if len(codes) > 1 else [keys]
+        groups = zip(*[[decoder[c] for c in part.tolist()] for decoder, part in zip(decoders, parts)])
+        counted = [((group[0] if single else group), count) for group, count in zip(groups, counts.tolist())]
+        order = lambda (value, count): (-count, value)
+        return heapq.nsmallest(top, counted, key=order) if top else sorted(counted, key=order)
+
+
+def build(json_paths, path):
+    ''' Columns of the documents of existing json file(s), e.g. of a routine run without columns.
+    The json documents hold no amenity, cuisine or name, those columns are empty; use routine(columns=...) for them.
+    '''
+    import aggregation
+
+    with ColumnWriter(path) as writer:
+        for json_path in ([json_paths] if isinstance(json_paths, basestring) else json_paths):
+            for doc in aggregation.iter_documents(json_path):
+                writer.add(doc)
+
+
+def benchmark(osmfile, path='/tmp/benchmark.columns', repeat=3):
+    ''' Time the notebook queries on the columns routine writes for osmfile against aggregation pipelines over the same
+    fields of its elements, held in memory. The json documents hold no amenity or cuisine, routine reads them from tags.
+    '''
+    import time
+
+    import aggregation
+    import osmData
+    import osmstream
+
+    started = time.time()
+    osmData.routine(osmfile, columns=path)
+    print "routine with columns {0} in {1:.2f}s".format(path, time.time() - started)
+    store = Columns(path)
+
+    docs = []
+    for elem in osmstream.iter_elements(osmfile, tags=('node', 'way', 'relation')):
+        doc = dict((tag.attrib['k'], tag.attrib['v']) for tag in elem.iter('tag') if tag.attrib['k'] in ('amenity', 'cuisine'))
+        doc['created'] = {'user': elem.attrib.get('user')}
+        docs.append(doc)
+
+    queries = [
+        ('top users',
+         lambda: store.count_by('created.user', top=3),
+         [{'$group': {'_id': '$created.user', 'count': {'$sum': 1}}}, {'$sort': {'count': -1}}, {'$limit': 3}]),
+        ('top amenities',
+         lambda: store.count_by('amenity', where=store.exists('amenity'), top=5),
+         [{'$match': {'amenity': {'$exists': 1}}}, {'$group': {'_id': '$amenity', 'count': {'$sum': 1}}},
+          {'$sort': {'count': -1}}, {'$limit': 5}]),
+        ('cuisines of restaurants',
+         lambda: store.count_by('cuisine', where=store.mask({'amenity': 'restaurant'}) & store.exists('cuisine'), top=10),
+         [{'$match': {'amenity': 'restaurant', 'cuisine': {'$exists': 1}}}, {'$group': {'_id': '$cuisine', 'count': {'$sum': 1}}},
+          {'$sort': {'count': -1}}, {'$limit': 10}]),
+    ]
+    for name, query, pipeline in queries:
+        started = time.time()
+        for _ in xrange(repeat):
+            result = query()
+        columns_time = (time.time() - started) / repeat
+        started = time.time()
+        expected = [(doc['_id'], doc['count']) for doc in aggregation.aggregate(docs, pipeline)]
+        scan_time = time.time() - started
+        print "{0}: columns {1:.1f}ms, scan {2:.0f}ms, {3} groups, same counts: {4}".format(
+            name, columns_time * 1000, scan_time * 1000, len(result), [c for _, c in result] == [c for _, c in expected])
+    print "pos [0, 0]: {0} documents".format(store.count_where({'pos.lat': 0.0, 'pos.lon': 0.0}))
+
+
+def test():
+    import shutil
+    import tempfile
+
+    docs = [
+        {'id': '1', 'type': 'node', 'created': {'user': 'a', 'timestamp': '2013-08-03T16:43:42Z'}, 'pos': [48.1, 11.5],
+         'amenity': 'restaurant', 'cuisine': 'italian'},
+        {'id': '2', 'type': 'node', 'created': {'user': 'b', 'timestamp': '2014-01-01T00:00:00Z'}, 'pos': [48.2, 11.6],
+         'amenity': 'restaurant', 'cuisine': 'italian', 'address': {'postcode': '80331'}},
+        {'id': '3', 'type': 'way', 'created': {'user': 'a', 'timestamp': '2014-01-01T00:00:00Z'}, 'pos': [0.0, 0.0],
+         'amenity': 'bench'},
+        {'id': '4', 'type': 'node', 'created': {'user': u'M\xfcller'}, 'pos': [48.3, 11.7],
+         'amenity': 'restaurant', 'address': {'postcode': '80331'}},
+        {'id': '-1', 'type': 'node', 'created': {'user': 'a', 'timestamp': '2014-01-01T00:00:00Z'}, 'pos': [48.4, 11.8]},
+    ]
+    path = os.path.join(tempfile.mkdtemp(), 'example.columns')
+    with ColumnWriter(path) as writer:
+        writer.add_rows([row(doc) for doc in docs[:2]])
+        for doc in docs[2:]:
+            writer.add(doc)
+
+    store = Columns(path)
+    assert len(store) == 5
+    assert store.count_by('created.user') == [('a', 3), (u'M\xfcller', 1), ('b', 1)]
+    assert store.count_by('cuisine', where={'amenity': 'restaurant'}, top=1) == [('italian', 2)]
+    assert store.count_by('cuisine', where={'amenity': 'restaurant'}) == [('italian', 2), (None, 1)]
+    assert store.count_by(['type', 'address.postcode']) == [(('node', None), 2), (('node', '80331'), 2), (('way', None), 1)]
+    assert store.count_by('id', where={'type': 'way'}) == [(3, 1)]
+    assert store.count_where({'pos.lat': 0.0, 'pos.lon': 0.0}) == 1
+    assert store.count_where({'amenity': ['bench', 'fountain']}) == 1
+    assert store.count_where({'cuisine': None}) == 3
+    assert store.distinct('created.user') == 3 and store.distinct('created.timestamp') == 2
+    assert store.column('created.timestamp')[0] == timestamp('2013-08-03T16:43:42Z') == 1375548222
+    assert store.count_by('amenity', where={'amenity': 'fountain'}) == []
+    # a negative id is a value, not a missing one
+    assert store.count_by('id', where={'pos.lat': 48.4}) == [(-1, 1)] and store.count_where({'id': None}) == 0
+    assert store.count_by('created.timestamp', where={'id': 4}) == [(None, 1)]
+
+    # amenity, cuisine and name come from the element tags, routine runs on a copy of the input in the temp directory
+    import osmData
+    osmfile = os.path.join(os.path.dirname(path), 'example.osm')
+    shutil.copy('example.osm', osmfile)
+    osmData.routine(osmfile, columns=path)
+    store = Columns(path)
+    assert store.count_by('amenity', where=store.exists('amenity')) == [('fast_food', 1)]
+    assert store.count_by('name', where={'cuisine': 'sausage'}) == [("Shelly's Tasty Freeze", 1)]
+    shutil.rmtree(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    test()
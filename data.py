@@ -120,18 +120,46 @@ The final return value for a "way" element should look something like:
       {'id': 209809850, 'key': 'building_id', 'type': 'chicago', 'value': '366409'}
    ]
 }
+
+# If the element top level tag is "relation":
+The dictionary should have the format {"relation": ..., "relation_tags": ..., "relation_members": ...}
+"relation" holds the same attributes as "way", "relation_tags" follows the rules of "node_tags", and
+"relation_members" holds one dictionary per member child tag with the fields:
+- id: the top level element (relation) id
+- member_type: the type attribute of the member tag (node, way or relation)
+- member_id: the ref attribute value of the member tag
+- role: the role attribute value of the member tag, may be empty
+- position: the index starting at 0 of the member tag
 """
 
 import csv
 import codecs
 import pprint
 import re
-import xml.etree.cElementTree as ET
-import cerberus
+import sys
+import fastvalidator
+import mongowriter
+import osmfilter
+import osmstream
 import schema
+import sqlexport
+from changeindex import ChangeIndex, CREATE, MODIFY
+from checkpoint import Checkpoint
 
 OSM_PATH = "./munich_germany_k10.osm"
 
+NODES_PATH = "nodes.csv"
+NODE_TAGS_PATH = "nodes_tags.csv"
+WAYS_PATH = "ways.csv"
+WAY_NODES_PATH = "ways_nodes.csv"
+WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+
+# bytes of osm input processed between two checkpoints
+CHUNK_SIZE = 16 * 1024 * 1024
+
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
@@ -154,20 +182,83 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+
+"""
+shape_rows shapes like shape_element, but emits the rows of the tag, way node
+and relation member tables as plain tuples in the column order of their csv
+files, much cheaper to build and to hold than a dict per row; the csv and
+sqlite export write them as they are. as_document turns them into the dicts
+of shape_element.
+"""
+RECORD_FIELDS = {
+    'node_tags': NODE_TAGS_FIELDS,
+    'way_tags': WAY_TAGS_FIELDS,
+    'way_nodes': WAY_NODES_FIELDS,
+    'relation_tags': RELATION_TAGS_FIELDS,
+    'relation_members': RELATION_MEMBERS_FIELDS,
+}
+
+# distinct tag keys split by split_key, there are a few thousand; the cache starts over when full
+KEY_CACHE = 1 << 16
+_split_keys = {}
 
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """ Clean and shape node or way XML element to Python dict """
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []
+    """ Clean and shape node, way or relation XML element to Python dict """
+    shaped = shape_rows(element)
+    return as_document(shaped) if shaped else shaped
 
+
+def shape_rows(element):
+    """ shape_element with the tags, way nodes and members as tuples in the order of RECORD_FIELDS """
     if element.tag == 'node':
         return shapingNode(element)
     elif element.tag == 'way':
         return shapingWay(element)
+    elif element.tag == 'relation':
+        return shapingRelation(element)
+
+
+def split_key(keystr):
+    """ (key, type) of a tag k attribute, e.g. ('street:name', 'addr') of 'addr:street:name', ('amenity', 'regular')
+    of 'amenity'. Both are interned and the result is cached per distinct k, every tag with the same k shares them.
+    """
+    split = _split_keys.get(keystr)
+    if split is None:
+        if len(_split_keys) >= KEY_CACHE:
+            _split_keys.clear()
+        t, colon, key = keystr.partition(':')
+        split = (_intern(key), _intern(t)) if colon else (_intern(keystr), 'regular')
+        _split_keys[keystr] = split
+    return split
+
+
+def _intern(text):
+    # unicode cannot be interned, the cache of split_key shares it anyway
+    return intern(text) if isinstance(text, str) else text
+
+
+def shape_attributes(element, fields):
+    """ {field: value} of the attributes of element in fields """
+    shaped = {}
+    for attr, value in element.attrib.iteritems():
+        if attr in fields:
+            shaped[attr] = value
+    return shaped
+
+
+def shape_tags(element, el_id):
+    """ (id, key, value, type) of the tag children of element, el_id being the id of the element """
+    tags = []
+    for tag in element.iter('tag'):
+        attrib = tag.attrib
+        key, t = split_key(attrib['k'])
+        tags.append((el_id, key, attrib.get('v'), t))
+    return tags
 
 
 def shapingNode(element):
@@ -178,32 +269,8 @@ def shapingNode(element):
     Returns:
         {'node': node_attribs, 'node_tags': tags}
     """
-    node = {}
-    for attr in element.attrib:
-        if attr in NODE_FIELDS:
-            node[attr] = element.attrib.get(attr)
-
-    """ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type'] """
-    nodeTags = []
-
-    for tag in element.iter('tag'):
-        keystr = tag.attrib.get('k')
-        keys = keystr.split(':')
-        if len(keys) == 1:
-            key = keys[0]
-            t = 'regular'
-        else:
-            key = keystr[(keystr.index(':') + 1):]
-            t = keys[0]
-
-        nodeTags.append({
-            'id': node.get('id'),
-            'key': key,
-            'value': tag.attrib.get('v'),
-            'type': t
-        })
-
-    return {'node': node, 'node_tags': nodeTags}
+    node = shape_attributes(element, NODE_FIELDS)
+    return {'node': node, 'node_tags': shape_tags(element, node.get('id'))}
 
 
 def shapingWay(element):
@@ -214,45 +281,34 @@ def shapingWay(element):
     Returns:
         {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
     """
-    way = {}
-    way_tags = []
-    for attr in element.attrib:
-        if attr in WAY_FIELDS:
-            way[attr] = element.attrib.get(attr)
+    way = shape_attributes(element, WAY_FIELDS)
+    way_id = way.get('id')
+    wayNodes = [(way_id, nd.attrib.get('ref'), idx) for idx, nd in enumerate(element.iter('nd'))]
+    return {'way': way, 'way_nodes': wayNodes, 'way_tags': shape_tags(element, way_id)}
 
-    wayTags = []
 
-    """ WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type'] """
-    for tag in element.iter('tag'):
-        keystr = tag.attrib.get('k')
-        keys = keystr.split(':')
-
-        if len(keys) == 1:
-            key = keys[0]
-            t = 'regular'
-        else:
-            key = keystr[(keystr.index(':') + 1):]
-            t = keys[0]
-
-        wayTags.append({
-            'id': way.get('id'),
-            'key': key,
-            'value': tag.attrib.get('v'),
-            'type': t
-        })
+def shapingRelation(element):
+    """
+    Args:
+        RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+
+    Returns:
+        {'relation': relation_attribs, 'relation_members': members, 'relation_tags': tags}
+    """
+    relation = shape_attributes(element, RELATION_FIELDS)
+    relation_id = relation.get('id')
+    relationMembers = []
+    for idx, member in enumerate(element.iter('member')):
+        relationMembers.append((relation_id, member.attrib.get('type'), member.attrib.get('ref'), member.attrib.get('role', ''), idx))
+    return {'relation': relation, 'relation_members': relationMembers, 'relation_tags': shape_tags(element, relation_id)}
 
-    wayNodes = []
-    idx = 0
-    # WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-    for nd in element.iter('nd'):
-        wayNodes.append({
-            'id': way.get('id'),
-            'node_id': nd.attrib.get('ref'),
-            'position': idx,
-        })
-        idx += 1
 
-    return {'way': way, 'way_nodes': wayNodes, 'way_tags': wayTags}
+def as_document(shaped):
+    """ shape_rows result with its tuples turned into dicts, i.e. the shape_element result """
+    doc = {}
+    for name, value in shaped.iteritems():
+        doc[name] = value if isinstance(value, dict) else [dict(zip(RECORD_FIELDS[name], row)) for row in value]
+    return doc
 
 
 # ================================================== #
@@ -260,13 +316,7 @@ def shapingWay(element):
 # ================================================== #
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """ Yield element if it is the right type of tag """
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-    root.clear()
+    return osmstream.iter_elements(osm_file, tags=tags)
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -291,38 +341,269 @@ class UnicodeDictWriter(csv.DictWriter, object):
         for row in rows:
             self.writerow(row)
 
+    def writerecords(self, records):
+        """ Write tuples holding the fields in the order of fieldnames, see RECORD_FIELDS """
+        self.writer.writerows([v.encode('utf-8') if isinstance(v, unicode) else v for v in record] for record in records)
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 
 
-def process_map(file_in, validate):
-    """ Iteratively process each XML element and write into mongodb collection(s) """
+def process_map(file_in, validate, collection=None, batch_size=mongowriter.BATCH_SIZE, checkpoint=False, resume=False, index=None,
+                element_filter=None):
+    """ Iteratively process each XML element and write into mongodb collection(s)
 
-    validator = cerberus.Validator()
+    Args:
+        collection: target collection, defaults to da.mun10 on the pooled local client.
+        batch_size: number of documents per bulk insert.
+        checkpoint: process the file in chunks of CHUNK_SIZE bytes and record the progress after each one
+            in "<file_in>.mongo.checkpoint".
+        resume: continue an interrupted checkpointed run. Documents the interrupted chunk already inserted are
+            removed first, so the chunk is not written twice.
+        index: change index file (see changeindex.py). Only new elements are inserted, changed ones replace their
+            document and the documents of elements gone since the previous import are deleted.
+        element_filter: insert only the elements passing this filter (dict, string or osmfilter.ElementFilter, see
+            osmfilter.py), the others are skipped before they are parsed. It cannot be combined with index.
+    """
+    if collection is None:
+        collection = mongowriter.get_client().da.mun10
+
+    validator = fastvalidator.Validator()
+    tags = ('node', 'way', 'relation')
+    if index and element_filter is not None:
+        raise ValueError("a change index needs all elements, the filtered out ones would be deleted")
+    element_filter = osmfilter.get_filter(element_filter)
+
+    if not (checkpoint or resume):
+        change_index = ChangeIndex(index) if index else None
+        elements = element_filter.elements(file_in) if element_filter else get_element(file_in, tags=tags)
+        with mongowriter.BulkWriter(collection, batch_size) as writer:
+            write_elements(elements, writer, validator, validate, change_index)
+            if change_index:
+                for el_type, el_id in change_index.removed():
+                    writer.delete({el_type + '.id': el_id})
+        if change_index:
+            change_index.close()
+        return
+
+    if index:
+        raise ValueError("a change index cannot be combined with checkpoints")
+    if resume and element_filter is not None and element_filter.ordered:
+        raise ValueError("a bbox filter of ways or relations needs the whole file, it cannot resume")
+
+    ckpt = Checkpoint("{0}.mongo.checkpoint".format(file_in), file_in)
+    state = ckpt.load() if resume else None
+    offset = state['offset'] if state else 0
+    written = state['outputs']['documents'] if state else 0
+
+    chunks = osmstream.chunk_offsets(file_in, CHUNK_SIZE, offset)
+    # a run interrupted before its first checkpoint may have inserted part of the first chunk
+    if resume and chunks:
+        undo_chunk(file_in, chunks[0], collection)
+
+    with mongowriter.BulkWriter(collection, batch_size) as writer:
+        for start, end in chunks:
+            if element_filter is not None:
+                elements = element_filter.elements(file_in, start, end)
+            else:
+                elements = osmstream.iter_range(file_in, start, end, tags=tags)
+            last_id = write_elements(elements, writer, validator, validate)
+            writer.flush()
+            ckpt.save(end, last_id, {'documents': written + writer.written})
+    ckpt.clear()
+
+
+def write_elements(elements, writer, validator, validate, change_index=None):
+    """ Shape, validate and queue elements on a mongowriter.BulkWriter, returns the id of the last element
+
+    With a change index unchanged elements are skipped and modified ones replace their previous document.
+    """
+    last_id = None
+    for element in elements:
+        last_id = element.get('id')
+        action = change_index.check(element) if change_index else CREATE
+        if action is None:
+            continue
 
-    for element in get_element(file_in, tags=('node', 'way')):
         el = shape_element(element)
         if el:
             if validate is True:
                 validate_element(el, validator)
 
-            insertElementIntoCollection(el)
+            if action == MODIFY:
+                writer.replace({element.tag + '.id': last_id}, el)
+            else:
+                writer.insert(el)
+    return last_id
+
+
+def undo_chunk(file_in, chunk, collection):
+    """ Remove the documents of the elements in the byte range chunk=(start, end) from the collection """
+    ids = {'node': [], 'way': [], 'relation': []}
+    for element in osmstream.iter_range(file_in, chunk[0], chunk[1], tags=('node', 'way', 'relation')):
+        ids[element.tag].append(element.get('id'))
+
+    for tag, tag_ids in ids.iteritems():
+        if tag_ids:
+            collection.delete_many({tag + '.id': {'$in': tag_ids}})
+
+
+def export_map(file_in, validate, sqlite_path=None):
+    """ Iteratively process each XML element and write it into the eight csv files, and optionally into sqlite
+
+    Args:
+        sqlite_path: also load the rows into this sqlite database, see sqlexport.SqliteLoader.
+    """
+    validator = fastvalidator.Validator()
+    loader = sqlexport.SqliteLoader(sqlite_path) if sqlite_path else None
+
+    with codecs.open(NODES_PATH, 'w') as nodes_file, \
+            codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
+            codecs.open(WAYS_PATH, 'w') as ways_file, \
+            codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
+            codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file, \
+            codecs.open(RELATIONS_PATH, 'w') as relations_file, \
+            codecs.open(RELATION_TAGS_PATH, 'w') as relation_tags_file, \
+            codecs.open(RELATION_MEMBERS_PATH, 'w') as relation_members_file:
+
+        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
+        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
+        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
+        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
+        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+        relations_writer = UnicodeDictWriter(relations_file, RELATION_FIELDS)
+        relation_tags_writer = UnicodeDictWriter(relation_tags_file, RELATION_TAGS_FIELDS)
+        relation_members_writer = UnicodeDictWriter(relation_members_file, RELATION_MEMBERS_FIELDS)
+
+        nodes_writer.writeheader()
+        node_tags_writer.writeheader()
+        ways_writer.writeheader()
+        way_nodes_writer.writeheader()
+        way_tags_writer.writeheader()
+        relations_writer.writeheader()
+        relation_tags_writer.writeheader()
+        relation_members_writer.writeheader()
+
+        for element in get_element(file_in):
+            el = shape_rows(element)
+            if el:
+                if validate is True:
+                    validate_element(as_document(el), validator)
+
+                if element.tag == 'node':
+                    nodes_writer.writerow(el['node'])
+                    node_tags_writer.writerecords(el['node_tags'])
+                elif element.tag == 'way':
+                    ways_writer.writerow(el['way'])
+                    way_nodes_writer.writerecords(el['way_nodes'])
+                    way_tags_writer.writerecords(el['way_tags'])
+                elif element.tag == 'relation':
+                    relations_writer.writerow(el['relation'])
+                    relation_members_writer.writerecords(el['relation_members'])
+                    relation_tags_writer.writerecords(el['relation_tags'])
+
+                if loader:
+                    loader.add(el)
+
+    if loader:
+        loader.close()
 
 
 def insertElementIntoCollection(d):
     """
     Args:
         json object.
+
+    Note: one round trip per document, use mongowriter.BulkWriter for more than a handful of elements.
     """
-    from pymongo import MongoClient
-    cl = MongoClient("mongodb://localhost:27017")
-    db = cl.da
+    db = mongowriter.get_client().da
     db.mun10.insert_one(d)
 
 
+def deep_size(obj, seen):
+    """ Bytes of obj and the containers and strings it holds, each object counted once across calls sharing seen """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(v, seen) for v in obj)
+    return size
+
+
+def benchmark(osmfiles=('example.osm', 'data_example.osm', 'audit_example.osm'), repeat=20):
+    """ Shape the elements of the files with tuples (shape_rows) and dicts (shape_element): elements per second, and the
+    distinct objects and bytes held by the shaped elements. tracemalloc is python 3 only, deep_size stands in for it.
+    """
+    import time
+
+    elements = []
+    for osmfile in osmfiles:
+        elements.extend(get_element(osmfile))
+
+    for name, shaping in (('tuples', shape_rows), ('dicts', shape_element)):
+        started = time.time()
+        for _ in xrange(repeat):
+            for element in elements:
+                shaping(element)
+        rate = len(elements) * repeat / (time.time() - started)
+
+        seen = set()
+        size = deep_size([shaping(element) for element in elements], seen)
+        print "{0}: {1:.0f} elements/s, {2:.1f} objects and {3:.0f} bytes per element".format(
+            name, rate, float(len(seen) - 1) / len(elements), float(size) / len(elements))
+
+
+def test():
+    assert split_key('addr:street:name') == ('street:name', 'addr') and split_key('amenity') == ('amenity', 'regular')
+    assert split_key('addr:street')[1] is split_key('addr:city')[1]
+
+    shaped = [shape_rows(element) for element in get_element('example.osm')]
+    node = next(el for el in shaped if 'node' in el and el['node_tags'])
+    assert node['node_tags'][0][0] is node['node']['id']
+    way = as_document(next(el for el in shaped if 'way' in el))
+    assert way['way_nodes'][0] == {'id': way['way']['id'], 'node_id': '2636086179', 'position': 0}
+    relation = as_document(shaped[-1])
+    assert relation['relation_members'][0] == {'id': '1557627', 'member_type': 'node', 'member_id': '1258927212', 'role': 'via', 'position': 0}
+    assert relation['relation_tags'] == [{'id': '1557627', 'key': 'restriction', 'value': 'only_right_turn', 'type': 'regular'},
+                                         {'id': '1557627', 'key': 'type', 'value': 'restriction', 'type': 'regular'}]
+    validator = fastvalidator.Validator()
+    for el, element in zip(shaped, get_element('example.osm')):
+        assert shape_element(element) == as_document(el)
+        validate_element(as_document(el), validator)
+
+    # a run interrupted in its first chunk, before any checkpoint, is resumed without duplicates
+    import mongomock
+    collection = mongomock.MongoClient().da.example
+    process_map('example.osm', False, collection)
+    count = collection.count_documents({})
+    collection.delete_many({})
+
+    class Crashing(object):
+        def __init__(self):
+            self.batches = 0
+
+        def insert_many(self, docs, ordered):
+            if self.batches:
+                raise IOError('crash')
+            self.batches += 1
+            return collection.insert_many(docs, ordered=ordered)
+    try:
+        process_map('example.osm', False, Crashing(), batch_size=5, checkpoint=True)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('the run was not interrupted')
+    assert collection.count_documents({}) == 5
+    process_map('example.osm', False, collection, batch_size=5, resume=True)
+    assert collection.count_documents({}) == count
+
+
 if __name__ == '__main__':
     """
-    Note: Validation is ~ 10X slower. For the project consider using a small sample of the map when validating.
+    Note: Validation uses the compiled fastvalidator, cerberus used to make it ~ 10X slower. See fastvalidator.benchmark().
     """
     process_map(OSM_PATH, validate=True)
@@ -0,0 +1,51 @@
+'''
+Sets of osm element ids as sparse bitmaps, for the ids seen in one pass over a
+file: the elements a sample keeps (sampling.py) and the nodes and ways inside
+the bbox of a filter (osmfilter.py).
+'''
+
+# ids per page of an IdSet
+PAGE_BITS = 1 << 16
+
+
+class IdSet(object):
+    ''' Sparse bitmap of element ids: a page of PAGE_BITS bits for every range of ids holding
+    at least one member, 8 KB per page instead of a set entry (~70 bytes) per id.
+    '''
+
+    def __init__(self):
+        self.pages = {}
+        self.count = 0
+
+    def add(self, element_id):
+        page, bit = divmod(int(element_id), PAGE_BITS)
+        bits = self.pages.get(page)
+        if bits is None:
+            bits = self.pages[page] = bytearray(PAGE_BITS // 8)
+        mask = 1 << (bit & 7)
+        if not bits[bit >> 3] & mask:
+            bits[bit >> 3] |= mask
+            self.count += 1
+
+    def __contains__(self, element_id):
+        page, bit = divmod(int(element_id), PAGE_BITS)
+        bits = self.pages.get(page)
+        return bits is not None and bool(bits[bit >> 3] & (1 << (bit & 7)))
+
+    def __len__(self):
+        return self.count
+
+
+def test():
+    ids = IdSet()
+    for element_id in (1, 65535, 65536, 10 ** 10):
+        ids.add(element_id)
+    ids.add('1')
+    assert len(ids) == 4 and 10 ** 10 in ids and '65536' in ids and 2 not in ids
+    # negative ids of unsaved edits fall on pages of their own
+    ids.add(-1)
+    assert -1 in ids and 65535 in ids and -2 not in ids and len(ids) == 5
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,272 @@
+'''
+Output stage of osmData.routine: json lines for mongoimport.
+
+- the encoder is pluggable: stdlib json, or orjson / ujson when installed, see get_encoder
+- lines are collected in large buffers and written with one write call per buffer
+- the output can be compressed (gzip, zstd), see open_output
+- the output can be sharded into N files, one per parallel mongoimport worker, see import_shards
+
+With shards=1 and no compression the file is the plain "<osmfile>.json" of the
+original routine.
+'''
+import gzip
+import json
+import os
+import subprocess
+from distutils.spawn import find_executable
+
+# encoders tried in this order by get_encoder('auto')
+ENCODERS = ('orjson', 'ujson', 'json')
+
+COMPRESSION = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# bytes buffered per shard before they are written
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def get_encoder(name='json'):
+    ''' Return encode(doc) -> json text (str) of a document.
+    Args:
+        name str - 'json', 'ujson', 'orjson', or 'auto' for the fastest one installed
+    '''
+    if name == 'auto':
+        for name in ENCODERS:
+            try:
+                return get_encoder(name)
+            except ImportError:
+                pass
+
+    if name == 'json':
+        return json.dumps
+    if name == 'ujson':
+        import ujson
+        # same escaping as json.dumps
+        return lambda doc: ujson.dumps(doc, ensure_ascii=True, escape_forward_slashes=False)
+    if name == 'orjson':
+        import orjson
+        # utf-8 bytes, non ascii characters are not escaped, which is valid json as well
+        return orjson.dumps
+    raise ValueError("unknown encoder {0}".format(name))
+
+
+def output_paths(path, shards=1, compress=None):
+    ''' File names of the output: path itself, or path with the shard number before its extension. '''
+    suffix = COMPRESSION[compress]
+    if shards == 1:
+        return [path + suffix]
+    base, ext = os.path.splitext(path)
+    return ["{0}.{1}{2}{3}".format(base, i, ext, suffix) for i in range(shards)]
+
+
+def open_output(path, compress=None):
+    ''' Open path for binary writing, compressed with gzip or zstd.
+
+    zstd uses the zstandard package, or pipes through the zstd program if the package is missing.
+    '''
+    if compress is None:
+        return open(path, 'wb')
+    if compress == 'gzip':
+        return gzip.open(path, 'wb', GZIP_LEVEL)
+    if compress == 'zstd':
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, 'wb'))
+        except ImportError:
+            program = find_executable('zstd')
+            if program is None:
+                raise ImportError("writing {0} needs the zstandard package or the zstd program".format(path))
+            return PipeWriter([program, '-q', '-f', '-{0}'.format(ZSTD_LEVEL), '-o', path])
+    raise ValueError("unknown compression {0}".format(compress))
+
+
+class PipeWriter(object):
+    ''' Write into the standard input of a compressor program, e.g. zstd -o file.json.zst '''
+
+    def __init__(self, args):
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise IOError("compressor exited with {0}".format(self._process.returncode))
+
+
+class JsonWriter(object):
+    ''' Buffered, optionally compressed and sharded writer of json lines.
+
+    Documents go round robin to the shards, blocks of lines written with write_lines go to the next shard as a
+    whole. Use it as a context manager, or call close() when done.
+    Args:
+        path str - output file, see output_paths for the names of compressed and sharded files
+        encoder str - see get_encoder
+        compress str - None, 'gzip' or 'zstd'
+        shards int - number of output files
+        buffer_size int - bytes buffered per shard before writing
+    '''
+
+    def __init__(self, path, encoder='json', compress=None, shards=1, buffer_size=BUFFER_SIZE):
+        self.paths = output_paths(path, shards, compress)
+        self.encode = get_encoder(encoder)
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self.documents = 0
+
+        self._files = [open_output(p, compress) for p in self.paths]
+        self._buffers = [[] for _ in self._files]
+        self._buffered = [0] * len(self._files)
+        self._next = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, doc):
+        ''' Encode and buffer one document. '''
+        self.write_lines(self.encode(doc) + "\n")
+        self.documents += 1
+
+    def write_lines(self, lines):
+        ''' Buffer already encoded json lines (str). '''
+        if not lines:
+            return
+        shard = self._next
+        self._next = (shard + 1) % len(self._files)
+
+        self._buffers[shard].append(lines)
+        self._buffered[shard] += len(lines)
+        if self._buffered[shard] >= self.buffer_size:
+            self._write(shard)
+
+    def close(self):
+        ''' Write the remaining buffers and close all files. '''
+        if self._files is None:
+            return
+        for shard, f in enumerate(self._files):
+            self._write(shard)
+            f.close()
+        self._files = None
+
+    def _write(self, shard):
+        if self._buffers[shard]:
+            self._files[shard].write("".join(self._buffers[shard]))
+            self.bytes_written += self._buffered[shard]
+            self._buffers[shard] = []
+            self._buffered[shard] = 0
+
+
+def import_shards(paths, db, collection, uri=None, workers=1):
+    ''' Run one mongoimport per shard, all in parallel, compressed shards are decompressed into its stdin.
+    Return:
+        wall time in seconds.
+    '''
+    import time
+
+    mongoimport = find_executable('mongoimport')
+    if mongoimport is None:
+        raise OSError("mongoimport not found")
+
+    started = time.time()
+    processes = []
+    for path in paths:
+        args = [mongoimport, '--quiet', '--db', db, '--collection', collection, '--numInsertionWorkers', str(workers)]
+        if uri:
+            args += ['--uri', uri]
+        if path.endswith('.json'):
+            processes.append(subprocess.Popen(args + ['--file', path]))
+            continue
+        decompress = subprocess.Popen(['gzip' if path.endswith('.gz') else 'zstd', '-dc', path], stdout=subprocess.PIPE)
+        processes.append(subprocess.Popen(args, stdin=decompress.stdout))
+        decompress.stdout.close()
+        processes.append(decompress)
+
+    failed = [p for p in processes if p.wait() != 0]
+    if failed:
+        raise OSError("mongoimport of {0} failed".format(paths))
+    return time.time() - started
+
+
+def benchmark(osmfile='example.osm', repeat=200, shards=4, db='test', collection='jsonout_benchmark'):
+    ''' Write the shaped documents of osmfile with every installed encoder and compression, print bytes/s, then
+    import the sharded output with parallel mongoimport workers if mongoimport is installed.
+    '''
+    import time
+    from collections import defaultdict
+    import mongowriter
+    import osmData
+    import osmstream
+
+    street_types = defaultdict(set)
+    docs = [osmData.audit_and_shape(e, street_types) for e in osmstream.iter_elements(osmfile, tags=("node", "way"))] * repeat
+    path = osmfile + '.benchmark.json'
+
+    compressions = [None, 'gzip']
+    try:
+        open_output(os.devnull, 'zstd').close()
+        compressions.append('zstd')
+    except ImportError:
+        pass
+
+    for name in ENCODERS:
+        try:
+            get_encoder(name)
+        except ImportError:
+            print "{0:8} not installed".format(name)
+            continue
+        for compress in compressions:
+            started = time.time()
+            with JsonWriter(path, name, compress) as writer:
+                for doc in docs:
+                    writer.write(doc)
+            elapsed = time.time() - started
+            size = sum(os.path.getsize(p) for p in writer.paths)
+            print "{0:8} {1:5} {2:7.1f} MB/s json, {3:7.2f} MB on disk".format(name, compress or '-', writer.bytes_written / elapsed / 1e6, size / 1e6)
+            for p in writer.paths:
+                os.remove(p)
+
+    if not find_executable('mongoimport'):
+        print "mongoimport not found, skipping the import benchmark"
+        return
+    for n in (1, shards):
+        with JsonWriter(path, shards=n) as writer:
+            for doc in docs:
+                writer.write(doc)
+        mongowriter.get_client()[db][collection].drop()
+        print "mongoimport {0} shard(s): {1:.2f}s".format(n, import_shards(writer.paths, db, collection))
+        for p in writer.paths:
+            os.remove(p)
+
+
+def test():
+    import tempfile
+
+    docs = [{'id': str(i), 'type': 'node', 'name': u'M\xfcnchen'} for i in range(10)]
+    path = os.path.join(tempfile.mkdtemp(), 'example.osm.json')
+
+    with JsonWriter(path, buffer_size=16) as writer:
+        for doc in docs:
+            writer.write(doc)
+    with open(path, 'rb') as f:
+        assert f.read() == "".join(json.dumps(doc) + "\n" for doc in docs)
+
+    with JsonWriter(path, compress='gzip', shards=3) as writer:
+        for doc in docs:
+            writer.write(doc)
+    assert [os.path.basename(p) for p in writer.paths] == ['example.osm.0.json.gz', 'example.osm.1.json.gz', 'example.osm.2.json.gz']
+    lines = []
+    for p in writer.paths:
+        with gzip.open(p, 'rb') as f:
+            lines.extend(f.read().splitlines())
+        os.remove(p)
+    assert sorted(json.loads(line)['id'] for line in lines) == sorted(doc['id'] for doc in docs)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
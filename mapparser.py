@@ -8,23 +8,25 @@ the map as value.
 
 Note that your code will be tested with a different data file than the 'example.osm'
 """
-import xml.etree.cElementTree as ET
 import pprint 
 
+import osmstream
+
+class TagCounter(osmstream.Visitor):
+   # counts every tag of the top level elements, plus the document root
+   def __init__(self, root='osm'):
+      self.counts = {root: 1}
+
+   def visit(self, element):
+      for child in element.iter():
+         self.counts[child.tag] = self.counts.get(child.tag, 0) + 1
+
+   def result(self):
+      return self.counts
+
 def count_tags(filename):
-   # YOUR CODE HERE
-   tree = ET.parse('example.osm')
-   root = tree.getroot()
-
-   tags = {}
-   for element in root.iter():
-      tag = element.tag
-      if tag in tags.keys():
-         tags[tag] += 1
-      else:
-         tags[tag] = 1
-
-   return tags
+   # one streaming pass, the file may be plain, .bz2, .gz or .zst
+   return osmstream.run_visitors(filename, [TagCounter()])[0]
 
 def test():
    tags = count_tags('example.osm')
@@ -0,0 +1,221 @@
+'''
+Buffered bulk writes of shaped documents into a mongodb collection.
+
+Documents are collected into batches of batch_size and sent with one unordered
+insert_many per batch by a background thread, so the parser keeps shaping while
+the previous batch is on the wire. At most max_pending batches wait for the
+writer; when the database falls behind, the parser blocks on the next batch
+(back-pressure) instead of buffering the whole map in memory.
+
+Besides inserts, replace (upsert) and delete operations can be queued, batches
+mixing them are sent as one ordered bulk_write so they apply in the given order.
+
+All writers of a process share one pooled MongoClient per uri, see get_client.
+'''
+import atexit
+import threading
+import time
+import weakref
+import Queue
+
+MONGO_URI = "mongodb://localhost:27017"
+BATCH_SIZE = 1000
+MAX_PENDING = 4
+
+INSERT = 'insert'
+REPLACE = 'replace'
+DELETE = 'delete'
+
+_clients = {}
+
+# writers not closed yet, closed by _close_all when the interpreter exits
+_open_writers = weakref.WeakSet()
+
+
+def get_client(uri=MONGO_URI):
+    ''' Return the process wide MongoClient for uri. MongoClient keeps its own connection pool, creating one per
+    document exhausts sockets.
+    '''
+    if uri not in _clients:
+        from pymongo import MongoClient
+        _clients[uri] = MongoClient(uri)
+    return _clients[uri]
+
+
+class BulkWriter(object):
+    ''' Batching, non blocking writer for a single collection.
+
+    Use it as a context manager, or call close() when done. Pending documents are flushed on close and, as a
+    last resort, when the interpreter exits.
+    Args:
+        collection pymongo.collection.Collection - target collection
+        batch_size int - documents per insert_many
+        max_pending int - batches queued for the writer thread before insert() blocks
+    written is the number of documents inserted so far, replacements and deletions are not counted.
+    '''
+
+    def __init__(self, collection, batch_size=BATCH_SIZE, max_pending=MAX_PENDING):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.written = 0
+
+        self._batch = []
+        self._queue = Queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _open_writers.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def insert(self, doc):
+        ''' Queue a document, blocks while max_pending batches are waiting for the database. '''
+        self._add(INSERT, doc)
+
+    def replace(self, query, doc):
+        ''' Queue the replacement of the document matching query by doc, doc is inserted if nothing matches. '''
+        self._add(REPLACE, (query, doc))
+
+    def delete(self, query):
+        ''' Queue the removal of all documents matching query. '''
+        self._add(DELETE, query)
+
+    def _add(self, kind, payload):
+        self._batch.append((kind, payload))
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    def flush(self):
+        ''' Send the current batch and wait until everything queued so far has been written. '''
+        self._submit()
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            _open_writers.discard(self)
+            self._queue.put(None)
+            self._thread.join()
+
+    def _submit(self):
+        self._raise_error()
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                if self._error is None:
+                    self._write(batch)
+                    self.written += sum(1 for kind, _ in batch if kind == INSERT)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        if all(kind == INSERT for kind, _ in batch):
+            self.collection.insert_many([doc for _, doc in batch], ordered=False)
+            return
+
+        from pymongo import InsertOne, ReplaceOne, DeleteMany
+        requests = []
+        for kind, payload in batch:
+            if kind == INSERT:
+                requests.append(InsertOne(payload))
+            elif kind == REPLACE:
+                requests.append(ReplaceOne(payload[0], payload[1], upsert=True))
+            else:
+                requests.append(DeleteMany(payload))
+        self.collection.bulk_write(requests, ordered=True)
+
+
+@atexit.register
+def _close_all():
+    for writer in list(_open_writers):
+        writer.close()
+
+
+def benchmark(docs, collection, batch_size=BATCH_SIZE):
+    ''' Print elements per second of one insert_one per document against the bulk writer.
+    Args:
+        docs list - shaped documents, e.g. [data.shape_element(e) for e in data.get_element(osmfile, ('node', 'way'))]
+        collection - pymongo or mongomock collection, it is emptied before each run
+    '''
+    import copy
+
+    collection.delete_many({})
+    started = time.time()
+    for doc in copy.deepcopy(docs):
+        collection.insert_one(doc)
+    single = len(docs) / (time.time() - started)
+
+    collection.delete_many({})
+    started = time.time()
+    with BulkWriter(collection, batch_size) as writer:
+        for doc in copy.deepcopy(docs):
+            writer.insert(doc)
+    bulk = len(docs) / (time.time() - started)
+
+    print "insert_one:  {0:.0f} elements/s".format(single)
+    print "BulkWriter:  {0:.0f} elements/s (batch size {1})".format(bulk, batch_size)
+
+
+def test():
+    import mongomock
+    collection = mongomock.MongoClient().da.test
+
+    with BulkWriter(collection, batch_size=7, max_pending=2) as writer:
+        for i in range(100):
+            writer.insert({'i': i})
+        writer.flush()
+        assert writer.written == 100 and collection.count_documents({}) == 100
+    assert writer.written == 100
+
+    with BulkWriter(collection, batch_size=3) as writer:
+        writer.replace({'i': 1}, {'i': 1, 'v': 2})
+        writer.replace({'i': 200}, {'i': 200})
+        writer.delete({'i': {'$lt': 50}})
+        writer.insert({'i': 300})
+    assert collection.count_documents({}) == 52
+    assert collection.find_one({'i': 200}) is not None
+    assert writer.written == 1 and writer not in _open_writers
+
+    # a failed write is raised by close, which still stops the writer thread
+    class Failing(object):
+        def insert_many(self, docs, ordered):
+            raise IOError('down')
+    writer = BulkWriter(Failing())
+    writer.insert({'i': 1})
+    try:
+        writer.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError('the write error was not raised')
+    assert not writer._thread.is_alive() and writer not in _open_writers
+
+
+if __name__ == '__main__':
+    test()
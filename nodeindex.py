@@ -0,0 +1,206 @@
+'''
+Memory-mapped node location index for extracts larger than RAM.
+
+A dense file holding 8 bytes per node id: the node with id n is at offset
+8 * n, its latitude and longitude packed as two little endian uint32 in units
+of 1e-7 degree (the precision of osm), shifted to be positive and offset by
++1 so that zero bytes mean "no such node". The file is sparse: holes between
+ids take no disk space, and lookups are served by the page cache shared by all
+processes that map the file.
+
+Node ids start at 1, slot 0 holds a marker written once the index is complete,
+a run that died while building it leaves an index that is not reused. Nodes
+with lower ids (the negative ids of edits not uploaded yet) have no slot, add
+rejects them and build skips them.
+
+    index = NodeIndex.create("munich.nodes")
+    index.add(node_id, lat, lon)
+    index.close()
+    ...
+    index = NodeIndex.open("munich.nodes")
+    index.get(node_id)      # (lat, lon) or None
+'''
+import mmap
+import os
+import struct
+
+SLOT = struct.Struct('<II')
+SLOT_SIZE = SLOT.size
+COMPLETE = 'NODEIDX\x01'
+SCALE = 10 ** 7
+# stored values are shifted to be positive, +1 to tell a node at -90/-180 from an empty slot
+LAT_SHIFT = 90 * SCALE + 1
+LON_SHIFT = 180 * SCALE + 1
+
+# the file grows at least by this many bytes at a time
+GROW_SIZE = 64 * 1024 * 1024
+
+_open_indexes = {}
+
+
+class NodeIndex(object):
+    ''' Use create or open. '''
+
+    def __init__(self, path, writable):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._map = None
+        self._size = 0
+        # end of the last slot written
+        self._end = SLOT_SIZE
+        self._remap()
+
+    @classmethod
+    def create(cls, path):
+        ''' New, empty index, replacing path. '''
+        with open(path, 'wb') as f:
+            f.truncate(GROW_SIZE)
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, path):
+        ''' Read only access to a complete index. '''
+        index = cls(path, writable=False)
+        if index._map[:SLOT_SIZE] != COMPLETE:
+            index.close()
+            raise ValueError("{0} is not a complete node index".format(path))
+        return index
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        self._size = os.fstat(self._file.fileno()).st_size
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), self._size, access=access)
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if node_id < 1:
+            raise ValueError("node id {0} has no slot in the index, ids start at 1".format(node_id))
+        offset = node_id * SLOT_SIZE
+        if offset + SLOT_SIZE > self._size:
+            self._file.truncate(max(offset + SLOT_SIZE, self._size + GROW_SIZE, self._size * 2))
+            self._remap()
+        self._end = max(self._end, offset + SLOT_SIZE)
+        SLOT.pack_into(self._map, offset, int(round(lat * SCALE)) + LAT_SHIFT, int(round(lon * SCALE)) + LON_SHIFT)
+
+    def get(self, node_id):
+        ''' (lat, lon) of the node, None if it is not in the index. '''
+        offset = int(node_id) * SLOT_SIZE
+        if offset <= 0 or offset + SLOT_SIZE > self._size:
+            return None
+        lat, lon = SLOT.unpack_from(self._map, offset)
+        if lat == 0:
+            return None
+        return (lat - LAT_SHIFT) / float(SCALE), (lon - LON_SHIFT) / float(SCALE)
+
+    def close(self):
+        ''' Close the index, a writable one is marked complete first. '''
+        if self._map is None:
+            return
+        if self.writable:
+            self._map[:SLOT_SIZE] = COMPLETE
+            self._map.flush()
+        self._map.close()
+        self._map = None
+        if self.writable:
+            # drop the room reserved for growing
+            self._file.truncate(self._end)
+        self._file.close()
+
+
+def is_fresh(path, osmfile):
+    ''' True if path is a complete index written after osmfile was last modified. '''
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(osmfile):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(SLOT_SIZE) == COMPLETE
+
+
+def build(osmfile, path):
+    ''' Index the nodes of osmfile into path, unless a fresh index exists already. '''
+    import osmstream
+
+    if is_fresh(path, osmfile):
+        return
+    index = NodeIndex.create(path)
+    for elem in osmstream.iter_elements(osmfile, tags=('node',)):
+        if int(elem.attrib['id']) > 0:
+            index.add(elem.attrib['id'], float(elem.attrib['lat']), float(elem.attrib['lon']))
+    index.close()
+
+
+def shared(path):
+    ''' Read only index of path, opened once per process (e.g. by each pool worker). '''
+    # a rebuilt file is opened again
+    key = (path, os.path.getmtime(path))
+    if key not in _open_indexes:
+        _open_indexes[key] = NodeIndex.open(path)
+    return _open_indexes[key]
+
+
+def benchmark(n=20000000, path='/tmp/benchmark.nodes', lookups=1000000):
+    ''' Build an index of n synthetic nodes with ids spread like an extract (increasing, with gaps) and time random
+    lookups.
+    '''
+    import random
+    import time
+
+    rnd = random.Random(1)
+    started = time.time()
+    index = NodeIndex.create(path)
+    node_id = 0
+    for _ in xrange(n):
+        node_id += rnd.randint(1, 3)
+        index.add(node_id, 48 + rnd.random(), 11 + rnd.random())
+    index.close()
+    build_time = time.time() - started
+    max_id = node_id
+
+    index = NodeIndex.open(path)
+    queries = [rnd.randint(1, max_id) for _ in xrange(lookups)]
+    started = time.time()
+    found = sum(1 for q in queries if index.get(q) is not None)
+    lookup_time = time.time() - started
+    index.close()
+
+    disk = os.stat(path).st_blocks * 512
+    print "{0} nodes, max id {1}: built in {2:.1f}s ({3:.0f} nodes/s)".format(n, max_id, build_time, n / build_time)
+    print "file {0:.0f} MB, {1:.0f} MB on disk".format(os.path.getsize(path) / 1e6, disk / 1e6)
+    print "{0} random lookups ({1} hits): {2:.0f} lookups/s".format(lookups, found, lookups / lookup_time)
+    os.remove(path)
+
+
+def test():
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.nodes')
+    index = NodeIndex.create(path)
+    index.add(1, -90.0, -180.0)
+    index.add(2, 90.0, 180.0)
+    index.add(5 * GROW_SIZE, 48.1, 11.5)
+    for node_id in (0, '-1'):
+        try:
+            index.add(node_id, 48.1, 11.5)
+        except ValueError:
+            continue
+        raise AssertionError("added node {0}".format(node_id))
+    index.close()
+
+    index = NodeIndex.open(path)
+    assert index.get(1) == (-90.0, -180.0) and index.get(2) == (90.0, 180.0)
+    assert index.get(5 * GROW_SIZE) == (48.1, 11.5)
+    assert index.get(3) is None and index.get(0) is None and index.get(-1) is None and index.get(10 ** 12) is None
+    index.close()
+    os.remove(path)
+
+    build('example.osm', path)
+    assert is_fresh(path, 'example.osm')
+    assert shared(path).get('261114295') == (41.9730791, -87.6866303)
+    assert shared(path).get('261114296') == (41.9730416, -87.6878512)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
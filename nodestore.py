@@ -0,0 +1,139 @@
+'''
+Compact in-process store of node locations, for resolving way geometry in the same pass.
+
+Node ids and coordinates are appended to typed arrays (8 byte id, two 8 byte
+floats, 24 bytes per node) instead of a dict of float tuples (~200 bytes per
+node). osm files list nodes by ascending id, so the id array stays sorted and a
+lookup is a binary search; a store filled out of order is sorted once before
+its first lookup.
+
+Python 2 arrays have no 'q' type code, 'l' is 64 bit on the 64 bit platforms
+this runs on.
+'''
+import bisect
+from array import array
+
+ID_TYPE = 'l'
+COORD_TYPE = 'd'
+
+
+class NodeStore(object):
+
+    def __init__(self):
+        self.ids = array(ID_TYPE)
+        self.lats = array(COORD_TYPE)
+        self.lons = array(COORD_TYPE)
+        self._sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if self._sorted and self.ids and node_id <= self.ids[-1]:
+            self._sorted = False
+        self.ids.append(node_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+
+    def get(self, node_id):
+        ''' (lat, lon) of the node, None if it is not in the store. '''
+        if not self._sorted:
+            self._sort()
+        node_id = int(node_id)
+        i = bisect.bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return self.lats[i], self.lons[i]
+        return None
+
+    def nbytes(self):
+        ''' Memory used by the arrays. '''
+        return sum(a.buffer_info()[1] * a.itemsize for a in (self.ids, self.lats, self.lons))
+
+    def _sort(self):
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array(ID_TYPE, (self.ids[i] for i in order))
+        self.lats = array(COORD_TYPE, (self.lats[i] for i in order))
+        self.lons = array(COORD_TYPE, (self.lons[i] for i in order))
+        self._sorted = True
+
+
+def resolve(nodes, node_refs):
+    ''' Locations of a way.
+    Args:
+        nodes - NodeStore, or any object with get(node_id) -> (lat, lon) or None
+        node_refs list - node ids of the way
+    Return:
+        (positions, bbox): [lat, lon] per ref, None for nodes not in the store (outside the extract), and
+        [min_lat, min_lon, max_lat, max_lon] of the resolved ones, None if none resolved.
+    '''
+    positions = []
+    lats = []
+    lons = []
+    for ref in node_refs:
+        location = nodes.get(ref)
+        if location is None:
+            positions.append(None)
+            continue
+        positions.append(list(location))
+        lats.append(location[0])
+        lons.append(location[1])
+
+    bbox = [min(lats), min(lons), max(lats), max(lons)] if lats else None
+    return positions, bbox
+
+
+def benchmark(n=1000000):
+    ''' Memory per node and lookups per second of a NodeStore and a dict of (lat, lon) tuples with n nodes. '''
+    import random
+    import sys
+    import time
+
+    rnd = random.Random(1)
+    ids = sorted(rnd.sample(xrange(n * 10), n))
+    coords = [(48 + rnd.random(), 11 + rnd.random()) for _ in xrange(n)]
+
+    store = NodeStore()
+    started = time.time()
+    for node_id, (lat, lon) in zip(ids, coords):
+        store.add(node_id, lat, lon)
+    store_build = time.time() - started
+
+    started = time.time()
+    table = {}
+    for node_id, (lat, lon) in zip(ids, coords):
+        table[node_id] = (lat, lon)
+    dict_build = time.time() - started
+    # the dict, its tuples and floats; small ids are cached ints, the rest are counted too
+    dict_bytes = sys.getsizeof(table) + sum(sys.getsizeof(k) + sys.getsizeof(v) + 2 * sys.getsizeof(v[0]) for k, v in table.iteritems())
+
+    queries = [rnd.choice(ids) for _ in xrange(min(n, 200000))]
+    results = []
+    for lookup in (store.get, table.get):
+        started = time.time()
+        for node_id in queries:
+            lookup(node_id)
+        results.append(len(queries) / (time.time() - started))
+
+    print "{0} nodes".format(n)
+    print "NodeStore: {0:.1f} bytes/node, built in {1:.2f}s, {2:.0f} lookups/s".format(float(store.nbytes()) / n, store_build, results[0])
+    print "dict:      {0:.1f} bytes/node, built in {1:.2f}s, {2:.0f} lookups/s".format(float(dict_bytes) / n, dict_build, results[1])
+
+
+def test():
+    store = NodeStore()
+    store.add('5', 48.1, 11.5)
+    store.add(3, 48.0, 11.4)
+    store.add(9, 48.2, 11.6)
+    assert len(store) == 3
+    assert store.get('3') == (48.0, 11.4) and store.get(9) == (48.2, 11.6) and store.get(4) is None
+    assert store.nbytes() == 3 * 24
+
+    positions, bbox = resolve(store, ['3', '7', '9'])
+    assert positions == [[48.0, 11.4], None, [48.2, 11.6]]
+    assert bbox == [48.0, 11.4, 48.2, 11.6]
+    assert resolve(store, ['7']) == ([None], None)
+
+
+if __name__ == '__main__':
+    test()
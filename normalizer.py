@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''
+Table driven street name cleaning with memoized results.
+
+The cleaning rules live in a json file (CLEANING_RULES):
+- "mapping": last word of the name -> replacement, e.g. "Str." -> "Straße" (the
+  'mapping' dict of audit.py / osmData.py)
+- "rules": [regex, replacement] pairs applied in order after the mapping, e.g.
+  the German "Hauptstr." -> "Hauptstraße". The replacement of a case insensitive
+  rule takes the case of the text it replaces, "HAUPTSTR." -> "HAUPTSTRAßE"
+
+Only street names are cleaned, osmData.shape keeps the other address values
+(house numbers, postcodes, cities) as they are.
+
+The rules are compiled once. As the same street names occur thousands of times,
+cleaned names are kept in a bounded cache keyed by the raw name, its hit rate is
+reported by Normalizer.stats. The cache is a two generation approximation of an
+LRU: a hit in the current generation is a single dict lookup, names only found
+in the previous generation are moved to the current one, and the previous
+generation is dropped when the current one is full. An OrderedDict LRU costs
+several microseconds per hit on python 2, more than cleaning a short name.
+'''
+import json
+import os
+import re
+
+CLEANING_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cleaning_rules.json')
+CACHE_SIZE = 100000
+
+
+def apply_mapping(name, mapping):
+    ''' Replace the last word of name if it is in mapping, names with an unknown or without a suffix are returned
+    unchanged.
+    '''
+    str_type = name.rsplit(' ', 1)
+    if len(str_type) == 2 and str_type[1] in mapping:
+        return str_type[0] + u' ' + mapping[str_type[1]]
+    return name
+
+
+def keep_case(replacement):
+    ''' re.sub replacement function of a case insensitive rule: the replacement in upper case for an upper case
+    match, capitalized for a capitalized one, else as written.
+    '''
+    def replace(match):
+        text = match.group(0)
+        result = match.expand(replacement)
+        if text.isupper():
+            return result.upper()
+        if text[:1].isupper():
+            return result[:1].upper() + result[1:]
+        return result
+    return replace
+
+
+class Normalizer(object):
+    ''' Memoized street name cleaning.
+    Args:
+        rules_path str - json rules file
+        cache_size int - at most this many cleaned names are kept, least recently used ones are dropped first
+    '''
+
+    def __init__(self, rules_path=CLEANING_RULES, cache_size=CACHE_SIZE):
+        with open(rules_path, 'rb') as f:
+            config = json.load(f)
+        self.mapping = config.get('mapping', {})
+        self.rules = []
+        for pattern, replacement in config.get('rules', []):
+            pattern = re.compile(pattern, re.UNICODE)
+            self.rules.append((pattern, keep_case(replacement) if pattern.flags & re.IGNORECASE else replacement))
+        self.cache_size = cache_size
+
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clean(self, name):
+        ''' Apply the mapping and the rules, without the cache. '''
+        name = apply_mapping(name, self.mapping)
+        for pattern, replacement in self.rules:
+            name = pattern.sub(replacement, name)
+        return name
+
+    def normalize(self, name):
+        ''' The cleaned name, from the cache if name was seen recently. '''
+        cleaned = self._current.get(name)
+        if cleaned is not None:
+            self.hits += 1
+            return cleaned
+
+        cleaned = self._previous.get(name)
+        if cleaned is not None:
+            self.hits += 1
+        else:
+            cleaned = self.clean(name)
+            self.misses += 1
+        if len(self._current) >= self.cache_size // 2:
+            self._previous = self._current
+            self._current = {}
+        self._current[name] = cleaned
+        return cleaned
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'cached': len(self._current) + len(self._previous),
+        }
+
+
+_default = None
+
+
+def default_normalizer():
+    ''' Process wide Normalizer of CLEANING_RULES. '''
+    global _default
+    if _default is None:
+        _default = Normalizer()
+    return _default
+
+
+def benchmark(osmfile='./munich_germany_k10.osm', repeat=1):
+    ''' Clean all street names of osmfile per occurrence with apply_mapping and the rules, and with the cache. '''
+    import time
+    import osmstream
+
+    values = []
+    for elem in osmstream.iter_elements(osmfile, tags=("node", "way")):
+        values.extend(tag.attrib['v'] for tag in elem.iter('tag') if tag.attrib['k'] == 'addr:street')
+    values *= repeat
+
+    normalizer = Normalizer()
+    started = time.time()
+    uncached = [normalizer.clean(value) for value in values]
+    uncached_time = time.time() - started
+
+    started = time.time()
+    cached = [normalizer.normalize(value) for value in values]
+    cached_time = time.time() - started
+
+    print "{0} names".format(len(values))
+    print "per occurrence: {0:.3f}s, {1:.2f} us/name".format(uncached_time, uncached_time / len(values) * 1e6)
+    print "memoized:       {0:.3f}s, {1:.2f} us/name, {2:.1f}x".format(cached_time, cached_time / len(values) * 1e6, uncached_time / cached_time)
+    print "same result: {0}, {1}".format(cached == uncached, normalizer.stats())
+
+
+def test():
+    normalizer = Normalizer(cache_size=4)
+    assert normalizer.normalize(u'North Lincoln St') == u'North Lincoln Street'
+    assert normalizer.normalize(u'Haupt Str.') == u'Haupt Straße'
+    assert normalizer.normalize(u'Hauptstr.') == u'Hauptstraße'
+    assert normalizer.normalize(u'HAUPTSTR.') == u'HAUPTSTRAßE' and normalizer.normalize(u'HauptStr') == u'HauptStraße'
+    assert normalizer.normalize(u'Leopoldstrasse') == u'Leopoldstraße'
+    assert normalizer.normalize(u'Sendlinger-Tor-Pl.') == u'Sendlinger-Tor-Pl.'
+    assert normalizer.normalize(u'Odeons Pl.') == u'Odeons Platz'
+    assert normalizer.normalize(u'Am  Krautgarten') == u'Am Krautgarten'
+    assert normalizer.normalize(u'Marienplatz') == u'Marienplatz'
+    assert normalizer.normalize(u'Marienplatz') == u'Marienplatz'
+    assert normalizer.normalize(u'5158') == u'5158'
+    assert normalizer.stats()['hits'] == 1 and normalizer.stats()['cached'] <= 4
+    assert apply_mapping(u'Foo Bar', {u'St': u'Street'}) == u'Foo Bar'
+
+    # osmData.shape cleans the street only
+    import xml.etree.cElementTree as ET
+    import osmData
+    elem = ET.fromstring('<node id="1" lat="48.1" lon="11.5"><tag k="addr:street" v="Alte Str."/>'
+                         '<tag k="addr:housename" v="Alte Str."/></node>')
+    assert osmData.shape(elem)['address'] == {'street': u'Alte Straße', 'housename': 'Alte Str.'}
+
+
+if __name__ == '__main__':
+    test()
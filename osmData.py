@@ -11,14 +11,28 @@ Code auto-format and convention:
     `autopep8 -ai --max-line-length 200'
 '''
 import sys
-import codecs
-import xml.etree.cElementTree as ET
+import audit
 from collections import defaultdict
 import re
 import pprint
-import cerberus
+import fastvalidator
 import schema
+import itertools
+import bboxindex
+import columnar
 import json
+import jsonout
+import multiprocessing
+import normalizer
+import nodeindex
+import nodestore
+import os
+import osmfilter
+import osmstream
+import spatial
+import textindex
+from changeindex import ChangeIndex, tombstone
+from checkpoint import Checkpoint
 
 ''' Input file to be audit, cleaned and shaped into json doc '''
 OSMFILE = "./munich_germany_k10.osm"
@@ -49,56 +63,330 @@ e.g.:
 '''
 expected = ["am", "an", "im", "in", "zu", "bach", "insel", "kreppe", "park", "hof", "winkel", "garten", "wiese", "wald", "markt", "feld"]
 
-''' The unexpected street types to the appropriate ones in the expected list.  The variable 'mapping' to reflect the changes needed to fix. '''
-mapping = {u"St": u"Street", u"Str.": u"Straße", u"Ave": u"Avenue", u"Rd.": u"Road", u"St.": u"Street"}
+''' The unexpected street types to the appropriate ones in the expected list.  The variable 'mapping' to reflect the changes needed to fix.
+It is loaded with the other cleaning rules from normalizer.CLEANING_RULES, e.g. {u"St": u"Street", u"Str.": u"Straße", ...}
+'''
+street_normalizer = normalizer.default_normalizer()
+mapping = street_normalizer.mapping
+
+# street_type_re and expected compiled into one cached matcher, see audit.street_matcher
+is_unexpected = audit.street_matcher(street_type_re, expected)
 
 # structure these attributes into 'created' document
 CREATED = ["version", "changeset", "timestamp", "user", "uid"]
 
+# approximate size of the byte ranges shaped by one worker in parallel mode
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# outputs besides the json file, by routine argument: writer of a path, and the rows a parallel worker collects for
+# it. Both take the shaped documents and the tags of their elements with add(doc, tags), the writer takes the rows
+# of a worker with add_rows.
+STAGES = {
+    'columns': (columnar.ColumnWriter, columnar.Rows),
+    'spatial': (spatial.SpatialWriter, spatial.Rows),
+    'text': (textindex.TextWriter, textindex.Rows),
+}
 
-def routine(osmfile, validate=False, pretty=False):
+
+def routine(osmfile, validate=False, pretty=False, processes=1, chunk_size=CHUNK_SIZE, checkpoint=False, resume=False, index=None,
+            encoder='json', compress=None, shards=1, geometry=False, node_index=None, columns=None,
+            spatial=None, text=None, element_filter=None):
     ''' osm data goes throw a routine for auditing, shaping, validation and final results will be stored in a json file.
     Args:
         osmfile str - osm input file
         validate bool - validate the element against a schema
         pretty bool - line break and indent for output file
+        processes int - number of worker processes, the file is split into chunks and shaped in parallel if > 1
+        chunk_size int - approximate size in bytes of the chunks handed to the workers
+        checkpoint bool - record the progress after every chunk in "<osmfile>.json.checkpoint"
+        resume bool - continue an interrupted checkpointed run instead of starting from byte zero
+        index str - change index file (see changeindex.py): only new and changed elements are written, followed
+            by a tombstone {"id": .., "type": .., "deleted": true} for every element gone since the previous run
+        encoder str - json encoder, 'json', 'ujson', 'orjson' or 'auto' (see jsonout.get_encoder)
+        compress str - None, 'gzip' or 'zstd' to compress the json file(s)
+        shards int - split the output into this many files, e.g. for parallel mongoimport workers (see jsonout.output_paths)
+        geometry bool - keep the node locations in a nodestore.NodeStore and add "node_pos" (a [lat, lon] per node ref,
+            null outside the extract) and "bbox" ([min_lat, min_lon, max_lat, max_lon]) to the ways, and the "bbox"
+            of their members to the relations. Way and relation bboxes are kept on disk, see bboxindex.py
+        node_index str - with geometry, keep the node locations in this memory-mapped file instead (see nodeindex.py),
+            and the bboxes in node_index + ".bbox". Both are built in the pass and reused while they are newer than
+            osmfile. Parallel and checkpointed runs need them, they are built before the chunks are handed out.
+        columns str - also write the main fields of the documents into this directory, for fast repeated queries
+            (see columnar.py)
+        spatial str - also index the node positions and the way and relation bboxes (with geometry) in this file
+            (see spatial.py)
+        text str - also index the words of the names, amenities and addresses in this file, for searches like
+            mongodb $text (see textindex.py)
+        element_filter dict|str|osmfilter.ElementFilter - shape only the elements passing this filter, the others are
+            skipped before they are parsed (see osmfilter.py). With geometry it needs a node_index, the nodes and ways
+            filtered out are still indexed to locate those kept. It cannot be combined with a change index.
     Return:
-        unexpeceted (none match) street names in a dictionary.
+        unexpeceted (none match) street names in a dictionary. With index, of the new and changed elements only, the
+        unchanged ones are skipped before they are audited.
     '''
-    osm_file = codecs.open(osmfile, "r", "utf-8")
+    stages = [(name, path) for name, path in (('columns', columns), ('spatial', spatial), ('text', text)) if path]
+    if index and stages:
+        raise ValueError("columns, spatial and text indexes need all documents, they cannot be written with a change index")
+    if index and element_filter is not None:
+        raise ValueError("a change index needs all elements, the filtered out ones would be written as deleted")
+    element_filter = osmfilter.get_filter(element_filter)
+    if processes > 1 or checkpoint or resume:
+        if index:
+            raise ValueError("a change index can only be used by the serial routine without checkpoints")
+        if geometry and not node_index:
+            raise ValueError("way geometry of parallel or checkpointed runs needs a node_index file")
+        if element_filter is not None and element_filter.ordered:
+            raise ValueError("a bbox filter of ways or relations can only be used by the serial routine without checkpoints")
+        if geometry:
+            build_geometry(osmfile, node_index)
+        return routine_chunked(osmfile, validate, pretty, processes, chunk_size, checkpoint or resume, resume, encoder, compress, shards,
+                               node_index if geometry else None, stages, element_filter.spec if element_filter else None)
+
+    if element_filter is not None and geometry:
+        if not node_index:
+            raise ValueError("way geometry of filtered runs needs a node_index file")
+        # built from all elements, filtered out or not
+        build_geometry(osmfile, node_index)
+
     street_types = defaultdict(set)
 
     file_out = "{0}.json".format(osmfile)
-    validator = cerberus.Validator()
-
-    with codecs.open(file_out, "w", "utf-8") as fo:
-        for event, elem in ET.iterparse(osm_file, events=("start",)):
-            if elem.tag == "node" or elem.tag == "way":
-                # Audit element
-                for tag in elem.iter("tag"):
-                    if is_street_name(tag):
-                        audit_street_type(street_types, tag.attrib['v'])
-                    if is_country_name(tag) and tag.attrib['v'] != "DE":
-                        # All data wihin this area should have county name "DE"
-                        tag.attrib['v'] = "DE"
-
-                # Shape element
-                doc = shape(elem)
-                if doc:
-                    # Validate element
-                    if validate is True:
-                        validate_element(doc, validator)
-
-                    # Write element into a json file
-                    if pretty:
-                        fo.write(json.dumps(doc, indent=2, ensure_ascii=False).encode('utf-8') + "\n")
-                    else:
-                        fo.write(json.dumps(doc) + "\n")
-
-    osm_file.close()
+    validator = fastvalidator.Validator()
+    change_index = ChangeIndex(index) if index else None
+    nodes = None
+    add_nodes = geometry
+    if geometry and node_index:
+        if nodeindex.is_fresh(node_index, osmfile):
+            nodes = nodeindex.NodeIndex.open(node_index)
+            add_nodes = False
+        else:
+            nodes = nodeindex.NodeIndex.create(node_index)
+    elif geometry:
+        nodes = nodestore.NodeStore()
+
+    bboxes = None
+    if geometry:
+        bbox_path = node_index + bboxindex.SUFFIX if node_index else "{0}{1}".format(file_out, bboxindex.SUFFIX)
+        if not add_nodes and bboxindex.is_fresh(bbox_path, osmfile):
+            bboxes = bboxindex.BBoxIndex(bbox_path, read_only=True)
+        else:
+            if os.path.exists(bbox_path):
+                os.remove(bbox_path)
+            bboxes = bboxindex.BBoxIndex(bbox_path)
+
+    writers = [STAGES[name][0](path) for name, path in stages]
+    with jsonout.JsonWriter(file_out, encoder, compress, shards) as fo:
+        if element_filter is not None:
+            elements = element_filter.elements(osmfile)
+        else:
+            elements = osmstream.iter_elements(osmfile, tags=("node", "way", "relation"))
+        for elem in elements:
+            # unchanged nodes are still needed to resolve changed ways; the node index has no slots for the
+            # negative ids of edits not uploaded yet, those nodes stay without location
+            if add_nodes and elem.tag == "node" and (node_index is None or int(elem.attrib['id']) > 0):
+                nodes.add(elem.attrib['id'], float(elem.attrib['lat']), float(elem.attrib['lon']))
+            if change_index and not change_index.check(elem):
+                # as are the bboxes of unchanged ways and relations to resolve changed relations
+                if bboxes is not None and not bboxes.read_only and elem.tag != "node":
+                    bboxindex.add_element(bboxes, elem, nodes)
+                continue
+            line = process_element(elem, street_types, validator, validate, pretty, fo.encode, nodes, bboxes, writers)
+            if line:
+                fo.write_lines(line)
+
+        if change_index:
+            for el_type, el_id in change_index.removed():
+                fo.write(tombstone(el_type, el_id))
+
+    if change_index:
+        change_index.close()
+    for writer in writers:
+        writer.close()
+    if node_index and nodes is not None:
+        nodes.close()
+    if bboxes is not None:
+        bboxes.close()
+        if not node_index:
+            os.remove(bbox_path)
+    return street_types
+
+
+def build_geometry(osmfile, node_index):
+    ''' Build the node index of osmfile and the bbox index next to it, unless they are fresh already. '''
+    nodeindex.build(osmfile, node_index)
+    nodes = nodeindex.NodeIndex.open(node_index)
+    bboxindex.build(osmfile, node_index + bboxindex.SUFFIX, nodes)
+    nodes.close()
+
+
+def routine_chunked(osmfile, validate=False, pretty=False, processes=None, chunk_size=CHUNK_SIZE, checkpoint=False, resume=False,
+                    encoder='json', compress=None, shards=1, node_index=None, stages=(), element_filter=None):
+    ''' Same as routine, but the osm file is split into byte ranges at top level element boundaries which are
+    audited, shaped and encoded one by one, or in a process pool if processes is not 1. Results are merged back in
+    the original order, so the json file is identical to the one of the serial routine.
+
+    With checkpoint, the input offset, the last element id, the json file position and the street types found so
+    far are saved after every chunk. resume reads them back, truncates the json file to the saved position and
+    continues with the next chunk. Checkpoints need a single uncompressed json file, the position in it is saved.
+    Args:
+        processes int - pool size, None for the number of cpus
+        node_index str - complete nodeindex file, next to its complete bboxindex file, to resolve the geometry of ways
+            and relations, None for no geometry
+        stages list - [(name, path)] of the outputs besides the json file (see STAGES), the workers return the rows
+            of their documents for them
+        element_filter dict|str - filter of the elements to shape (see osmfilter.py), compiled by each worker. It must
+            not be ordered, the workers see their chunk only.
+    '''
+    if checkpoint and (compress or shards != 1):
+        raise ValueError("checkpoints cannot be used with compressed or sharded output")
+    if checkpoint and stages:
+        raise ValueError("checkpoints cannot be used with columns, spatial or text indexes")
+
+    street_types = defaultdict(set)
+    file_out = "{0}.json".format(osmfile)
+
+    ckpt = Checkpoint(file_out + ".checkpoint", osmfile)
+    state = ckpt.load() if resume else None
+    if state:
+        for st_type, names in state['result'].iteritems():
+            street_types[st_type].update(names)
+        fo = open(file_out, "r+b")
+        fo.seek(state['outputs'][file_out])
+        fo.truncate()
+        offset = state['offset']
+    elif checkpoint:
+        fo = open(file_out, "wb")
+        offset = 0
+    else:
+        fo = jsonout.JsonWriter(file_out, encoder, compress, shards)
+        offset = 0
+    write = fo.write_lines if isinstance(fo, jsonout.JsonWriter) else fo.write
+
+    stage_names = tuple(name for name, _ in stages)
+    tasks = [(osmfile, start, end, validate, pretty, encoder, node_index, stage_names, element_filter)
+             for start, end in osmstream.chunk_offsets(osmfile, chunk_size, offset)]
+    writers = [STAGES[name][0](path) for name, path in stages]
+
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        with fo:
+            # both keep the chunk order
+            results = pool.imap(process_chunk, tasks) if pool else itertools.imap(process_chunk, tasks)
+            for task, (chunk_types, lines, last_id, stage_rows) in itertools.izip(tasks, results):
+                write(lines)
+                for writer, rows in zip(writers, stage_rows):
+                    writer.add_rows(rows)
+                for st_type, names in chunk_types.iteritems():
+                    street_types[st_type].update(names)
+
+                if checkpoint:
+                    fo.flush()
+                    os.fsync(fo.fileno())
+                    result = dict((st_type, sorted(names)) for st_type, names in street_types.iteritems())
+                    ckpt.save(task[2], last_id, {file_out: fo.tell()}, result)
+        if pool:
+            pool.close()
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+
+    for writer in writers:
+        writer.close()
+    if checkpoint:
+        ckpt.clear()
     return street_types
 
 
+def process_chunk(task):
+    ''' Worker of routine_chunked: audit, shape and encode all elements of a byte range.
+    Args:
+        task (osmfile, start, end, validate, pretty, encoder, node_index, stage names, element filter)
+    Return:
+        (street types of the chunk, json lines of the chunk as one string, id of the last element,
+         rows of the chunk per stage)
+    '''
+    osmfile, start, end, validate, pretty, encoder, node_index, stage_names, element_filter = task
+    street_types = defaultdict(set)
+    validator = fastvalidator.Validator()
+    encode = jsonout.get_encoder(encoder)
+    nodes = nodeindex.shared(node_index) if node_index else None
+    bboxes = bboxindex.shared(node_index + bboxindex.SUFFIX) if node_index else None
+    collectors = [STAGES[name][1]() for name in stage_names]
+
+    lines = []
+    last_id = None
+    if element_filter is not None:
+        elements = osmfilter.ElementFilter(element_filter).elements(osmfile, start, end)
+    else:
+        elements = osmstream.iter_range(osmfile, start, end, tags=("node", "way", "relation"))
+    for elem in elements:
+        line = process_element(elem, street_types, validator, validate, pretty, encode, nodes, bboxes, collectors)
+        if line:
+            lines.append(line)
+        last_id = elem.get("id")
+    return dict(street_types), "".join(lines), last_id, [collector.rows for collector in collectors]
+
+
+def process_element(elem, street_types, validator, validate=False, pretty=False, encode=json.dumps, nodes=None, bboxes=None, stages=()):
+    ''' Audit, clean, shape and validate a single node, way or relation element.
+    Args:
+        encode function - doc -> json text, see jsonout.get_encoder. pretty output always uses the stdlib json.
+        nodes - node locations to resolve the geometry of ways, a NodeStore or NodeIndex, see nodestore.resolve
+        bboxes bboxindex.BBoxIndex - bboxes of ways and relations to resolve relations, the bbox of each way and
+            relation is added to it unless it is read only
+        stages list - writers or worker rows of the outputs besides the json file (see STAGES), the document is added
+            to each
+    Return:
+        the element as a line of json, None if shaping produced nothing.
+    '''
+    doc = audit_and_shape(elem, street_types)
+    if not doc:
+        return None
+
+    if nodes is not None and doc['type'] == "way":
+        doc['node_pos'], bbox = nodestore.resolve(nodes, doc['node_refs'])
+        if bbox:
+            doc['bbox'] = bbox
+    elif nodes is not None and doc['type'] == "relation":
+        bbox = bboxindex.relation_bbox(doc['members'], nodes, bboxes)
+        if bbox:
+            doc['bbox'] = bbox
+    if bboxes is not None and not bboxes.read_only and 'bbox' in doc:
+        bboxes.add(doc['type'], doc['id'], doc['bbox'])
+
+    # Validate element
+    if validate is True:
+        validate_element(doc, validator)
+
+    if stages:
+        # the shaped document keeps the address only
+        tags = dict((tag.attrib['k'], tag.attrib['v']) for tag in elem.iter('tag'))
+        for stage in stages:
+            stage.add(doc, tags)
+
+    if pretty:
+        return json.dumps(doc, indent=2, ensure_ascii=False).encode('utf-8') + "\n"
+    return encode(doc) + "\n"
+
+
+def audit_and_shape(elem, street_types):
+    ''' Audit the street names of the element into street_types, fix its country and shape it. '''
+    # Audit element
+    for tag in elem.iter("tag"):
+        if is_street_name(tag):
+            audit_street_type(street_types, tag.attrib['v'])
+        if is_country_name(tag) and tag.attrib['v'] != "DE":
+            # All data wihin this area should have county name "DE"
+            tag.attrib['v'] = "DE"
+
+    # Shape element
+    return shape(elem)
+
+
 def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
@@ -114,21 +402,19 @@ def audit_street_type(street_types, street_name):
         steet_type - collections.defaultdict
         street_name - string
     '''
-    m = street_type_re.search(street_name)
-    if m is None and isNotExpected(street_name):
+    if is_unexpected(street_name):
         street_types[street_name.rsplit(' ', 1)[-1]].add(street_name)
 
 
-def update_name(name, mapping):
+def update_name(name, mapping=None):
     ''' The function takes a string with street name as an argument and should return the fixed name.
     Args:
         name str - street name to fix
-        mapping {str: str} - dict of name mapping
+        mapping {str: str} - dict of name mapping, None for the memoized mapping and rules of the cleaning rules file
     '''
-    str_type = name.rsplit(' ', 1)
-    if len(str_type) == 2 and str_type[1] in mapping:
-        name = str_type[0] + ' ' + mapping[str_type[1]]
-    return name
+    if mapping is None:
+        return street_normalizer.normalize(name)
+    return normalizer.apply_mapping(name, mapping)
 
 
 def shape(element):
@@ -163,7 +449,7 @@ def shape(element):
     }
 
     In particular the following things have done:
-    - you should process only 2 types of top level tags: "node" and "way"
+    - you should process only 3 types of top level tags: "node", "way" and "relation"
     - all attributes of "node" and "way" should be turned into regular key/value pairs, except:
     - attributes in the CREATED array should be added under a key "created"
     - attributes for latitude and longitude should be added to a "pos" array, for use in geospacial indexing. Make sure the values inside "pos" array are floats and not strings.
@@ -196,6 +482,15 @@ def shape(element):
     should be turned into:
 
     "node_refs": ["305896090", "1719825889"]
+
+    - for "relation" specifically:
+
+    <member type="way" ref="8125151" role="outer"/>
+    <member type="node" ref="261114296" role="admin_centre"/>
+
+    should be turned into:
+
+    "members": [{"type": "way", "ref": "8125151", "role": "outer"}, {"type": "node", "ref": "261114296", "role": "admin_centre"}]
     '''
     node = {}
     node['type'] = element.tag
@@ -228,8 +523,8 @@ def shape(element):
         # put address related infomation in one dictionary
         addrs = key.split('addr:')
         if len(addrs) == 2:
-            # update the street
-            address[addrs[1]] = update_name(value, mapping)
+            # update the street, the other address values are kept as they are
+            address[addrs[1]] = update_name(value) if addrs[1] == 'street' else value
         if bool(address):
             node['address'] = address
 
@@ -239,6 +534,12 @@ def shape(element):
             ndRef.append(nd.attrib.get('ref'))
         node['node_refs'] = ndRef
 
+    if element.tag == "relation":
+        members = []
+        for member in element.iter('member'):
+            members.append({'type': member.attrib.get('type'), 'ref': member.attrib.get('ref'), 'role': member.attrib.get('role')})
+        node['members'] = members
+
     return node
 
 
@@ -264,6 +565,28 @@ def test():
     pprint.pprint(dict(unexpected_st_types))
 
 
+def benchmark(osmfile=OSMFILE, processes=None):
+    ''' Compare the serial and the parallel routine: wall time, speedup and identity of the json output. '''
+    import hashlib
+    import time
+
+    processes = processes or multiprocessing.cpu_count()
+    file_out = "{0}.json".format(osmfile)
+    results = []
+    for n in (1, processes):
+        started = time.time()
+        street_types = routine(osmfile, processes=n)
+        elapsed = time.time() - started
+        with open(file_out, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        results.append((elapsed, digest, dict(street_types)))
+
+    (serial, serial_digest, serial_types), (parallel, parallel_digest, parallel_types) = results
+    print "serial:   {0:.2f}s".format(serial)
+    print "parallel: {0:.2f}s with {1} processes, speedup {2:.2f}x".format(parallel, processes, serial / parallel)
+    print "identical output: {0}".format(serial_digest == parallel_digest and serial_types == parallel_types)
+
+
 if __name__ == '__main__':
     reload(sys)
     sys.setdefaultencoding('utf8')
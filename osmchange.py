@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+'''
+Ingestion of osmChange (.osc) diff files, e.g. the minutely or daily replication diffs.
+
+The create/modify/delete blocks are read with the same streaming parser as full
+extracts (osmstream.iter_changes), created and modified elements go through the
+usual auditing, street name cleaning and shaping of osmData, and the result is
+applied as batched upserts/deletes to
+- the json file written by osmData.routine, see apply_to_json
+- a collection the json file was imported into, see apply_to_collection
+
+Both identify documents by their "type" and "id" fields.
+'''
+import json
+import os
+import re
+import sys
+from collections import defaultdict, OrderedDict
+
+import jsonout
+import mongowriter
+import osmData
+import osmstream
+
+OSCFILE = "./example.osc"
+
+# number of changes applied per rewrite of the json file
+BATCH_SIZE = 100000
+
+# cheap pre-filter of json lines, only lines with one of the changed ids are decoded; any spacing, as the compact
+# output of ujson and orjson has none
+id_re = re.compile(r'"id"\s*:\s*"([^"]*)"')
+
+
+def shape_changes(oscfile, street_types=None):
+    ''' Yield (action, document) for the nodes, ways and relations of an osc file.
+    Args:
+        oscfile str - osmChange input file
+        street_types collections.defaultdict(set) - collects the unexpected street names of created/modified elements
+    Return:
+        generator of (action, doc). Deletions only carry {"id": .., "type": ..}.
+    '''
+    if street_types is None:
+        street_types = defaultdict(set)
+
+    for action, elem in osmstream.iter_changes(oscfile):
+        if elem.tag not in ("node", "way", "relation"):
+            continue
+        if action == "delete":
+            yield action, {"id": elem.get("id"), "type": elem.tag}
+        else:
+            yield action, osmData.audit_and_shape(elem, street_types)
+
+
+def iter_batches(oscfile, batch_size=BATCH_SIZE, stats=None):
+    ''' Group the changes of an osc file into batches.
+    Return:
+        generator of OrderedDict (type, id) -> document, None for a deletion. Within a batch the last change of an
+        element wins.
+    '''
+    batch = OrderedDict()
+    for action, doc in shape_changes(oscfile):
+        key = (doc["type"], doc["id"])
+        batch.pop(key, None)
+        batch[key] = None if action == "delete" else doc
+        if stats is not None:
+            stats[action] += 1
+        if len(batch) >= batch_size:
+            yield batch
+            batch = OrderedDict()
+    if batch:
+        yield batch
+
+
+def apply_to_json(oscfile, jsonfile, batch_size=BATCH_SIZE):
+    ''' Apply an osc file to a json file written by osmData.routine (pretty=False, one document per line).
+
+    Every batch is one pass over the json file: changed documents are replaced in place, deleted ones dropped and
+    documents not found in the file appended at its end. The file is replaced atomically after each pass.
+    Compressed and sharded json output cannot be changed in place, it is refused.
+    Return:
+        number of changes per action.
+    '''
+    if jsonfile.endswith(tuple(suffix for suffix in jsonout.COMPRESSION.values() if suffix)):
+        raise ValueError("{0} is compressed, changes can only be applied to an uncompressed json file".format(jsonfile))
+    if not os.path.exists(jsonfile) and os.path.exists(jsonout.output_paths(jsonfile, shards=2)[0]):
+        raise ValueError("{0} is sharded, changes can only be applied to a single json file".format(jsonfile))
+
+    stats = defaultdict(int)
+    for changes in iter_batches(oscfile, batch_size, stats):
+        _rewrite(jsonfile, changes)
+    return dict(stats)
+
+
+def _rewrite(jsonfile, changes):
+    ids = set(el_id for _, el_id in changes)
+    tmp = jsonfile + ".tmp"
+
+    with open(jsonfile, "rb") as fi, open(tmp, "wb") as fo:
+        for line in fi:
+            if ids.isdisjoint(id_re.findall(line)):
+                fo.write(line)
+                continue
+
+            doc = json.loads(line)
+            key = (doc.get("type"), doc.get("id"))
+            if key not in changes:
+                fo.write(line)
+                continue
+
+            doc = changes.pop(key)
+            if doc is not None:
+                fo.write(json.dumps(doc) + "\n")
+
+        # created elements, and modified ones missing from the file
+        for doc in changes.itervalues():
+            if doc is not None:
+                fo.write(json.dumps(doc) + "\n")
+
+    os.rename(tmp, jsonfile)
+
+
+def apply_to_collection(oscfile, collection, batch_size=mongowriter.BATCH_SIZE):
+    ''' Apply an osc file to a collection holding osmData shaped documents, as ordered batches of upserts and deletes.
+    Return:
+        number of changes per action.
+    '''
+    stats = defaultdict(int)
+    with mongowriter.BulkWriter(collection, batch_size) as writer:
+        for action, doc in shape_changes(oscfile):
+            query = {"type": doc["type"], "id": doc["id"]}
+            if action == "delete":
+                writer.delete(query)
+            else:
+                writer.replace(query, doc)
+            stats[action] += 1
+    return dict(stats)
+
+
+def test():
+    import mongomock
+
+    osmData.routine("example.osm")
+    jsonfile = "example.osm.json"
+    with open(jsonfile, "rb") as f:
+        original = [json.loads(line) for line in f]
+
+    collection = mongomock.MongoClient().da.example
+    collection.insert_many(original)
+
+    stats = apply_to_json(OSCFILE, jsonfile, batch_size=2)
+    assert stats == {"create": 2, "modify": 2, "delete": 2}
+    with open(jsonfile, "rb") as f:
+        docs = dict((doc["id"], doc) for doc in (json.loads(line) for line in f))
+    os.remove(jsonfile)
+
+    apply_to_collection(OSCFILE, collection, batch_size=2)
+    assert collection.count_documents({}) == len(docs) == len(original)
+
+    for by_id in [docs, dict((doc["id"], doc) for doc in collection.find({}, {"_id": False}))]:
+        assert "261114296" not in by_id and "3000000002" not in by_id
+        assert by_id["261114295"]["created"]["version"] == "8"
+        assert by_id["261114295"]["address"]["street"] == "North Lincoln Street"
+        assert by_id["3000000001"]["address"] == {"street": "West Lawrence Avenue", "country": "DE"}
+        assert len(by_id["258219703"]["node_refs"]) == 5
+
+    # compact json, as written by the ujson and orjson encoders
+    with open(jsonfile, "wb") as f:
+        for doc in original:
+            doc.pop("_id", None)
+            f.write(json.dumps(doc, separators=(",", ":")) + "\n")
+    apply_to_json(OSCFILE, jsonfile)
+    with open(jsonfile, "rb") as f:
+        compact = [json.loads(line) for line in f]
+    os.remove(jsonfile)
+    assert len(compact) == len(original) and dict((doc["id"], doc) for doc in compact) == docs
+
+    shard = jsonout.output_paths(jsonfile, shards=2)[0]
+    open(shard, "wb").close()
+    for refused in (jsonfile + ".gz", jsonfile):
+        try:
+            apply_to_json(OSCFILE, refused)
+        except ValueError:
+            continue
+        raise AssertionError("changed {0}".format(refused))
+    os.remove(shard)
+
+
+if __name__ == '__main__':
+    reload(sys)
+    sys.setdefaultencoding('utf8')
+    test()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+Filters selecting the osm elements worth shaping, tested on the raw bytes of
+the input (see osmstream.RawElement) before any element tree is built: the
+elements filtered out, e.g. the untagged nodes of the way geometries, are only
+scanned, never parsed, shaped or written.
+
+A filter is a dict, or the same written as a string of space separated terms:
+
+    {'tags': ['amenity', 'addr:*', 'cuisine=italian|pizza'],     any of them
+     'not_tags': ['disused'],                                     none of them
+     'types': ['node', 'way'],
+     'bbox': [min_lat, min_lon, max_lat, max_lon],
+     'users': ['uboot'], 'uids': [26299], 'changesets': [5288876]}
+
+    "amenity addr:* cuisine=italian|pizza -disused @type=node,way @bbox=48.1,11.5,48.2,11.6 @user=uboot"
+
+A tag is "key", "prefix*" for any key starting with prefix, or "key=v1|v2"
+for some of its values. Every part is optional, those given must all match.
+The string form cannot hold spaces in values, use the dict for those.
+
+Nodes are in the bbox by their position, ways if one of their nodes is, and
+relations if one of their node or way members is. Ways and relations are
+tested against the elements before them in the file, so a bbox filter of ways
+or relations needs the whole file in one pass (see ElementFilter.ordered).
+
+    osmData.routine(osmfile, element_filter="amenity addr:*")
+    data.process_map(file_in, validate, element_filter={'tags': ['amenity']})
+    sampling.writeSample(area, 1, element_filter="@type=node @bbox=48.1,11.5,48.2,11.6")
+'''
+import re
+
+import osmstream
+from idset import IdSet
+
+TYPES = osmstream.TOP_LEVEL
+KEYS = ('tags', 'not_tags', 'types', 'bbox', 'users', 'uids', 'changesets')
+
+# terms of the string form besides tags, by the key of the dict form they fill
+ATTRIBUTE_TERMS = {'@type': 'types', '@bbox': 'bbox', '@user': 'users', '@uid': 'uids', '@changeset': 'changesets'}
+
+
+def parse(text):
+    ''' Filter dict of the string form, see the module doc. '''
+    spec = {}
+    for term in text.split():
+        if term.startswith('@'):
+            name, _, value = term.partition('=')
+            if name not in ATTRIBUTE_TERMS or not value:
+                raise ValueError("unknown filter term {0}".format(term))
+            key = ATTRIBUTE_TERMS[name]
+            if key == 'bbox':
+                spec[key] = [float(v) for v in value.split(',')]
+            elif key == 'types':
+                spec[key] = value.split(',')
+            else:
+                spec.setdefault(key, []).extend(value.split('|'))
+        elif term.startswith('-') and len(term) > 1:
+            spec.setdefault('not_tags', []).append(term[1:])
+        else:
+            spec.setdefault('tags', []).append(term)
+    return spec
+
+
+def utf8(value):
+    ''' Raw attributes are utf-8 encoded str. '''
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+def tag_test(text):
+    ''' (key, prefix, values) of a tag of a filter, values None for any value. '''
+    key, equals, values = utf8(text).partition('=')
+    prefix = key.endswith('*')
+    if prefix:
+        key = key[:-1]
+    return key, prefix, frozenset(values.split('|')) if equals else None
+
+
+def key_re(tests):
+    ''' Regex finding a k attribute of one of the keys of tag_tests in raw bytes, the quick test before parsing tags. '''
+    keys = [re.escape(key) + ('' if prefix else '["\']') for key, prefix, _ in tests]
+    return re.compile('k=["\'](?:{0})'.format('|'.join(keys)))
+
+
+def has_tag(tags, (key, prefix, values)):
+    ''' True if the {k: v} tags of an element pass a tag_test. '''
+    if prefix:
+        return any(k.startswith(key) and (values is None or v in values) for k, v in tags.iteritems())
+    return key in tags and (values is None or tags[key] in values)
+
+
+class ElementFilter(object):
+    ''' A filter (dict or string, see the module doc) compiled into tests on osmstream.RawElement.
+    seen and kept count the elements it was asked about and those it accepted.
+    '''
+
+    def __init__(self, spec):
+        if isinstance(spec, basestring):
+            spec = parse(spec)
+        unknown = set(spec) - set(KEYS)
+        if unknown:
+            raise ValueError("unknown filter keys {0}".format(sorted(unknown)))
+        self.spec = spec
+
+        self.types = frozenset(spec.get('types') or TYPES)
+        if not self.types <= set(TYPES):
+            raise ValueError("filter types must be in {0}".format(TYPES))
+        self.tags = [tag_test(t) for t in spec.get('tags') or ()]
+        self.not_tags = [tag_test(t) for t in spec.get('not_tags') or ()]
+        self._tags_re = key_re(self.tags) if self.tags else None
+        self._not_tags_re = key_re(self.not_tags) if self.not_tags else None
+        self.attributes = [(name, frozenset(utf8(v) for v in spec[key]))
+                           for name, key in (('user', 'users'), ('uid', 'uids'), ('changeset', 'changesets')) if spec.get(key)]
+
+        self.bbox = spec.get('bbox')
+        if self.bbox is not None and len(self.bbox) != 4:
+            raise ValueError("filter bbox must be [min_lat, min_lon, max_lat, max_lon]")
+        # elements to read: the bbox of ways needs all nodes, of relations all ways
+        self.scan = TYPES if self.bbox is not None else tuple(t for t in TYPES if t in self.types)
+        self.ordered = self.bbox is not None and self.types != frozenset(['node'])
+        # ids of the nodes and ways in the bbox, for the ways and relations after them
+        self._nodes = IdSet() if self.ordered else None
+        self._ways = IdSet() if self.ordered else None
+
+        self.seen = 0
+        self.kept = 0
+
+    def match(self, element):
+        ''' True if the raw element passes the filter. '''
+        self.seen += 1
+        if self.bbox is not None and not self._in_bbox(element):
+            return False
+        if element.tag not in self.types:
+            return False
+        for name, values in self.attributes:
+            if element.get(name) not in values:
+                return False
+        # most elements lack the keys, their tags are not parsed
+        if self._tags_re is not None and not element.search(self._tags_re):
+            return False
+        excluded = self._not_tags_re is not None and element.search(self._not_tags_re)
+        if self.tags or excluded:
+            tags = element.tags()
+            if self.tags and not any(has_tag(tags, test) for test in self.tags):
+                return False
+            if excluded and any(has_tag(tags, test) for test in self.not_tags):
+                return False
+        self.kept += 1
+        return True
+
+    def _in_bbox(self, element):
+        if element.tag == 'node':
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            inside = min_lat <= float(element.get('lat')) <= max_lat and min_lon <= float(element.get('lon')) <= max_lon
+            if inside and self._nodes is not None:
+                self._nodes.add(element.get('id'))
+            return inside
+        if self._nodes is None:
+            return False
+        if element.tag == 'way':
+            inside = any(ref in self._nodes for ref in element.refs())
+            if inside:
+                self._ways.add(element.get('id'))
+            return inside
+        return any((m_type == 'node' and ref in self._nodes) or (m_type == 'way' and ref in self._ways)
+                   for m_type, ref, _ in element.members())
+
+    def select(self, elements):
+        ''' The raw elements passing the filter. '''
+        for element in elements:
+            if self.match(element):
+                yield element
+
+    def elements(self, osm_file, start=0, end=None):
+        ''' The elements of osm_file passing the filter, parsed into element trees like osmstream.iter_elements.
+        Args:
+            osm_file str - osm input file name, may be compressed unless a byte range is given
+            start, end int - byte range of the uncompressed file (see osmstream.chunk_offsets), None for all of it
+        '''
+        if end is None:
+            raw = osmstream.iter_raw(osm_file, self.scan)
+        else:
+            raw = osmstream.iter_mapped(osm_file, self.scan, start, end)
+        for element in self.select(raw):
+            yield element.parse()
+
+    def report(self):
+        return "kept {0} of {1} elements".format(self.kept, self.seen)
+
+
+def get_filter(element_filter):
+    ''' ElementFilter of a filter dict or string, None for no filter; an ElementFilter is returned as it is. '''
+    if element_filter is None or isinstance(element_filter, ElementFilter):
+        return element_filter
+    return ElementFilter(element_filter)
+
+
+def benchmark(osmfile, element_filter="amenity addr:*"):
+    ''' Shape osmfile with osmData.routine without and with the filter: elements per second and json size. '''
+    import os
+    import time
+    import osmData
+
+    file_out = "{0}.json".format(osmfile)
+    count = sum(1 for _ in osmstream.iter_raw(osmfile))
+    started = time.time()
+    osmData.routine(osmfile)
+    full_time = time.time() - started
+    full_size = os.path.getsize(file_out)
+
+    element_filter = ElementFilter(element_filter)
+    started = time.time()
+    osmData.routine(osmfile, element_filter=element_filter)
+    filtered_time = time.time() - started
+    filtered_size = os.path.getsize(file_out)
+
+    print "all elements: {0:.2f}s, {1:.0f} elements/s, {2:.1f} MB json".format(full_time, count / full_time, full_size / 1e6)
+    print "{0!r}: {1:.2f}s, {2:.0f} elements/s, {3:.1f} MB json, {4}".format(
+        element_filter.spec, filtered_time, count / filtered_time, filtered_size / 1e6, element_filter.report())
+    print "speedup {0:.1f}x, output {1:.1%} smaller".format(full_time / filtered_time, 1 - float(filtered_size) / full_size)
+
+
+def test():
+    assert parse("amenity addr:* cuisine=italian|pizza -disused @type=node,way @bbox=1,2,3,4 @user=a|b @uid=7") == {
+        'tags': ['amenity', 'addr:*', 'cuisine=italian|pizza'], 'not_tags': ['disused'], 'types': ['node', 'way'],
+        'bbox': [1.0, 2.0, 3.0, 4.0], 'users': ['a', 'b'], 'uids': ['7']}
+    assert tag_test(u'cuisine=italian|pizza') == ('cuisine', False, frozenset(['italian', 'pizza']))
+    assert has_tag({'addr:street': 'x'}, tag_test('addr:*')) and not has_tag({'addr': 'x'}, tag_test('addr:*'))
+    pattern = key_re([tag_test('addr:*'), tag_test('name')])
+    assert pattern.search('<tag k="addr:city"') and pattern.search("<tag k='name'") and not pattern.search('<tag k="name:de"')
+
+    def ids(spec):
+        return [elem.get('id') for elem in ElementFilter(spec).elements('example.osm')]
+
+    assert ids("amenity") == ['757860928']
+    assert ids("highway") == ['261221424', '258219703']
+    assert ids("highway @type=way") == ids({'tags': ['highway'], 'types': ['way']}) == ['258219703']
+    assert ids("highway -highway=traffic_signals") == ids("highway=residential|tertiary|secondary|primary|unclassified|service")
+    assert ids("cuisine=sausage") == ['757860928'] and ids("cuisine=pizza") == []
+    assert ids("@uid=26299") == ids({'users': [u'uboot']}) and ids("@uid=26299")
+    assert ids("@changeset=-1") == []
+
+    bbox = [41.97, -87.69, 41.98, -87.68]
+    element_filter = ElementFilter({'bbox': bbox})
+    assert element_filter.ordered
+    kept = list(element_filter.elements('example.osm'))
+    nodes = set(elem.get('id') for elem in kept if elem.tag == 'node')
+    assert nodes and all(bbox[1] <= float(elem.get('lon')) <= bbox[3] for elem in kept if elem.tag == 'node')
+    assert all(nodes & set(nd.get('ref') for nd in elem.iter('nd')) for elem in kept if elem.tag == 'way')
+    assert element_filter.seen == 22 and element_filter.kept == len(kept)
+    assert not ElementFilter({'bbox': bbox, 'types': ['node']}).ordered
+
+    # the byte range of the whole file yields the same elements
+    with open('example.osm', 'rb') as f:
+        end = osmstream.document_end(f)
+    start, _ = osmstream.chunk_offsets('example.osm', 1 << 20)[0]
+    assert [elem.get('id') for elem in ElementFilter("highway").elements('example.osm', start, end)] == ids("highway")
+
+    for bad in ("@colour=red", {'type': ['node']}, {'types': ['area']}, {'bbox': [1, 2]}):
+        try:
+            ElementFilter(bad)
+        except ValueError:
+            continue
+        raise AssertionError("accepted {0!r}".format(bad))
+
+
+if __name__ == '__main__':
+    test()
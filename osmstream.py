@@ -0,0 +1,674 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming access to open street map xml files.
+
+Top level elements (node, way, relation) are yielded once they are completely
+built, i.e. on their 'end' event, and are detached from the document root as
+soon as the consumer asks for the next one. Nothing accumulates in the tree, so
+memory use stays flat no matter how large the input file is.
+
+Input files may be compressed (.bz2, .gz, .zst), see open_osm: they are
+decompressed on the fly in a background thread, or by lbzip2/pbzip2 on all
+cores when one of them is installed, without a temporary decompressed copy.
+Byte range access (chunk_offsets, RangeFile) needs an uncompressed file.
+
+Shared by:
+- osmData.routine
+- audit.audit
+- tags.process_map
+- users.process_map
+'''
+import bz2
+import gzip
+import mmap
+import os
+import re
+import resource
+import subprocess
+import threading
+import Queue
+import xml.etree.cElementTree as ET
+from contextlib import closing
+from distutils.spawn import find_executable
+from xml.sax.saxutils import unescape
+
+TOP_LEVEL = ('node', 'way', 'relation')
+
+# Opening tag of a top level element. Osm files never nest these tags and escape '<' in attribute values.
+top_level_re = re.compile(r'<(?:node|way|relation)[\s/>]')
+
+SCAN_SIZE = 1 << 20
+
+# attributes of an opening tag, nd and member references of a raw element
+attr_re = re.compile(r'([\w:]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# inside of a tag up to its closing '>', which may appear unescaped in quoted attribute values
+TAG_BODY = r'(?:[^"\'>]+|"[^"]*"|\'[^\']*\')*'
+head_re = re.compile(r'<\w+' + TAG_BODY + '>')
+nd_ref_re = re.compile(r'<nd\s[^>]*?ref\s*=\s*["\'](-?\d+)')
+member_re = re.compile(r'<member\s' + TAG_BODY + '>')
+tag_re = re.compile(r'<tag\s' + TAG_BODY + '>')
+
+XML_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+COMPRESSED = ('.bz2', '.gz', '.zst')
+
+# decompressed data is handed to the parser in blocks of BLOCK_SIZE, at most READ_AHEAD blocks ahead
+BLOCK_SIZE = 1 << 20
+READ_AHEAD = 32
+
+# parallel bzip2 decompressors, tried in this order
+PARALLEL_BZIP2 = ('lbzip2', 'pbzip2')
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED)
+
+
+def open_osm(path, threaded=True, parallel=True):
+    ''' Open an osm or osc file for reading, decompressing .bz2, .gz and .zst files on the fly.
+    Args:
+        path str - input file
+        threaded bool - decompress in a background thread, ahead of the parser
+        parallel bool - decompress .bz2 files with lbzip2 or pbzip2 if one is installed
+    Return:
+        file like object with read() and close()
+    '''
+    if not is_compressed(path):
+        return open(path, 'rb')
+
+    if path.endswith('.bz2'):
+        program = parallel and next((p for p in map(find_executable, PARALLEL_BZIP2) if p), None)
+        if program:
+            return PipeReader([program, '-dc', path])
+        raw = MultiStreamBZ2File(path)
+    elif path.endswith('.gz'):
+        raw = gzip.open(path, 'rb')
+    else:
+        try:
+            import zstandard
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        except ImportError:
+            program = find_executable('zstd')
+            if program is None:
+                raise ImportError("reading {0} needs the zstandard package or the zstd program".format(path))
+            return PipeReader([program, '-dc', path])
+
+    return ThreadedReader(raw) if threaded else raw
+
+
+class MultiStreamBZ2File(object):
+    ''' Reader of .bz2 files made of several concatenated streams, as written by pbzip2 / lbzip2 for the planet
+    files. bz2.BZ2File of python 2 silently stops after the first stream.
+    '''
+
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buf = ''
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._buf[self._pos:]]
+            self._buf, self._pos = '', 0
+            while self._fill():
+                chunks.append(self._buf)
+            self._buf = ''
+            return ''.join(chunks)
+
+        if self._pos >= len(self._buf) and not self._fill():
+            return ''
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def _fill(self):
+        ''' Replace the buffer by the next decompressed data, False at the end of the file. '''
+        chunks = []
+        while not chunks:
+            data = self._f.read(BLOCK_SIZE)
+            if not data:
+                self._buf, self._pos = '', 0
+                return False
+            while data:
+                try:
+                    out = self._decompressor.decompress(data)
+                except EOFError:
+                    # the previous stream ended exactly at the end of the last read
+                    self._decompressor = bz2.BZ2Decompressor()
+                    continue
+                if out:
+                    chunks.append(out)
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = bz2.BZ2Decompressor()
+        self._buf, self._pos = ''.join(chunks), 0
+        return True
+
+    def close(self):
+        self._f.close()
+
+
+class ThreadedReader(object):
+    ''' Read a file object in a background thread, up to READ_AHEAD blocks ahead of the consumer.
+
+    Decompression (bz2, zlib) releases the GIL, so it overlaps with parsing in the main thread.
+    '''
+
+    def __init__(self, raw, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD):
+        self._raw = raw
+        self._block_size = block_size
+        self._queue = Queue.Queue(read_ahead)
+        self._stop = threading.Event()
+        self._error = None
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                data = self._raw.read(self._block_size)
+                self._queue.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._error = e
+            self._queue.put('')
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._buf):
+                if self._eof:
+                    break
+                self._buf = self._queue.get()
+                self._pos = 0
+                if not self._buf:
+                    self._eof = True
+                    if self._error is not None:
+                        raise self._error
+                    break
+
+            end = len(self._buf) if size < 0 else min(len(self._buf), self._pos + size)
+            chunks.append(self._buf[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return ''.join(chunks)
+
+    def close(self):
+        self._stop.set()
+        # unblock the reader thread if it waits for room in the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                self._thread.join(0.01)
+        self._raw.close()
+
+
+class PipeReader(object):
+    ''' Read the standard output of a decompressor program, e.g. lbzip2 -dc file.osm.bz2 '''
+
+    def __init__(self, args):
+        self._process = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.stdout.close()
+        self._process.wait()
+
+
+def iter_elements(osm_file, tags=TOP_LEVEL):
+    ''' Yield fully built top level elements of the osm file.
+    Args:
+        osm_file str|file - osm input file name or file object opened in binary mode
+        tags tuple - top level tag names to yield, None yields every top level element
+    Return:
+        generator of xml.etree.cElementTree.Element
+
+    The element and everything parsed before it are cleared from the root once the
+    consumer moves on, so keep a reference only if the element is needed later.
+    '''
+    if isinstance(osm_file, basestring):
+        with closing(open_osm(osm_file)) as f:
+            for elem in iter_elements(f, tags=tags):
+                yield elem
+        return
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 0:
+            if tags is None or elem.tag in tags:
+                yield elem
+            # elem is a direct child of root, clearing the root releases it and its preceding siblings
+            root.clear()
+
+
+def iter_changes(osc_file):
+    ''' Yield (action, element) for every top level element of an osmChange (.osc) file.
+    Args:
+        osc_file str|file - osc input file name or file object opened in binary mode
+    Return:
+        generator of (action, xml.etree.cElementTree.Element), action is "create", "modify" or "delete".
+
+    Like iter_elements, elements are released as soon as the consumer moves on.
+    '''
+    if isinstance(osc_file, basestring):
+        with closing(open_osm(osc_file)) as f:
+            for change in iter_changes(f):
+                yield change
+        return
+
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+
+    depth = 0
+    block = None
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                block = elem
+            continue
+
+        depth -= 1
+        if depth == 1 and elem.tag in TOP_LEVEL:
+            yield block.tag, elem
+            # the action block is still being filled by the parser, release what it holds so far
+            block.clear()
+        elif depth == 0:
+            root.clear()
+
+
+class Visitor(object):
+    ''' Base of the analyses run together by run_visitors.
+    Subclasses set tags to the top level element types they look at (None for all) and implement visit and result.
+    '''
+    tags = None
+
+    def visit(self, elem):
+        ''' Look at one fully parsed top level element, it is cleared afterwards. '''
+        raise NotImplementedError
+
+    def result(self):
+        ''' The report of the analysis once every element was visited. '''
+        raise NotImplementedError
+
+
+def run_visitors(osm_file, visitors):
+    ''' Stream osm_file once and hand every top level element to each visitor interested in its type.
+    Return:
+        list of the visitor results, in the order of visitors.
+    '''
+    for elem in iter_elements(osm_file, tags=None):
+        for visitor in visitors:
+            if visitor.tags is None or elem.tag in visitor.tags:
+                visitor.visit(elem)
+    return [visitor.result() for visitor in visitors]
+
+
+class RawElement(object):
+    ''' A top level element as the bytes it takes in the osm file, for copying it verbatim.
+
+    The element is a range of a buffer (a block of the stream, or the memory-mapped file) and is not copied out of
+    it unless data is asked for. get parses only the attribute asked for, refs, members and tags scan the range.
+    '''
+    __slots__ = ('tag', 'buf', 'start', 'end', '_head_end', '_attrib')
+
+    def __init__(self, tag, buf, start=0, end=None):
+        self.tag = tag
+        # from its opening '<' up to the next top level element, i.e. with the whitespace after it
+        self.buf = buf
+        self.start = start
+        self.end = len(buf) if end is None else end
+        self._head_end = None
+        self._attrib = None
+
+    @property
+    def data(self):
+        return self.buf[self.start:self.end]
+
+    def copy(self):
+        ''' The element on its own bytes, e.g. to keep it without keeping the block it was read from. '''
+        return RawElement(self.tag, self.data)
+
+    def parse(self):
+        ''' The element as an xml.etree.cElementTree.Element, like iter_elements yields it. '''
+        return ET.fromstring(self.data)
+
+    def _head(self):
+        if self._head_end is None:
+            m = head_re.match(self.buf, self.start, self.end)
+            self._head_end = m.end() - 1 if m else self.end
+        return self._head_end
+
+    @property
+    def attrib(self):
+        if self._attrib is None:
+            self._attrib = _attributes(self.buf[self.start:self._head()])
+        return self._attrib
+
+    def get(self, name, default=None):
+        if self._attrib is not None:
+            return self._attrib.get(name, default)
+        m = _attribute_re(name).search(self.buf, self.start, self._head())
+        if m is None:
+            return default
+        value = m.group(1) if m.group(1) is not None else m.group(2)
+        return unescape(value, XML_ENTITIES) if '&' in value else value
+
+    def refs(self):
+        ''' Node ids of the nd elements of a way. '''
+        return nd_ref_re.findall(self.buf, self.start, self.end)
+
+    def members(self):
+        ''' [(type, ref, role)] of the members of a relation. '''
+        members = []
+        for m in member_re.finditer(self.buf, self.start, self.end):
+            attrib = _attributes(m.group())
+            members.append((attrib.get('type'), attrib.get('ref'), attrib.get('role')))
+        return members
+
+    def has_tag_key(self, key):
+        ''' Quick test for a tag key, without parsing the tags; may be fooled by a value containing k="key". '''
+        return self.buf.find('k="{0}"'.format(key), self.start, self.end) >= 0 or \
+            self.buf.find("k='{0}'".format(key), self.start, self.end) >= 0
+
+    def search(self, pattern):
+        ''' pattern.search over the bytes of the element. '''
+        return pattern.search(self.buf, self.start, self.end)
+
+    def tags(self):
+        ''' {k: v} of the tag elements. '''
+        tags = {}
+        for m in tag_re.finditer(self.buf, self.start, self.end):
+            attrib = _attributes(m.group())
+            if 'k' in attrib:
+                tags[attrib['k']] = attrib.get('v')
+        return tags
+
+
+def _attributes(text):
+    attrib = {}
+    for name, double, single in attr_re.findall(text):
+        value = double or single
+        attrib[name] = unescape(value, XML_ENTITIES) if '&' in value else value
+    return attrib
+
+
+_attribute_res = {}
+
+
+def _attribute_re(name):
+    if name not in _attribute_res:
+        _attribute_res[name] = re.compile(r'\s{0}\s*=\s*(?:"([^"]*)"|\'([^\']*)\')'.format(re.escape(name)))
+    return _attribute_res[name]
+
+
+def iter_raw(osm_file, tags=TOP_LEVEL, block_size=BLOCK_SIZE):
+    ''' Yield the top level elements of the osm file as RawElement, without parsing them into element trees.
+
+    An uncompressed file given by name is memory-mapped and scanned in place (see iter_mapped), other input is read
+    in blocks of block_size.
+    Args:
+        osm_file str|file - osm input file name (may be compressed, see open_osm) or file object
+        tags tuple - top level tag names to yield
+    '''
+    if isinstance(osm_file, basestring):
+        if not is_compressed(osm_file):
+            for elem in iter_mapped(osm_file, tags):
+                yield elem
+            return
+        with closing(open_osm(osm_file)) as f:
+            for elem in iter_raw(f, tags, block_size):
+                yield elem
+        return
+
+    buf = ''
+    while True:
+        data = osm_file.read(block_size)
+        buf += data
+        starts = list(top_level_re.finditer(buf))
+        if not data:
+            break
+        # the last element may continue in the next block
+        for m, nxt in zip(starts, starts[1:]):
+            tag = m.group()[1:-1]
+            if tag in tags:
+                yield RawElement(tag, buf, m.start(), nxt.start())
+        buf = buf[starts[-1].start():] if starts else buf[-16:]
+
+    if starts:
+        end = buf.rfind('</osm>')
+        end = end if end >= 0 else len(buf)
+        for m, nxt in zip(starts, starts[1:] + [None]):
+            tag = m.group()[1:-1]
+            if tag in tags:
+                yield RawElement(tag, buf, m.start(), nxt.start() if nxt else end)
+
+
+def iter_mapped(osm_path, tags=TOP_LEVEL, start=0, end=None):
+    ''' iter_raw of an uncompressed file: the elements are ranges of the memory-mapped file, nothing is read into
+    memory but what the consumer looks at.
+    Args:
+        start, end int - byte range to scan, e.g. a chunk of chunk_offsets; None for up to the closing </osm> tag
+    '''
+    with open(osm_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        if end is None:
+            end = document_end(f)
+        # not closed here, elements kept by the consumer still read from it; unmapped once they are all gone
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    previous = None
+    for m in top_level_re.finditer(mapped, start, end):
+        if previous is not None:
+            yield RawElement(previous[0], mapped, previous[1], m.start())
+        tag = m.group()[1:-1]
+        previous = (tag, m.start()) if tag in tags else None
+    if previous is not None:
+        yield RawElement(previous[0], mapped, previous[1], end)
+
+
+class RangeFile(object):
+    ''' Read-only file object exposing the byte range [start, end) of an osm file as a standalone document.
+
+    The range must start and end at top level element boundaries (see find_boundary), it is wrapped into
+    an <osm> root element so that iter_elements can parse it on its own.
+    '''
+
+    def __init__(self, osm_path, start, end):
+        self._f = open(osm_path, 'rb')
+        self._f.seek(start)
+        self._left = end - start
+        self._head = '<osm>'
+        self._tail = '</osm>'
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._left + len(self._head) + len(self._tail)
+
+        data = self._head[:size]
+        self._head = self._head[len(data):]
+        size -= len(data)
+
+        if size > 0 and self._left > 0:
+            body = self._f.read(min(size, self._left))
+            self._left -= len(body)
+            size -= len(body)
+            data += body
+
+        if size > 0 and self._left == 0:
+            tail, self._tail = self._tail[:size], self._tail[size:]
+            data += tail
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+def find_boundary(f, offset):
+    ''' Byte offset of the first top level element starting at or after offset, None if there is none.
+    Args:
+        f file - osm file opened in binary mode
+        offset int - byte offset to start scanning from
+    '''
+    f.seek(offset)
+    # Keep a small overlap between reads so a tag split across two reads is still found
+    overlap = 16
+    buf = ''
+    pos = offset
+    while True:
+        data = f.read(SCAN_SIZE)
+        if not data:
+            return None
+        buf = buf[-overlap:] + data
+        m = top_level_re.search(buf)
+        if m:
+            return pos - (len(buf) - len(data)) + m.start()
+        pos += len(data)
+
+
+def document_end(f):
+    ''' Byte offset of the closing </osm> tag. '''
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 4096))
+    tail = f.read()
+    return size - len(tail) + tail.rindex('</osm>')
+
+
+def chunk_offsets(osm_path, chunk_size, offset=0):
+    ''' Split the osm file into byte ranges which start and end at top level element boundaries.
+    Args:
+        osm_path str - uncompressed osm input file
+        chunk_size int - approximate size of each range in bytes
+        offset int - skip everything before this byte offset
+    Return:
+        list of (start, end) tuples covering every top level node/way/relation after offset in file order.
+    '''
+    if is_compressed(osm_path):
+        raise ValueError("{0} is compressed, splitting it into byte ranges needs the uncompressed file".format(osm_path))
+    with open(osm_path, 'rb') as f:
+        end = document_end(f)
+        start = find_boundary(f, offset)
+        if start is None or start >= end:
+            return []
+
+        offsets = []
+        while True:
+            nxt = find_boundary(f, start + chunk_size) if start + chunk_size < end else None
+            if nxt is None or nxt >= end:
+                offsets.append((start, end))
+                return offsets
+            offsets.append((start, nxt))
+            start = nxt
+
+
+def iter_range(osm_path, start, end, tags=TOP_LEVEL):
+    ''' Yield the top level elements inside the byte range [start, end) of the osm file. '''
+    range_file = RangeFile(osm_path, start, end)
+    try:
+        for elem in iter_elements(range_file, tags=tags):
+            yield elem
+    finally:
+        range_file.close()
+
+
+def peak_rss():
+    ''' Peak resident set size of this process in kilobytes. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(compressed_path):
+    ''' Parse a compressed osm file once by decompressing it to disk first, once by streaming it, and print the
+    throughput of both in MB of uncompressed xml per second.
+    '''
+    import shutil
+    import tempfile
+    import time
+
+    results = []
+
+    started = time.time()
+    tmp = tempfile.NamedTemporaryFile(suffix='.osm', delete=False)
+    with closing(open_osm(compressed_path, threaded=False, parallel=False)) as f:
+        shutil.copyfileobj(f, tmp, BLOCK_SIZE)
+    tmp.close()
+    size = os.path.getsize(tmp.name)
+    count = sum(1 for _ in iter_elements(tmp.name))
+    results.append(('decompress, then parse', time.time() - started))
+    os.remove(tmp.name)
+
+    for name, threaded, parallel in [('stream', False, False), ('stream, background thread', True, False), ('stream, parallel bzip2', True, True)]:
+        started = time.time()
+        with closing(open_osm(compressed_path, threaded, parallel)) as f:
+            assert sum(1 for _ in iter_elements(f)) == count
+        results.append((name, time.time() - started))
+
+    for name, elapsed in results:
+        print "{0:28} {1:6.2f}s {2:6.1f} MB/s".format(name, elapsed, size / elapsed / 1e6)
+
+
+def test():
+    counts = {}
+    for elem in iter_elements('example.osm', tags=None):
+        counts[elem.tag] = counts.get(elem.tag, 0) + 1
+    assert counts == {'bounds': 1, 'node': 20, 'way': 1, 'relation': 1}
+
+    way = next(iter_elements('example.osm', tags=('way',)))
+    assert len(way.findall('nd')) == 4
+    ids = [elem.get('id') for elem in iter_elements('example.osm')]
+    chunked = [elem.get('id') for start, end in chunk_offsets('example.osm', 512) for elem in iter_range('example.osm', start, end)]
+    assert chunked == ids
+
+    with open('example.osm', 'rb') as f:
+        raw = list(iter_raw(f, block_size=100))
+    assert [elem.get('id') for elem in raw] == ids
+    mapped = list(iter_raw('example.osm'))
+    assert [(elem.tag, elem.data) for elem in mapped] == [(elem.tag, elem.data) for elem in raw]
+    assert [elem.attrib for elem in mapped] == [elem.attrib for elem in raw]
+    assert mapped[0].get('user') == raw[0].attrib['user'] and mapped[0].get('missing') is None
+    assert [elem.get('id') for elem in iter_raw('example.osm', tags=('way', 'relation'))] == ids[-2:]
+    assert raw[-1].data.endswith('</relation>\n') and raw[0].data.startswith('<node ')
+    way = [elem for elem in raw if elem.tag == 'way'][0]
+    assert way.refs() == [nd.get('ref') for nd in next(iter_elements('example.osm', tags=('way',))).iter('nd')]
+
+    # '>' may appear unescaped in attribute values
+    elem = RawElement('node', '<node id="1" user="a>b" lat="48.1" lon=\'11.5\'>\n  <tag k="note" v="x > y"/>\n'
+                              '  <member type="way" ref="2" role="a>b"/>\n</node>\n')
+    assert elem.get('lat') == '48.1' and elem.get('lon') == '11.5' and elem.attrib['user'] == 'a>b'
+    assert elem.tags() == {'note': 'x > y'} and elem.members() == [('way', '2', 'a>b')]
+
+    import tempfile
+    for ext, compress in [('.bz2', bz2.BZ2File), ('.gz', gzip.open)]:
+        path = os.path.join(tempfile.mkdtemp(), 'example.osm' + ext)
+        with open('example.osm', 'rb') as src, closing(compress(path, 'wb')) as dst:
+            dst.write(src.read())
+        assert [elem.get('id') for elem in iter_elements(path)] == ids
+        os.remove(path)
+
+    print "peak rss: {0} kB".format(peak_rss())
+
+
+if __name__ == '__main__':
+    test()
@@ -26,6 +26,7 @@ examples, your results will be different.
 """
 
 import pprint
+import aggregation
 
 def get_db(db_name):
     from pymongo import MongoClient
@@ -55,9 +56,8 @@ def aggregate(db, pipeline):
     return result
 
 if __name__ == '__main__':
-    db = get_db('examples')
-    pipeline = make_pipeline()
-    result = aggregate(db, pipeline)
+    # --local [file]: run the pipeline in process over a file of city documents
+    result = aggregation.main(make_pipeline, lambda pipeline: aggregate(get_db('examples'), pipeline))
     print "OK"
     #assert len(result["result"]) == 1
     #assert result["result"][0]["avg"] == 196025.97814809752
@@ -0,0 +1,103 @@
+'''
+Profile of a new extract in a single pass over the osm file.
+
+The analyses of the exploration scripts are visitors (see osmstream.Visitor)
+over one shared element stream, so the file is parsed and decompressed once
+instead of once per script:
+
+    tag_counts      mapparser.TagCounter    count of every tag
+    key_types       tags.KeyTypeCounter     lower / lower_colon / problemchars / other tag keys
+    users           users.UserCollector     distinct users of the nodes
+    street_types    audit.StreetAuditor     unexpected street names by street type
+    street_matches  reunicode.StreetMatcher street_type_re match of every street name
+    distinct_users  users.DistinctUserCounter number of distinct users and uids
+    tag_stats       tags.TagStats           most frequent tag keys, amenities and street suffixes
+
+With approximate=True the reports whose size grows with the input are replaced
+by fixed memory sketches (see sketches.py): users and street_matches are left
+out, distinct_users uses HyperLogLog and tag_stats Count-Min / Space-Saving.
+'''
+import pprint
+import sys
+from collections import OrderedDict
+
+import audit
+import mapparser
+import osmstream
+import reunicode
+import tags
+import users
+
+OSMFILE = "./munich_germany_k10.osm"
+
+
+def visitors(approximate=False):
+    ''' Fresh visitors of all analyses, by report name. '''
+    analyses = [
+        ('tag_counts', mapparser.TagCounter()),
+        ('key_types', tags.KeyTypeCounter()),
+        ('street_types', audit.StreetAuditor()),
+        ('distinct_users', users.DistinctUserCounter(approximate)),
+        ('tag_stats', tags.TagStats(approximate)),
+    ]
+    if not approximate:
+        analyses.insert(2, ('users', users.UserCollector()))
+        analyses.insert(4, ('street_matches', reunicode.StreetMatcher()))
+    return OrderedDict(analyses)
+
+
+def profile(osmfile, names=None, approximate=False):
+    ''' Run the analyses in one pass over osmfile.
+    Args:
+        names list - report names to compute, all if None
+        approximate bool - fixed memory sketches instead of exact sets and counters
+    Return:
+        OrderedDict report name -> result
+    '''
+    selected = [(name, visitor) for name, visitor in visitors(approximate).iteritems() if names is None or name in names]
+    results = osmstream.run_visitors(osmfile, [visitor for _, visitor in selected])
+    return OrderedDict((name, result) for (name, _), result in zip(selected, results))
+
+
+def benchmark(osmfile=OSMFILE):
+    ''' Time one pass per analysis against the fused pass and check both give the same reports. '''
+    import time
+
+    separate = OrderedDict()
+    started = time.time()
+    for name, visitor in visitors().iteritems():
+        separate[name] = osmstream.run_visitors(osmfile, [visitor])[0]
+    separate_time = time.time() - started
+
+    started = time.time()
+    fused = profile(osmfile)
+    fused_time = time.time() - started
+
+    print "{0} passes: {1:.2f}s".format(len(separate), separate_time)
+    print "1 pass:     {0:.2f}s, {1:.2f}x faster".format(fused_time, separate_time / fused_time)
+    print "same reports: {0}".format(separate == fused)
+
+
+def test():
+    reports = profile('example.osm')
+    assert reports['tag_counts'] == mapparser.count_tags('example.osm')
+    assert reports['key_types'] == tags.process_map('example.osm')
+    assert reports['users'] == users.process_map('example.osm')
+    assert reports['street_types'] == audit.audit('example.osm')
+    assert profile('example.osm', ['users']).keys() == ['users']
+    assert reports['distinct_users'] == {'user': 6, 'uid': 6}
+
+    approximate = profile('example.osm', approximate=True)
+    assert 'users' not in approximate
+    assert approximate['distinct_users'] == reports['distinct_users']
+    assert approximate['tag_stats'] == reports['tag_stats']
+
+
+if __name__ == '__main__':
+    reload(sys)
+    sys.setdefaultencoding('utf8')
+    approximate = '--approximate' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--approximate']
+    for name, report in profile(args[0] if args else OSMFILE, approximate=approximate).iteritems():
+        print name
+        pprint.pprint(dict(report) if isinstance(report, dict) else report)
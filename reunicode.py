@@ -1,8 +1,7 @@
 # coding=utf-8
 import re
 import sys
-import xml.etree.cElementTree as ET
-import codecs
+import osmstream
 
 street_type_re = re.compile(
     ur'(\s|-)?(straße|weg|ring|platz|allee)$',
@@ -16,23 +15,31 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 
+class StreetMatcher(osmstream.Visitor):
+    ''' street_type_re match of every street name, as printable lines. '''
+    tags = ("node", "way")
+
+    def __init__(self):
+        self.lines = []
+
+    def visit(self, elem):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                s = tag.attrib['v']
+                # s = "aaastraße"
+                m = street_type_re.search(s)
+                if m is None:
+                    self.lines.append(s)
+                else:
+                    self.lines.append('<string: %r, start=%r, end=%r, match=%r>' % (m.string, m.start(), m.end(), m.group()))
+
+    def result(self):
+        return self.lines
+
+
 def test():
-    osm_file = codecs.open(
-        './munich_germany_k10.osm',
-        mode='r',
-        encoding='utf-8')
-
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    s = tag.attrib['v']
-                    # s = "aaastraße"
-                    m = street_type_re.search(s)
-                    if m is None:
-                        print s
-                    else:
-                        print '<string: %r, start=%r, end=%r, match=%r>' % (m.string, m.start(), m.end(), m.group())
+    for line in osmstream.run_visitors('./munich_germany_k10.osm', [StreetMatcher()])[0]:
+        print line
 
 
 if __name__ == '__main__':
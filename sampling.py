@@ -1,4 +1,26 @@
+"""Samples of an osm file, for developing against a small extract.
+
+Sampling modes of writeSample:
+   kth         every k-th top level element (the original sample)
+   reservoir   k top level elements drawn uniformly at random, in file order
+   bbox        the nodes inside a bbox, the ways and relations referencing them, and the
+               nodes outside the bbox those ways and relations reference
+   closed      every k-th way and relation, plus every node they reference, so that no
+               way of the sample points to a missing node
+
+Kept elements are copied byte by byte from the input (see osmstream.iter_raw)
+instead of being parsed into element trees and serialized again; select() filters them by
+id or tag key the same way.
+"""
+import random
 import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+from contextlib import closing
+
+import osmfilter
+import osmstream
+from idset import IdSet
+
+MODES = ('kth', 'reservoir', 'bbox', 'closed')
 
 def get_element(osm_file, tags=('node', 'way', 'relation')):
    """Yield element if it is the right type of tag
@@ -6,27 +28,265 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
    Reference:
    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
    """
-   context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-   _, root = next(context)
-   for event, elem in context:
-      if event == 'end' and elem.tag in tags:
-         yield elem
-         root.clear()
+   with closing(osmstream.open_osm(osm_file)) as f:
+      context = iter(ET.iterparse(f, events=('start', 'end')))
+      _, root = next(context)
+      for event, elem in context:
+         if event == 'end' and elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+def every_kth(elements, k):
+   for i, element in enumerate(elements):
+      if i % k == 0:
+         yield element
+
+
+def reservoir(elements, k, seed=None):
+   """k raw elements drawn uniformly at random (Algorithm R), in file order."""
+   rnd = random.Random(seed)
+   kept = []
+   for i, element in enumerate(elements):
+      # a copy, not to keep the whole block the element was read from
+      if i < k:
+         kept.append((i, element.copy()))
+      else:
+         j = rnd.randint(0, i)
+         if j < k:
+            kept[j] = (i, element.copy())
+   kept.sort(key=lambda (i, element): i)
+   return [element for _, element in kept]
+
+
+def in_bbox(elements, bbox):
+   """Nodes inside bbox [min_lat, min_lon, max_lat, max_lon], and the ways and relations
+   with a member kept before them.
+   """
+   min_lat, min_lon, max_lat, max_lon = bbox
+   kept = {'node': IdSet(), 'way': IdSet(), 'relation': IdSet()}
+   for element in elements:
+      if element.tag == 'node':
+         inside = min_lat <= float(element.get('lat')) <= max_lat and min_lon <= float(element.get('lon')) <= max_lon
+      elif element.tag == 'way':
+         inside = any(ref in kept['node'] for ref in element.refs())
+      else:
+         inside = any(m_type in kept and ref in kept[m_type] for m_type, ref, _ in element.members())
+      if inside:
+         kept[element.tag].add(element.get('id'))
+         yield element
+
+
+def bbox_closed(osm_file, bbox, elements=None):
+   """The elements of in_bbox and the nodes outside bbox that its ways and relations reference,
+   in two passes over osm_file like closed: the first one selects among elements (all of
+   osm_file by default, e.g. those passing a filter), the second one copies the selected
+   elements and the referenced nodes.
+   """
+   if elements is None:
+      elements = osmstream.iter_raw(osm_file)
+
+   kept = {'node': IdSet(), 'way': IdSet(), 'relation': IdSet()}
+   for element in in_bbox(elements, bbox):
+      kept[element.tag].add(element.get('id'))
+      if element.tag == 'way':
+         for ref in element.refs():
+            kept['node'].add(ref)
+      elif element.tag == 'relation':
+         for m_type, ref, _ in element.members():
+            if m_type == 'node':
+               kept['node'].add(ref)
+
+   for element in osmstream.iter_raw(osm_file):
+      if element.get('id') in kept[element.tag]:
+         yield element
+
+
+def closed(osm_file, k, element_filter=None):
+   """Every k-th way and relation and all nodes they reference, in two passes over osm_file:
+   the first one selects the ways and relations and collects their node ids, the second
+   one copies the selected elements. With element_filter (an osmfilter.ElementFilter) the
+   ways and relations are selected among those passing it, their nodes are kept anyway.
+   """
+   if element_filter is None:
+      elements = osmstream.iter_raw(osm_file, tags=('way', 'relation'))
+   else:
+      elements = (e for e in element_filter.select(osmstream.iter_raw(osm_file, element_filter.scan)) if e.tag != 'node')
+
+   ways = IdSet()
+   relations = IdSet()
+   nodes = IdSet()
+   for i, element in enumerate(elements):
+      if i % k:
+         continue
+      if element.tag == 'way':
+         ways.add(element.get('id'))
+         for ref in element.refs():
+            nodes.add(ref)
+      else:
+         relations.add(element.get('id'))
+         for m_type, ref, _ in element.members():
+            if m_type == 'node':
+               nodes.add(ref)
+
+   kept = {'node': nodes, 'way': ways, 'relation': relations}
+   for element in osmstream.iter_raw(osm_file):
+      if element.get('id') in kept[element.tag]:
+         yield element
+
 
+def select(elements, ids=None, tag_keys=None):
+   """Raw elements whose id is in ids, or with a tag of one of tag_keys; the bytes of the
+   element are searched for the key before its tags are parsed.
+   """
+   for element in elements:
+      if ids is not None and element.get('id') in ids:
+         yield element
+      elif tag_keys and any(element.has_tag_key(key) for key in tag_keys):
+         keys = element.tags()
+         if any(key in keys for key in tag_keys):
+            yield element
 
-def writeSample(area, k):
-   OSM_FILE = area + ".osm"  # Replace this with your osm file
-   SAMPLE_FILE = area + "_k" + str(k) + ".osm"
 
-   with open(SAMPLE_FILE, 'wb') as output:
+def write_raw(path, elements):
+   """Write the bytes of raw elements (see osmstream.RawElement) into an osm document."""
+   with open(path, 'wb') as output:
       output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
       output.write('<osm>\n  ')
+      for element in elements:
+         output.write(element.data)
+      output.write('</osm>\n')
+   return path
+
+
+def writeSample(area, k, ext=".osm", mode='kth', bbox=None, seed=None, element_filter=None):
+   """Write a sample of area + ext.
+   Args:
+      k int - every k-th element ('kth', 'closed'), number of elements ('reservoir')
+      ext str - may name a compressed input, e.g. ".osm.bz2"
+      mode str - one of MODES, see the module doc
+      bbox list - [min_lat, min_lon, max_lat, max_lon] of the 'bbox' mode
+      seed - random seed of the 'reservoir' mode
+      element_filter - sample only the elements passing this filter (dict, string or
+         osmfilter.ElementFilter, see osmfilter.py)
+   Return:
+      the name of the sample file, area + "_k10.osm" for every 10th element; "_r", "_c" and
+      "_bbox" for the other modes
+   """
+   if mode not in MODES:
+      raise ValueError("unknown sampling mode {0}".format(mode))
+   if mode == 'bbox' and (bbox is None or len(bbox) != 4):
+      raise ValueError("the bbox mode needs bbox [min_lat, min_lon, max_lat, max_lon]")
+   if mode != 'bbox' and k < 1:
+      raise ValueError("k must be at least 1, got {0}".format(k))
+
+   OSM_FILE = area + ext  # Replace this with your osm file
+   element_filter = osmfilter.get_filter(element_filter)
+   if element_filter is None:
+      raw = osmstream.iter_raw(OSM_FILE)
+   else:
+      raw = element_filter.select(osmstream.iter_raw(OSM_FILE, element_filter.scan))
+
+   if mode == 'kth':
+      SAMPLE_FILE = area + "_k" + str(k) + ".osm"
+      elements = every_kth(raw, k)
+   elif mode == 'reservoir':
+      SAMPLE_FILE = area + "_r" + str(k) + ".osm"
+      elements = reservoir(raw, k, seed)
+   elif mode == 'bbox':
+      SAMPLE_FILE = area + "_bbox.osm"
+      elements = bbox_closed(OSM_FILE, bbox, raw)
+   elif mode == 'closed':
+      SAMPLE_FILE = area + "_c" + str(k) + ".osm"
+      elements = closed(OSM_FILE, k, element_filter)
 
-      # Write every kth top level element
-      for i, element in enumerate(get_element(OSM_FILE)):
+   return write_raw(SAMPLE_FILE, elements)
+
+
+def benchmark(area, k=10, ext=".osm"):
+   """Time the kth sample with re-serialized elements against raw copies, and the other modes."""
+   import os
+   import time
+
+   started = time.time()
+   path = area + "_k" + str(k) + ".tostring.osm"
+   with open(path, 'wb') as output:
+      output.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n  ')
+      for i, element in enumerate(get_element(area + ext)):
          if i % k == 0:
             output.write(ET.tostring(element, encoding='utf-8'))
-
       output.write('</osm>')
+   print "kth, ET.tostring: {0:.2f}s".format(time.time() - started)
+   os.remove(path)
+
+   started = time.time()
+   found = sum(1 for element in get_element(area + ext) if any(tag.get('k') == 'amenity' for tag in element.iter('tag')))
+   print "amenity filter, iterparse: {0:.2f}s, {1} elements".format(time.time() - started, found)
+   started = time.time()
+   found = sum(1 for _ in select(osmstream.iter_raw(area + ext), tag_keys=('amenity',)))
+   print "amenity filter, raw: {0:.2f}s, {1} elements".format(time.time() - started, found)
+
+   for mode, n in (('kth', k), ('reservoir', 1000), ('closed', k)):
+      started = time.time()
+      path = writeSample(area, n, ext, mode, seed=1)
+      print "{0}, raw copy: {1:.2f}s, {2:.1f} MB".format(mode, time.time() - started, os.path.getsize(path) / 1e6)
+      os.remove(path)
+
+
+def test():
+   import os
+   import shutil
+   import tempfile
+
+   directory = tempfile.mkdtemp()
+   area = os.path.join(directory, 'example')
+   shutil.copy('example.osm', area + '.osm')
+   ids = [element.get('id') for element in osmstream.iter_elements('example.osm')]
+
+   sample = writeSample(area, 3)
+   assert [element.get('id') for element in osmstream.iter_elements(sample)] == ids[::3]
+   sample = writeSample(area, 5, mode='reservoir', seed=1)
+   kept = [element.get('id') for element in osmstream.iter_elements(sample)]
+   assert len(kept) == 5 and kept == [i for i in ids if i in kept]
+
+   # the way and the relation of example.osm, with those of their nodes the extract holds
+   sample = writeSample(area, 1, mode='closed')
+   way = next(osmstream.iter_elements(sample, tags=('way',)))
+   nodes = set(element.get('id') for element in osmstream.iter_elements(sample, tags=('node',)))
+   referenced = set(nd.get('ref') for nd in way.iter('nd')) | set(['1258927212'])
+   assert nodes == referenced & set(ids)
+   sample = writeSample(area, 2, mode='closed')
+   assert [element.tag for element in osmstream.iter_elements(sample)] == ['way']
+
+   sample = writeSample(area, 1, mode='bbox', bbox=[41.97, -87.69, 41.98, -87.68])
+   elements = list(osmstream.iter_elements(sample))
+   assert elements and all(-87.69 <= float(e.get('lon')) <= -87.68 for e in elements if e.tag == 'node')
+
+   # the nodes outside the bbox of a kept way or relation are kept too, others are not
+   with open(area + '_nodes.osm', 'w') as f:
+      f.write('<osm>\n <node id="1" lat="1.5" lon="1.5"/>\n <node id="2" lat="5" lon="5"/>\n'
+              ' <node id="3" lat="6" lon="6"/>\n <node id="4" lat="7" lon="7"/>\n'
+              ' <way id="10"><nd ref="1"/><nd ref="2"/></way>\n'
+              ' <relation id="20"><member type="way" ref="10" role=""/><member type="node" ref="3" role=""/></relation>\n</osm>\n')
+   sample = writeSample(area + '_nodes', 1, mode='bbox', bbox=[1, 1, 2, 2])
+   assert [(e.tag, e.get('id')) for e in osmstream.iter_elements(sample)] == [
+      ('node', '1'), ('node', '2'), ('node', '3'), ('way', '10'), ('relation', '20')]
+
+   raw = osmstream.iter_raw('example.osm')
+   assert [element.get('id') for element in select(raw, ids=set(ids[:2]), tag_keys=('highway',))] == ids[:2] + ['261221424', '258219703']
+
+   sample = writeSample(area, 1, element_filter="highway")
+   assert [element.get('id') for element in osmstream.iter_elements(sample)] == ['261221424', '258219703']
+   sample = writeSample(area, 1, mode='closed', element_filter="highway")
+   assert [element.tag for element in osmstream.iter_elements(sample)].count('way') == 1
+   for mode, k in (('bbox', 1), ('kth', 0), ('closed', 0), ('area', 1)):
+      try:
+         writeSample(area, k, mode=mode)
+      except ValueError:
+         continue
+      raise AssertionError("sampled {0} with k={1}".format(mode, k))
+   shutil.rmtree(directory)
+
 
-   return SAMPLE_FILE
+if __name__ == '__main__':
+   test()
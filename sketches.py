@@ -0,0 +1,233 @@
+'''
+Fixed memory statistics for profiling very large extracts.
+
+Distinct counts and frequency counts come in an exact and an approximate
+flavour with the same interface, so an analysis picks one by a flag:
+
+    distinct(approximate, error)        add(item), count()
+        ExactDistinct   set of all items
+        HyperLogLog     2^p registers of one byte, relative standard error ~1.04/sqrt(2^p)
+
+    frequencies(approximate, ...)       add(item, n=1), estimate(item), top(n)
+        ExactCounter    collections.Counter
+        ApproxCounter   Count-Min sketch for point estimates, overestimating by at most epsilon * total with
+                        probability 1 - delta, plus Space-Saving for the k most frequent items
+
+Items are str or unicode, unicode is hashed as utf-8.
+'''
+import hashlib
+import heapq
+import math
+import struct
+from array import array
+from collections import Counter
+
+# defaults of the approximate mode
+HLL_ERROR = 0.01
+CMS_EPSILON = 0.0001
+CMS_DELTA = 0.01
+TOP_K = 100
+
+
+def _hash64(item):
+    ''' Two independent 64 bit hashes of item. '''
+    if isinstance(item, unicode):
+        item = item.encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(item).digest())
+
+
+def distinct(approximate=False, error=HLL_ERROR):
+    return HyperLogLog(error) if approximate else ExactDistinct()
+
+
+def frequencies(approximate=False, k=TOP_K, epsilon=CMS_EPSILON, delta=CMS_DELTA):
+    return ApproxCounter(k, epsilon, delta) if approximate else ExactCounter()
+
+
+class ExactDistinct(object):
+
+    def __init__(self):
+        self.items = set()
+
+    def add(self, item):
+        self.items.add(item)
+
+    def count(self):
+        return len(self.items)
+
+
+class HyperLogLog(object):
+    ''' Approximate number of distinct items.
+    Args:
+        error float - wanted relative standard error, e.g. 0.01 takes 16 KB of registers
+    '''
+
+    def __init__(self, error=HLL_ERROR):
+        self.p = min(18, max(4, int(math.ceil(math.log((1.04 / error) ** 2, 2)))))
+        self.m = 1 << self.p
+        self.registers = bytearray(self.m)
+        self._rest_bits = 64 - self.p
+
+        if self.m >= 128:
+            self._alpha = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            self._alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.m]
+
+    def add(self, item):
+        h = _hash64(item)[0]
+        index = h >> self._rest_bits
+        rest = h & ((1 << self._rest_bits) - 1)
+        # position of the leftmost 1 bit in the remaining bits
+        rank = self._rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        estimate = self._alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * self.m and zeros:
+            # small range correction, linear counting
+            return int(round(self.m * math.log(float(self.m) / zeros)))
+        return int(round(estimate))
+
+
+class ExactCounter(object):
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, item, n=1):
+        self.counts[item] += n
+
+    def estimate(self, item):
+        return self.counts[item]
+
+    def top(self, n=TOP_K):
+        ''' [(item, count)] by descending count, ties by item. '''
+        return sorted(self.counts.iteritems(), key=lambda (item, count): (-count, item))[:n]
+
+
+class CountMinSketch(object):
+    ''' Frequency estimates, never below the true count and above it by at most epsilon * total with probability
+    1 - delta. Memory is ceil(e / epsilon) * ceil(ln(1 / delta)) counters.
+    '''
+
+    def __init__(self, epsilon=CMS_EPSILON, delta=CMS_DELTA):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.rows = [array('L', [0]) * self.width for _ in xrange(self.depth)]
+        self.total = 0
+
+    def _columns(self, item):
+        h1, h2 = _hash64(item)
+        return [(h1 + i * h2) % self.width for i in xrange(self.depth)]
+
+    def add(self, item, n=1):
+        ''' Count item n more times and return its new estimate. '''
+        self.total += n
+        estimate = None
+        for row, column in zip(self.rows, self._columns(item)):
+            row[column] += n
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, item):
+        return min(row[column] for row, column in zip(self.rows, self._columns(item)))
+
+
+class SpaceSaving(object):
+    ''' The k most frequent items with at most k counters (Metwally et al.).
+
+    Every item with a frequency above total / k is kept. A counter overestimates its item by at most the count it
+    inherited when it replaced the least frequent one, which is kept as its error.
+    '''
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.counters = {}
+        # (count, item) of the counters, entries are outdated once the counter grew; rebuilt when too long
+        self._heap = []
+
+    def add(self, item, n=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += n
+        elif len(self.counters) < self.k:
+            counter = self.counters[item] = [n, 0]
+        else:
+            count, victim = self._pop_min()
+            del self.counters[victim]
+            counter = self.counters[item] = [count + n, count]
+
+        heapq.heappush(self._heap, (counter[0], item))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c[0], i) for i, c in self.counters.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters.get(item)
+            if counter is not None and counter[0] == count:
+                return count, item
+
+    def top(self, n=TOP_K):
+        ''' [(item, count, error)] by descending count. '''
+        ranked = sorted(self.counters.iteritems(), key=lambda (item, c): (-c[0], item))
+        return [(item, c[0], c[1]) for item, c in ranked[:n]]
+
+
+class ApproxCounter(object):
+    ''' Count-Min estimates for any item, Space-Saving for the top k. '''
+
+    def __init__(self, k=TOP_K, epsilon=CMS_EPSILON, delta=CMS_DELTA):
+        self.sketch = CountMinSketch(epsilon, delta)
+        self.heavy = SpaceSaving(k)
+
+    def add(self, item, n=1):
+        self.sketch.add(item, n)
+        self.heavy.add(item, n)
+
+    def estimate(self, item):
+        return self.sketch.estimate(item)
+
+    def top(self, n=TOP_K):
+        ''' The top items of Space-Saving, with the tighter of both estimates. '''
+        return [(item, min(count, self.sketch.estimate(item))) for item, count, _ in self.heavy.top(n)]
+
+
+def test():
+    import random
+
+    rnd = random.Random(1)
+    items = ['user%d' % rnd.randint(0, 49999) for _ in xrange(100000)]
+    exact = len(set(items))
+    hll = distinct(True, error=0.01)
+    for item in items:
+        hll.add(item)
+    assert abs(hll.count() - exact) < 0.04 * exact
+
+    small = distinct(True)
+    for item in [u'M\xfcller', 'a', 'b', 'a']:
+        small.add(item)
+    assert small.count() == 3
+
+    # zipf like frequencies
+    words = ['key%d' % int(rnd.paretovariate(1.2)) for _ in xrange(50000)]
+    truth = Counter(words)
+    approx = frequencies(True, k=20, epsilon=0.001, delta=0.01)
+    for word in words:
+        approx.add(word)
+    assert [item for item, _ in approx.top(5)] == [item for item, _ in truth.most_common(5)]
+    for item, count in truth.most_common(50):
+        assert count <= approx.estimate(item) <= count + 0.001 * len(words) * 2
+
+    exact_counter = frequencies()
+    for word in words:
+        exact_counter.add(word)
+    assert [count for _, count in exact_counter.top(5)] == [count for _, count in truth.most_common(5)]
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,426 @@
+'''
+Grid index of the positions of the shaped documents, for bounding box, radius
+and nearest neighbour queries without scanning all of them.
+
+osmData.routine(..., spatial=path) indexes the "pos" of every node and the
+"bbox" of the ways and relations (with geometry, see nodestore.py), together
+with their amenity (from the element tags, the shaped documents do not keep
+it), into a uniform grid of CELL_SIZE degrees:
+
+    index = SpatialIndex("munich.osm.spatial")
+    index.bbox(48.13, 11.56, 48.15, 11.59)             [(type, id)]
+    index.radius(48.137, 11.575, 500, amenity='cafe')   [(meters, type, id)] nearest first
+    index.nearest(48.137, 11.575, k=5)                  [(meters, type, id)] nearest first
+
+The file holds a directory of the non empty cells (sorted cell keys and the
+start of their postings), the postings (entry numbers of each cell) and the
+entries (type, amenity, id, bbox). Opening it reads the directory only, the
+postings and entries are read from the memory-mapped file as queries touch
+them. Bboxes spanning more than MAX_CELLS cells are kept in a separate list
+checked by every query instead of in all their cells.
+
+Distances are great circle distances in meters; a bbox is as far as its
+nearest point.
+'''
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
+from array import array
+
+CELL_SIZE = 0.01
+MAX_CELLS = 256
+
+MAGIC = 'SPATIDX1'
+# magic, cell size, number of entries, cells, postings, large entries
+HEADER = struct.Struct('<8sdQQQQ')
+# type, amenity code + 1 (0 for none), id, min_lat, min_lon, max_lat, max_lon
+ENTRY = struct.Struct('<BIq4d')
+TYPES = ('node', 'way', 'relation')
+
+# 'l' is 64 bit on the platforms this runs on, see nodestore.py
+KEY_TYPE = 'l'
+POSTING_TYPE = 'I'
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    ''' Great circle distance in meters. '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bbox_distance(lat, lon, bbox):
+    ''' Meters from a point to the nearest point of [min_lat, min_lon, max_lat, max_lon]. '''
+    return distance(lat, lon, min(max(lat, bbox[0]), bbox[2]), min(max(lon, bbox[1]), bbox[3]))
+
+
+def entry(doc, tags=None):
+    ''' (type, id, amenity, bbox) of a shaped document, None if it has no position.
+    Args:
+        tags dict - tags of the osm element, for the amenity the shaped document does not keep
+    '''
+    if doc['type'] == 'node':
+        bbox = doc['pos'] * 2
+    elif 'bbox' in doc:
+        bbox = doc['bbox']
+    else:
+        return None
+    return doc['type'], int(doc['id']), doc.get('amenity', (tags or {}).get('amenity')), bbox
+
+
+class Rows(object):
+    ''' Entries of documents collected by a worker of the parallel routine, added to a SpatialWriter by the parent. '''
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, doc, tags=None):
+        values = entry(doc, tags)
+        if values:
+            self.rows.append(values)
+
+
+class Grid(object):
+    ''' Cell keys of a grid of cell_size degrees, row by row from -90/-180. '''
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.rows = int(math.ceil(180 / cell_size))
+        self.cols = int(math.ceil(360 / cell_size))
+
+    def cell(self, lat, lon):
+        ''' (row, col) of a point, clamped to the grid. '''
+        row = min(max(int((lat + 90) / self.cell_size), 0), self.rows - 1)
+        col = min(max(int((lon + 180) / self.cell_size), 0), self.cols - 1)
+        return row, col
+
+    def key(self, row, col):
+        return row * self.cols + col
+
+
+class SpatialWriter(object):
+    ''' Collects the entries of the documents added to it and writes the index file on close.
+    Use it as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, path, cell_size=CELL_SIZE):
+        self.path = path
+        self.grid = Grid(cell_size)
+        self._entries = []
+        self._amenities = {}
+        # cell key -> entry numbers
+        self._cells = {}
+        self._large = array(POSTING_TYPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, doc, tags=None):
+        values = entry(doc, tags)
+        if values:
+            self.add_row(values)
+
+    def add_rows(self, rows):
+        for values in rows:
+            self.add_row(values)
+
+    def add_row(self, values):
+        el_type, el_id, amenity, bbox = values
+        amenity_code = 0
+        if amenity is not None:
+            amenity_code = self._amenities.setdefault(amenity, len(self._amenities) + 1)
+        number = len(self._entries)
+        self._entries.append(ENTRY.pack(TYPES.index(el_type), amenity_code, el_id, *bbox))
+
+        row0, col0 = self.grid.cell(bbox[0], bbox[1])
+        row1, col1 = self.grid.cell(bbox[2], bbox[3])
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_CELLS:
+            self._large.append(number)
+            return
+        for row in xrange(row0, row1 + 1):
+            for col in xrange(col0, col1 + 1):
+                key = self.grid.key(row, col)
+                postings = self._cells.get(key)
+                if postings is None:
+                    postings = self._cells[key] = array(POSTING_TYPE)
+                postings.append(number)
+
+    def close(self):
+        ''' Write the index, replacing path at once so that readers never see a partial file. '''
+        if self._entries is None:
+            return
+        keys = array(KEY_TYPE, sorted(self._cells))
+        starts = array(KEY_TYPE, [0])
+        postings = array(POSTING_TYPE)
+        for key in keys:
+            postings.extend(self._cells[key])
+            starts.append(len(postings))
+
+        amenities = sorted(self._amenities, key=self._amenities.get)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.grid.cell_size, len(self._entries), len(keys), len(postings), len(self._large)))
+            keys.tofile(f)
+            starts.tofile(f)
+            postings.tofile(f)
+            self._large.tofile(f)
+            f.write(''.join(self._entries))
+            json.dump(amenities, f)
+        os.rename(tmp_path, self.path)
+        self._entries = self._cells = None
+
+
+class SpatialIndex(object):
+    ''' Read only queries over an index file written by SpatialWriter.
+    The queries take optional filters: el_type 'node', 'way' or 'relation', amenity a value of the amenity tag.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, cell_size, self.count, n_cells, n_postings, n_large = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a spatial index".format(path))
+        self.grid = Grid(cell_size)
+
+        offset = HEADER.size
+        self._keys, offset = self._read(KEY_TYPE, offset, n_cells)
+        self._starts, offset = self._read(KEY_TYPE, offset, n_cells + 1)
+        self._postings_offset = offset
+        offset += n_postings * array(POSTING_TYPE).itemsize
+        self._large, offset = self._read(POSTING_TYPE, offset, n_large)
+        self._entries_offset = offset
+        self._amenities = json.loads(self._map[offset + self.count * ENTRY.size:])
+        # rows and columns of the non empty cells, see nearest
+        self._extent = None
+
+    def _read(self, typecode, offset, n):
+        values = array(typecode)
+        end = offset + n * values.itemsize
+        values.fromstring(self._map[offset:end])
+        return values, end
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, number):
+        ''' (type, id, amenity, bbox) of an entry. '''
+        type_code, amenity_code, el_id, min_lat, min_lon, max_lat, max_lon = ENTRY.unpack_from(
+            self._map, self._entries_offset + number * ENTRY.size)
+        amenity = self._amenities[amenity_code - 1] if amenity_code else None
+        return TYPES[type_code], el_id, amenity, (min_lat, min_lon, max_lat, max_lon)
+
+    def _cell_postings(self, i):
+        ''' Entry numbers of the i-th non empty cell. '''
+        itemsize = array(POSTING_TYPE).itemsize
+        start = self._postings_offset + self._starts[i] * itemsize
+        end = self._postings_offset + self._starts[i + 1] * itemsize
+        return array(POSTING_TYPE, self._map[start:end])
+
+    def _row_cells(self, row, col0, col1):
+        ''' Numbers of the non empty cells of a row between two columns. '''
+        if row < 0 or row >= self.grid.rows:
+            return xrange(0)
+        lo = bisect.bisect_left(self._keys, self.grid.key(row, max(col0, 0)))
+        hi = bisect.bisect_right(self._keys, self.grid.key(row, min(col1, self.grid.cols - 1)))
+        return xrange(lo, hi)
+
+    def _candidates(self, cells, seen):
+        ''' Entries of the given cells not in seen, seen is updated. '''
+        for i in cells:
+            for number in self._cell_postings(i):
+                if number not in seen:
+                    seen.add(number)
+                    yield self._entry(number)
+
+    def _large_entries(self, seen):
+        seen.update(self._large)
+        return [self._entry(number) for number in self._large]
+
+    def _area(self, min_lat, min_lon, max_lat, max_lon, el_type, amenity):
+        ''' Entries of the cells covering the bbox, and the large ones, that pass the filters. '''
+        row0, col0 = self.grid.cell(min_lat, min_lon)
+        row1, col1 = self.grid.cell(max_lat, max_lon)
+        seen = set()
+        candidates = self._large_entries(seen)
+        for row in xrange(row0, row1 + 1):
+            candidates.extend(self._candidates(self._row_cells(row, col0, col1), seen))
+        return [e for e in candidates if (el_type is None or e[0] == el_type) and (amenity is None or e[2] == amenity)]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, el_type=None, amenity=None):
+        ''' [(type, id)] of the entries intersecting the bbox. '''
+        return [(e_type, e_id) for e_type, e_id, _, box in self._area(min_lat, min_lon, max_lat, max_lon, el_type, amenity)
+                if box[0] <= max_lat and box[2] >= min_lat and box[1] <= max_lon and box[3] >= min_lon]
+
+    def radius(self, lat, lon, meters, el_type=None, amenity=None):
+        ''' [(meters, type, id)] of the entries at most meters away, nearest first. '''
+        dlat = meters / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+        found = []
+        for e_type, e_id, _, box in self._area(lat - dlat, lon - dlon, lat + dlat, lon + dlon, el_type, amenity):
+            d = bbox_distance(lat, lon, box)
+            if d <= meters:
+                found.append((d, e_type, e_id))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k=1, el_type=None, amenity=None):
+        ''' [(meters, type, id)] of the k nearest entries, nearest first.
+
+        Searches rings of cells around the cell of the point until the k-th nearest entry found is closer than
+        any cell outside the rings.
+        '''
+        row_c, col_c = self.grid.cell(lat, lon)
+        cell = self.grid.cell_size
+        seen = set()
+        # max heap of the k nearest so far, by negated distance
+        best = []
+
+        def consider(entries):
+            for e_type, e_id, e_amenity, box in entries:
+                if (el_type is None or e_type == el_type) and (amenity is None or e_amenity == amenity):
+                    item = (-bbox_distance(lat, lon, box), e_type, e_id)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+
+        consider(self._large_entries(seen))
+        if self._extent is None:
+            rows = [key // self.grid.cols for key in self._keys]
+            cols = [key % self.grid.cols for key in self._keys]
+            self._extent = (min(rows), max(rows), min(cols), max(cols)) if rows else (0, -1, 0, -1)
+        row_lo, row_hi, col_lo, col_hi = self._extent
+
+        # rings closer than the first non empty cell are skipped, rings beyond the last one are not searched
+        ring = max(row_lo - row_c, row_c - row_hi, col_lo - col_c, col_c - col_hi, 0)
+        max_ring = max(row_c - row_lo, row_hi - row_c, col_c - col_lo, col_hi - col_c)
+        while ring <= max_ring:
+            for row in xrange(max(row_c - ring, row_lo), min(row_c + ring, row_hi) + 1):
+                if row in (row_c - ring, row_c + ring):
+                    consider(self._candidates(self._row_cells(row, col_c - ring, col_c + ring), seen))
+                else:
+                    consider(self._candidates(self._row_cells(row, col_c - ring, col_c - ring), seen))
+                    if ring:
+                        consider(self._candidates(self._row_cells(row, col_c + ring, col_c + ring), seen))
+
+            if len(best) == k:
+                # nearest point of a cell outside the rings searched so far
+                lat_lo = (row_c - ring) * cell - 90
+                lat_hi = (row_c + ring + 1) * cell - 90
+                lon_lo = (col_c - ring) * cell - 180
+                lon_hi = (col_c + ring + 1) * cell - 180
+                lat_gap = min(lat - lat_lo, lat_hi - lat) * METERS_PER_DEGREE
+                lon_scale = math.cos(math.radians(min(max(abs(lat_lo), abs(lat_hi)), 90)))
+                lon_gap = min(lon - lon_lo, lon_hi - lon) * METERS_PER_DEGREE * lon_scale
+                if -best[0][0] <= min(lat_gap, lon_gap):
+                    break
+            ring += 1
+
+        return sorted((-d, e_type, e_id) for d, e_type, e_id in best)
+
+
+def benchmark(n=1000000, queries=1000, path='/tmp/benchmark.spatial'):
+    ''' Queries/s of the index against a linear scan over n random points around Munich, and identity of the
+    results.
+    '''
+    import random
+    import time
+
+    rnd = random.Random(1)
+    points = [(48.0 + 0.3 * rnd.random(), 11.4 + 0.4 * rnd.random()) for _ in xrange(n)]
+    amenities = [rnd.choice(['cafe', 'bench', None, None, None]) for _ in xrange(n)]
+    started = time.time()
+    with SpatialWriter(path) as writer:
+        for i, ((lat, lon), amenity) in enumerate(zip(points, amenities)):
+            writer.add_row(('node', i, amenity, [lat, lon, lat, lon]))
+    build_time = time.time() - started
+    index = SpatialIndex(path)
+    centers = [(48.0 + 0.3 * rnd.random(), 11.4 + 0.4 * rnd.random()) for _ in xrange(queries)]
+
+    def scan_bbox(lat, lon):
+        return sorted(('node', i) for i, (p_lat, p_lon) in enumerate(points)
+                      if lat <= p_lat <= lat + 0.005 and lon <= p_lon <= lon + 0.005)
+
+    def scan_nearest(lat, lon):
+        return [i for _, i in heapq.nsmallest(5, ((distance(lat, lon, p[0], p[1]), i)
+                                                  for i, p in enumerate(points) if amenities[i] == 'cafe'))]
+
+    checks = [
+        ('bbox 500m', lambda lat, lon: sorted(index.bbox(lat, lon, lat + 0.005, lon + 0.005)), scan_bbox),
+        ('5 nearest cafes', lambda lat, lon: [i for _, _, i in index.nearest(lat, lon, 5, amenity='cafe')], scan_nearest),
+    ]
+    print "{0} points indexed in {1:.1f}s, {2:.0f} MB".format(n, build_time, os.path.getsize(path) / 1e6)
+    for name, query, scan in checks:
+        started = time.time()
+        results = [query(lat, lon) for lat, lon in centers]
+        index_rate = queries / (time.time() - started)
+        scanned = 10
+        started = time.time()
+        expected = [scan(lat, lon) for lat, lon in centers[:scanned]]
+        scan_rate = scanned / (time.time() - started)
+        print "{0}: index {1:.0f} queries/s, linear scan {2:.2f} queries/s, same results: {3}".format(
+            name, index_rate, scan_rate, results[:scanned] == expected)
+    index.close()
+    os.remove(path)
+
+
+def test():
+    import random
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.spatial')
+    rnd = random.Random(2)
+    points = [(48.1 + 0.05 * rnd.random(), 11.5 + 0.05 * rnd.random()) for _ in xrange(2000)]
+    with SpatialWriter(path) as writer:
+        for i, (lat, lon) in enumerate(points):
+            writer.add({'type': 'node', 'id': str(i), 'pos': [lat, lon], 'amenity': 'cafe' if i % 10 == 0 else None})
+        writer.add({'type': 'way', 'id': '7', 'pos': [0.0, 0.0], 'bbox': [48.12, 11.52, 48.121, 11.521]})
+        writer.add({'type': 'relation', 'id': '8', 'pos': [0.0, 0.0], 'bbox': [47.0, 10.0, 49.0, 12.0]})
+        writer.add({'type': 'way', 'id': '9', 'pos': [0.0, 0.0]})
+
+    index = SpatialIndex(path)
+    assert len(index) == 2002
+    box = (48.11, 11.51, 48.13, 11.53)
+    expected = set(('node', i) for i, (lat, lon) in enumerate(points) if box[0] <= lat <= box[2] and box[1] <= lon <= box[3])
+    assert set(index.bbox(*box)) == expected | set([('way', 7), ('relation', 8)])
+    assert set(index.bbox(*box, el_type='way')) == set([('way', 7)])
+
+    lat, lon = 48.125, 11.525
+    near = sorted((distance(lat, lon, p[0], p[1]), 'node', i) for i, p in enumerate(points) if i % 10 == 0)
+    assert index.nearest(lat, lon, 3, amenity='cafe') == near[:3]
+    assert index.radius(lat, lon, 800, amenity='cafe') == [n for n in near if n[0] <= 800]
+    assert index.nearest(lat, lon, 1, el_type='relation') == [(0.0, 'relation', 8)]
+    assert index.nearest(0.0, 0.0, 1, el_type='way')[0][1:] == ('way', 7)
+    index.close()
+
+    # routine indexes the amenity of a node from its tag, shaped documents have none; it runs on a copy of the
+    # input so that its json output lands next to the index
+    import shutil
+    import osmData
+    osmfile = os.path.join(os.path.dirname(path), 'example.osm')
+    shutil.copy('example.osm', osmfile)
+    osmData.routine(osmfile, spatial=path)
+    index = SpatialIndex(path)
+    assert [found[1:] for found in index.nearest(41.97, -87.69, 1, amenity='fast_food')] == [('node', 757860928)]
+    index.close()
+    shutil.rmtree(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,213 @@
+'''
+Bulk load of shaped elements (data.shape_element or data.shape_rows) into a local SQLite database.
+
+Rows are buffered per table and written with executemany inside large
+transactions. Tables are created bare, their indexes only after the load, so
+SQLite does not have to maintain b-trees while millions of rows stream in.
+
+The column order follows the *_FIELDS lists of data.py, i.e. the csv files and
+the tables share the same layout.
+'''
+import sqlite3
+
+TABLES = {
+    'nodes': ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp'],
+    'nodes_tags': ['id', 'key', 'value', 'type'],
+    'ways': ['id', 'user', 'uid', 'version', 'changeset', 'timestamp'],
+    'ways_tags': ['id', 'key', 'value', 'type'],
+    'ways_nodes': ['id', 'node_id', 'position'],
+    'relations': ['id', 'user', 'uid', 'version', 'changeset', 'timestamp'],
+    'relations_tags': ['id', 'key', 'value', 'type'],
+    'relations_members': ['id', 'member_type', 'member_id', 'role', 'position'],
+}
+
+# shape_element key -> table
+SHAPED_TABLES = {
+    'node': 'nodes',
+    'node_tags': 'nodes_tags',
+    'way': 'ways',
+    'way_tags': 'ways_tags',
+    'way_nodes': 'ways_nodes',
+    'relation': 'relations',
+    'relation_tags': 'relations_tags',
+    'relation_members': 'relations_members',
+}
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS ways (
+    id INTEGER NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS relations (
+    id INTEGER NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS relations_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS relations_members (
+    id INTEGER NOT NULL,
+    member_type TEXT NOT NULL,
+    member_id INTEGER NOT NULL,
+    role TEXT,
+    position INTEGER NOT NULL
+);
+'''
+
+INDEX_SQL = '''
+CREATE UNIQUE INDEX IF NOT EXISTS nodes_id ON nodes (id);
+CREATE UNIQUE INDEX IF NOT EXISTS ways_id ON ways (id);
+CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id);
+CREATE INDEX IF NOT EXISTS nodes_tags_key ON nodes_tags (key, value);
+CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id);
+CREATE INDEX IF NOT EXISTS ways_tags_key ON ways_tags (key, value);
+CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position);
+CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id);
+CREATE UNIQUE INDEX IF NOT EXISTS relations_id ON relations (id);
+CREATE INDEX IF NOT EXISTS relations_tags_id ON relations_tags (id);
+CREATE INDEX IF NOT EXISTS relations_tags_key ON relations_tags (key, value);
+CREATE INDEX IF NOT EXISTS relations_members_id ON relations_members (id, position);
+CREATE INDEX IF NOT EXISTS relations_members_member ON relations_members (member_type, member_id);
+'''
+
+BATCH_SIZE = 10000
+TRANSACTION_SIZE = 500000
+
+
+class SqliteLoader(object):
+    ''' Buffered loader of shaped elements into an SQLite file.
+    Args:
+        db_path str - sqlite database file, created if missing; the tables of a previous load are dropped first
+        batch_size int - rows per executemany
+        transaction_size int - rows per commit
+    '''
+
+    def __init__(self, db_path, batch_size=BATCH_SIZE, transaction_size=TRANSACTION_SIZE):
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+        self.rows = 0
+
+        self._conn = sqlite3.connect(db_path)
+        self._conn.text_factory = str
+        # the database is rebuilt from the osm file if the load fails, no need for a journal
+        self._conn.execute('PRAGMA journal_mode = OFF')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        # a new load replaces the previous one, its indexes go with the tables
+        self._conn.executescript(''.join('DROP TABLE IF EXISTS {0};'.format(table) for table in TABLES))
+        self._conn.executescript(SCHEMA_SQL)
+
+        self._insert = {}
+        self._buffers = {}
+        for table, fields in TABLES.iteritems():
+            self._insert[table] = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(table, ', '.join(fields), ', '.join('?' * len(fields)))
+            self._buffers[table] = []
+        self._uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._conn.close()
+
+    def add(self, shaped):
+        ''' Buffer the rows of one data.shape_element or data.shape_rows result. '''
+        for key, value in shaped.iteritems():
+            table = SHAPED_TABLES[key]
+            fields = TABLES[table]
+            buf = self._buffers[table]
+            if isinstance(value, dict):
+                buf.append(tuple(value.get(f) for f in fields))
+            elif value and isinstance(value[0], tuple):
+                # rows of data.shape_rows hold the columns in order, see data.RECORD_FIELDS
+                buf.extend(value)
+            else:
+                buf.extend(tuple(row.get(f) for f in fields) for row in value)
+            if len(buf) >= self.batch_size:
+                self._write(table)
+
+    def close(self):
+        ''' Write the remaining rows, commit and build the indexes. '''
+        for table in TABLES:
+            self._write(table)
+        self._conn.commit()
+        self._conn.executescript(INDEX_SQL)
+        self._conn.commit()
+        self._conn.close()
+
+    def _write(self, table):
+        buf = self._buffers[table]
+        if not buf:
+            return
+        self._conn.executemany(self._insert[table], buf)
+        self.rows += len(buf)
+        self._uncommitted += len(buf)
+        self._buffers[table] = []
+        if self._uncommitted >= self.transaction_size:
+            self._conn.commit()
+            self._uncommitted = 0
+
+
+def test():
+    import data
+    import os
+    import tempfile
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'example.db')
+    # the second load, of tuple rows, replaces the first
+    for shape in (data.shape_element, data.shape_rows):
+        with SqliteLoader(db_path, batch_size=3) as loader:
+            for element in data.get_element('example.osm'):
+                loader.add(shape(element))
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT count(*) FROM nodes').fetchone() == (20,)
+    assert conn.execute('SELECT count(*) FROM ways_nodes').fetchone() == (4,)
+    assert conn.execute("SELECT value FROM nodes_tags WHERE key = 'cuisine'").fetchone() == ('sausage',)
+    assert conn.execute("SELECT member_type, role FROM relations_members ORDER BY position").fetchall() == [('node', 'via'), ('way', 'from'), ('way', 'to')]
+    conn.close()
+    os.remove(db_path)
+
+
+if __name__ == '__main__':
+    test()
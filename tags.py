@@ -1,6 +1,7 @@
-import xml.etree.cElementTree as ET
 import pprint
 import re
+import osmstream
+import sketches
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into your database, you should check the
@@ -45,12 +46,41 @@ def key_type(element, keys):
    return keys
 
 
-def process_map(filename):
-   keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-   for _, element in ET.iterparse(filename):
-      keys = key_type(element, keys)
+class KeyTypeCounter(osmstream.Visitor):
+   # key_type categories of the tags of all top level elements
+   def __init__(self):
+      self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
 
-   return keys
+   def visit(self, element):
+      for tag in element.iter('tag'):
+         self.keys = key_type(tag, self.keys)
+
+   def result(self):
+      return self.keys
+
+
+class TagStats(osmstream.Visitor):
+   # most frequent tag keys, amenities and street suffixes, approximate uses Count-Min / Space-Saving in fixed memory
+   def __init__(self, approximate=False, k=sketches.TOP_K, epsilon=sketches.CMS_EPSILON, delta=sketches.CMS_DELTA):
+      self.k = k
+      self.counters = dict((name, sketches.frequencies(approximate, k, epsilon, delta))
+                           for name in ('keys', 'amenities', 'street_suffixes'))
+
+   def visit(self, element):
+      for tag in element.iter('tag'):
+         key = tag.attrib['k']
+         self.counters['keys'].add(key)
+         if key == 'amenity':
+            self.counters['amenities'].add(tag.attrib['v'])
+         elif key == 'addr:street':
+            self.counters['street_suffixes'].add(tag.attrib['v'].rsplit(' ', 1)[-1])
+
+   def result(self):
+      return dict((name, counter.top(self.k)) for name, counter in self.counters.iteritems())
+
+
+def process_map(filename):
+   return osmstream.run_visitors(filename, [KeyTypeCounter()])[0]
 
 
 
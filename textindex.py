@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+'''
+Inverted index of the names, amenities and addresses of the shaped documents,
+for the text searches the notebook ran with a mongodb $text index.
+
+osmData.routine(..., text=path) tokenizes the TEXT_KEYS tags and the address
+fields of every document. Tokens are lower case words with umlauts and ß
+folded (Straße -> strasse, München -> muenchen) and other accents dropped, so
+queries match either spelling:
+
+    index = TextIndex("munich.osm.text")
+    index.search('cinema')              [(type, id)]
+    index.search('kino OR cinema')
+    index.search('italian -pizza')      italian and not pizza
+    index.search('leopold*')            any token starting with leopold
+    index.count('cinema')
+
+Terms of a query are combined with AND, OR separates alternatives.
+
+The file holds the (type, id) of every document, the sorted terms, and for
+every term the ascending numbers of its documents as varint encoded gaps.
+Opening it reads the terms only, postings are decoded from the memory-mapped
+file when a query needs them, and kept for the following queries.
+'''
+import bisect
+import mmap
+import os
+import re
+import struct
+import unicodedata
+from array import array
+
+# tags tokenized besides the address fields
+TEXT_KEYS = ('name', 'alt_name', 'old_name', 'amenity', 'cuisine', 'shop', 'tourism', 'leisure')
+
+MAGIC = 'TEXTIDX1'
+# magic, number of documents, terms, bytes of the terms, bytes of the postings
+HEADER = struct.Struct('<8sQQQQ')
+# type, id
+DOC = struct.Struct('<Bq')
+TYPES = ('node', 'way', 'relation')
+
+# 'l' is 64 bit on the platforms this runs on, see nodestore.py
+OFFSET_TYPE = 'l'
+
+# decoded postings kept per open index, in terms; the cache starts over when full
+POSTINGS_CACHE = 4096
+
+GERMAN = {u'ä': u'ae', u'ö': u'oe', u'ü': u'ue', u'ß': u'ss'}
+german_re = re.compile(u'[äöüß]')
+word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    ''' Lower case text with umlauts and ß folded and other accents removed. '''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = german_re.sub(lambda m: GERMAN[m.group()], text.lower())
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+
+
+def tokenize(text):
+    ''' Distinct words of text, normalized. '''
+    return set(word_re.findall(normalize(text)))
+
+
+def tokens(doc, tags=None):
+    ''' Tokens of the text fields of a shaped document and its osm tags. '''
+    found = set()
+    for key in TEXT_KEYS:
+        value = doc.get(key, (tags or {}).get(key))
+        if value:
+            found.update(tokenize(value))
+    for value in (doc.get('address') or {}).itervalues():
+        found.update(tokenize(value))
+    return found
+
+
+def encode_gaps(numbers):
+    ''' Varint encoded gaps of ascending numbers. '''
+    out = bytearray()
+    previous = 0
+    for number in numbers:
+        gap = number - previous
+        previous = number
+        while gap >= 0x80:
+            out.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return out
+
+
+def decode_gaps(data):
+    ''' Ascending numbers of encode_gaps output (a bytearray or str). '''
+    numbers = []
+    number = gap = shift = 0
+    for byte in bytearray(data):
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            number += gap
+            numbers.append(number)
+            gap = shift = 0
+    return numbers
+
+
+class Rows(object):
+    ''' Tokens of documents collected by a worker of the parallel routine, added to a TextWriter by the parent. '''
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, doc, tags=None):
+        found = tokens(doc, tags)
+        if found:
+            self.rows.append((doc['type'], int(doc['id']), found))
+
+
+class TextWriter(object):
+    ''' Collects the tokens of the documents added to it and writes the index file on close.
+    Documents without any token are not indexed. Use it as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._docs = []
+        # term -> numbers of its documents, ascending as documents are numbered in order
+        self._postings = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, doc, tags=None):
+        found = tokens(doc, tags)
+        if found:
+            self.add_row((doc['type'], int(doc['id']), found))
+
+    def add_rows(self, rows):
+        for values in rows:
+            self.add_row(values)
+
+    def add_row(self, values):
+        el_type, el_id, found = values
+        number = len(self._docs)
+        self._docs.append(DOC.pack(TYPES.index(el_type), el_id))
+        for term in found:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array('I')
+            postings.append(number)
+
+    def close(self):
+        ''' Write the index, replacing path at once so that readers never see a partial file. '''
+        if self._docs is None:
+            return
+        terms = sorted(self._postings)
+        offsets = array(OFFSET_TYPE, [0])
+        postings = []
+        size = 0
+        for term in terms:
+            encoded = encode_gaps(self._postings[term])
+            postings.append(str(encoded))
+            size += len(encoded)
+            offsets.append(size)
+        terms_blob = '\n'.join(terms)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self._docs), len(terms), len(terms_blob), size))
+            f.write(''.join(self._docs))
+            f.write(terms_blob)
+            offsets.tofile(f)
+            f.write(''.join(postings))
+        os.rename(tmp_path, self.path)
+        self._docs = self._postings = None
+
+
+class TextIndex(object):
+    ''' Read only search over an index file written by TextWriter, see the module doc for the query syntax. '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.documents, n_terms, terms_size, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a text index".format(path))
+
+        self._docs_offset = HEADER.size
+        offset = self._docs_offset + self.documents * DOC.size
+        self.terms = self._map[offset:offset + terms_size].split('\n') if n_terms else []
+        offset += terms_size
+        self._offsets = array(OFFSET_TYPE)
+        self._offsets.fromstring(self._map[offset:offset + (n_terms + 1) * self._offsets.itemsize])
+        self._postings_offset = offset + len(self._offsets) * self._offsets.itemsize
+        self._cache = {}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.documents
+
+    def _postings(self, i):
+        ''' frozenset of the document numbers of the i-th term. '''
+        numbers = self._cache.get(i)
+        if numbers is None:
+            if len(self._cache) >= POSTINGS_CACHE:
+                self._cache = {}
+            start = self._postings_offset + self._offsets[i]
+            numbers = self._cache[i] = frozenset(decode_gaps(self._map[start:self._postings_offset + self._offsets[i + 1]]))
+        return numbers
+
+    def term(self, word):
+        ''' Numbers of the documents containing a word. '''
+        word = normalize(word)
+        i = bisect.bisect_left(self.terms, word)
+        if i < len(self.terms) and self.terms[i] == word:
+            return self._postings(i)
+        return frozenset()
+
+    def prefix(self, start):
+        ''' Numbers of the documents containing a word that starts with start. '''
+        start = normalize(start)
+        numbers = set()
+        i = bisect.bisect_left(self.terms, start)
+        while i < len(self.terms) and self.terms[i].startswith(start):
+            numbers.update(self._postings(i))
+            i += 1
+        return numbers
+
+    def _match(self, word):
+        if word.endswith('*'):
+            return self.prefix(word[:-1])
+        found = frozenset()
+        # a query word may normalize to several tokens, e.g. "Maria-Eich"
+        for i, token in enumerate(sorted(tokenize(word))):
+            found = self.term(token) if i == 0 else found & self.term(token)
+        return found
+
+    def numbers(self, query):
+        ''' Numbers of the documents matching a query. '''
+        result = set()
+        for alternative in re.split(r'\s+OR\s+', query.strip()):
+            words = alternative.split()
+            required = [w for w in words if not w.startswith('-')]
+            excluded = [w[1:] for w in words if w.startswith('-') and len(w) > 1]
+            if not required:
+                continue
+            # smallest postings first, the intersection only shrinks
+            matched = sorted((self._match(w) for w in required), key=len)
+            found = matched[0]
+            for other in matched[1:]:
+                found = found & other
+            for word in excluded:
+                found = found - self._match(word)
+            result |= found
+        return result
+
+    def document(self, number):
+        ''' (type, id) of a document number. '''
+        type_code, el_id = DOC.unpack_from(self._map, self._docs_offset + number * DOC.size)
+        return TYPES[type_code], el_id
+
+    def search(self, query):
+        ''' [(type, id)] of the documents matching a query, in file order. '''
+        return [self.document(n) for n in sorted(self.numbers(query))]
+
+    def count(self, query):
+        return len(self.numbers(query))
+
+
+def benchmark(path, queries=('cinema', 'kino OR cinema', 'italian restaurant', 'strasse*', 'leopold*'), repeat=1000):
+    ''' Microseconds per query of an index built by routine. '''
+    import time
+
+    index = TextIndex(path)
+    print "{0} documents, {1} terms".format(len(index), len(index.terms))
+    for query in queries:
+        started = time.time()
+        for _ in xrange(repeat):
+            found = index.count(query)
+        print "{0!r}: {1} documents, {2:.1f} us".format(query, found, (time.time() - started) / repeat * 1e6)
+    index.close()
+
+
+def test():
+    import tempfile
+
+    assert normalize(u'Straße') == 'strasse' and normalize(u'MÜNCHEN') == 'muenchen' and normalize(u'Café') == 'cafe'
+    assert tokenize('Zu Maria-Eich') == set(['zu', 'maria', 'eich'])
+    numbers = [0, 1, 5, 300, 70000, 70001]
+    assert decode_gaps(str(encode_gaps(numbers))) == numbers
+
+    path = os.path.join(tempfile.mkdtemp(), 'example.text')
+    with TextWriter(path) as writer:
+        writer.add({'type': 'node', 'id': '1', 'address': {'street': u'Leopoldstraße'}}, {'amenity': 'cinema', 'name': 'Kino'})
+        writer.add({'type': 'node', 'id': '2'}, {'amenity': 'restaurant', 'cuisine': 'italian', 'name': u'Pizzeria Müller'})
+        writer.add({'type': 'way', 'id': '3'}, {'amenity': 'restaurant', 'cuisine': 'italian', 'name': 'Da Mario'})
+        writer.add({'type': 'node', 'id': '4'}, {'highway': 'bus_stop'})
+        writer.add_rows([('relation', 5, tokenize(u'Kino am Leopoldplatz'))])
+
+    index = TextIndex(path)
+    assert len(index) == 4
+    assert index.search('cinema') == [('node', 1)]
+    assert index.search('kino') == [('node', 1), ('relation', 5)]
+    assert index.search('kino -leopold*') == [] and index.search('kino OR cinema') == [('node', 1), ('relation', 5)]
+    assert index.search('italian restaurant') == [('node', 2), ('way', 3)]
+    assert index.search('italian -pizzeria') == [('way', 3)]
+    assert index.search(u'müller') == index.search('mueller') == [('node', 2)]
+    assert index.search(u'Leopoldstraße') == index.search('leopoldstrasse') == [('node', 1)]
+    assert index.count('leopold*') == 2 and index.count('bus_stop') == 0 and index.count('') == 0
+    index.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
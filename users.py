@@ -1,6 +1,7 @@
-import xml.etree.cElementTree as ET
 import pprint
 import re
+import osmstream
+import sketches
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -12,16 +13,48 @@ The function process_map should return a set of unique user IDs ("uid")
 def get_user(element):
    return
 
-def process_map(filename):
-   users = set()
-   for _, element in ET.iterparse(filename):
-      if element.tag == 'node':
-         if element.attrib['user'] not in users:
-            users.add(element.attrib['user'])
+class UserCollector(osmstream.Visitor):
+   tags = ('node',)
+
+   def __init__(self):
+      self.users = set()
+
+   def visit(self, element):
+      self.users.add(element.attrib['user'])
+
+   def result(self):
+      return self.users
+
+class DistinctUserCounter(osmstream.Visitor):
+   # number of distinct users and uids of all top level elements, approximate uses HyperLogLog in fixed memory;
+   # anonymous elements (no user or uid attribute) are not counted
+   tags = ('node', 'way', 'relation')
 
-   return users
+   def __init__(self, approximate=False, error=sketches.HLL_ERROR):
+      self.users = sketches.distinct(approximate, error)
+      self.uids = sketches.distinct(approximate, error)
+
+   def visit(self, element):
+      user = element.attrib.get('user')
+      if user is not None:
+         self.users.add(user)
+      uid = element.attrib.get('uid')
+      if uid is not None:
+         self.uids.add(uid)
+
+   def result(self):
+      return {'user': self.users.count(), 'uid': self.uids.count()}
+
+def process_map(filename):
+   return osmstream.run_visitors(filename, [UserCollector()])[0]
 
 def test():
+   import xml.etree.cElementTree as ET
+   counter = DistinctUserCounter()
+   for xml in ('<node user="a" uid="1"/>', '<node user="a" uid="1"/>', '<node/>', '<way user="b" uid="2"/>'):
+      counter.visit(ET.fromstring(xml))
+   assert counter.result() == {'user': 2, 'uid': 2}
+
    users = process_map('users_example.osm')
    pprint.pprint(users)
    assert len(users) == 6